@@ -0,0 +1,68 @@
+import os
+from typing import Any, Dict, List, Optional
+
+from write_behind import WriteBehindBuffer
+
+ATTEMPT_LOG_WRITE_BEHIND = os.getenv("ATTEMPT_LOG_WRITE_BEHIND", "0").lower() in ("1", "true", "yes")
+ATTEMPT_LOG_BATCH_SIZE = int(os.getenv("ATTEMPT_LOG_BATCH_SIZE", "500"))
+ATTEMPT_LOG_FLUSH_SECONDS = float(os.getenv("ATTEMPT_LOG_FLUSH_SECONDS", "1.0"))
+ATTEMPT_LOG_MAX_BUFFER = int(os.getenv("ATTEMPT_LOG_MAX_BUFFER", "20000"))
+ATTEMPT_LOG_BLOCK_SECONDS = float(os.getenv("ATTEMPT_LOG_BLOCK_SECONDS", "0.25"))
+ATTEMPT_LOG_SPILL_PATH = os.getenv("ATTEMPT_LOG_SPILL_PATH", "attempts.spill.jsonl")
+
+# Column -> Postgres type, for COPY and for bulk unnest() inserts.
+ATTEMPT_COLUMN_TYPES = {
+    "student_id": "text",
+    "skill_name": "text",
+    "answer": "text",
+    "attempt_count": "int",
+    "time_on_task": "int",
+    "hints_used": "int",
+    "correct": "bool",
+    "created_at": "timestamptz",
+}
+ATTEMPT_COLUMNS = tuple(ATTEMPT_COLUMN_TYPES)
+
+_LOG: Optional[WriteBehindBuffer] = None
+
+
+def start_attempt_log() -> None:
+    global _LOG
+    if _LOG is None:
+        _LOG = WriteBehindBuffer(
+            "attempts",
+            ATTEMPT_COLUMNS,
+            batch_size=ATTEMPT_LOG_BATCH_SIZE,
+            flush_seconds=ATTEMPT_LOG_FLUSH_SECONDS,
+            max_buffer=ATTEMPT_LOG_MAX_BUFFER,
+            block_seconds=ATTEMPT_LOG_BLOCK_SECONDS,
+            spill_path=ATTEMPT_LOG_SPILL_PATH,
+        )
+        _LOG.start()
+
+
+async def stop_attempt_log() -> None:
+    global _LOG
+    if _LOG is not None:
+        log, _LOG = _LOG, None
+        await log.stop()
+
+
+def attempt_log_enabled() -> bool:
+    return _LOG is not None
+
+
+async def log_attempt(row: Dict[str, Any]) -> None:
+    if _LOG is not None:
+        await _LOG.log(row)
+
+
+async def log_attempts(rows: List[Dict[str, Any]]) -> None:
+    if _LOG is not None:
+        await _LOG.log_many(rows)
+
+
+def attempt_log_metrics() -> Dict[str, Any]:
+    if _LOG is None:
+        return {"enabled": False}
+    return {"enabled": True, **_LOG.metrics()}
@@ -0,0 +1,214 @@
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import re
+import socket
+import statistics
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_stub_llm(delay: float) -> ThreadingHTTPServer:
+    # OpenAI-compatible /chat/completions that answers after `server.delay`
+    # seconds (plus `server.item_delay` per batched problem and
+    # `server.token_delay` per 8-character piece, streamed when asked) with
+    # HTTP `server.status`; all of these can be changed while running.
+    counter = itertools.count(1)
+
+    def problem() -> Dict[str, str]:
+        x = next(counter)
+        return {"prompt": "Solve for x.", "latex": f"2x + 1 = {2 * x + 1}", "answer": str(x)}
+
+    def content_for(count: Optional[int]) -> str:
+        if count is None:
+            return json.dumps(problem())
+        return json.dumps([problem() for _ in range(count)])
+
+    def completion(prompt_text: str, content: str) -> bytes:
+        return json.dumps(
+            {
+                "id": "bench",
+                "object": "chat.completion",
+                "created": 0,
+                "model": "bench",
+                "choices": [
+                    {
+                        "index": 0,
+                        "finish_reason": "stop",
+                        "message": {"role": "assistant", "content": content},
+                    }
+                ],
+                # Rough 4-characters-per-token estimate.
+                "usage": {
+                    "prompt_tokens": len(prompt_text) // 4,
+                    "completion_tokens": len(content) // 4,
+                    "total_tokens": (len(prompt_text) + len(content)) // 4,
+                },
+            }
+        ).encode()
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        disable_nagle_algorithm = True
+
+        def do_POST(self) -> None:
+            request = json.loads(self.rfile.read(int(self.headers.get("Content-Length") or 0)))
+            prompt_text = " ".join(message["content"] for message in request.get("messages", []))
+            # Batched prompts carry "Count: N" and get a JSON array back.
+            match = re.search(r"Count: (\d+)", prompt_text)
+            count = int(match.group(1)) if match else None
+            time.sleep(self.server.delay + self.server.item_delay * (count or 1))
+            status = self.server.status
+            if status != 200:
+                self.reply(status, b'{"error": {"message": "stub failure"}}')
+                return
+            content = content_for(count)
+            pieces = [content[idx:idx + 8] for idx in range(0, len(content), 8)]
+            if not request.get("stream"):
+                time.sleep(self.server.token_delay * len(pieces))
+                self.reply(200, completion(prompt_text, content))
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Connection", "close")
+            self.end_headers()
+            self.close_connection = True
+            for piece in pieces:
+                time.sleep(self.server.token_delay)
+                chunk = {
+                    "id": "bench",
+                    "object": "chat.completion.chunk",
+                    "created": 0,
+                    "model": "bench",
+                    "choices": [{"index": 0, "delta": {"content": piece}, "finish_reason": None}],
+                }
+                self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode())
+                self.wfile.flush()
+            self.wfile.write(b"data: [DONE]\n\n")
+
+        def reply(self, status: int, body: bytes) -> None:
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args: Any) -> None:
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", free_port()), Handler)
+    server.daemon_threads = True
+    server.delay = delay
+    server.item_delay = 0.0
+    server.token_delay = 0.0
+    server.status = 200
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def legacy_app():
+    # The pre-async request path: sync handlers run on the framework threadpool.
+    from fastapi import FastAPI
+
+    import main as api
+    from llm import generate_problem_with_llm
+
+    app = FastAPI()
+
+    @app.get("/bkt/snapshot")
+    def bkt_snapshot(student_id: str, skill_name: str) -> Dict[str, Any]:
+        return api.get_state_memory(student_id, skill_name)
+
+    @app.post("/llm/problem")
+    def llm_problem(payload: api.ProblemRequest) -> Dict[str, Any]:
+        problem = generate_problem_with_llm(
+            skill_name=payload.skill_name, mastery=api.DEFAULT_PRIOR, zpd_status="zpd"
+        )
+        return problem or {}
+
+    return app
+
+
+async def measure(app, burst: int, probes: int) -> List[float]:
+    import httpx
+    import uvicorn
+
+    port = free_port()
+    server = uvicorn.Server(uvicorn.Config(app, port=port, log_level="warning", lifespan="on"))
+    serve_task = asyncio.create_task(server.serve())
+    while not server.started:
+        await asyncio.sleep(0.01)
+
+    base = f"http://127.0.0.1:{port}"
+    limits = httpx.Limits(max_connections=burst + probes)
+    async with httpx.AsyncClient(base_url=base, timeout=120, limits=limits) as client:
+        llm_calls = [
+            asyncio.create_task(
+                client.post("/llm/problem", json={"skill_name": "6.EE.A.1", "student_id": f"B-{idx}"})
+            )
+            for idx in range(burst)
+        ]
+        await asyncio.sleep(0.2)
+        latencies = []
+        for idx in range(probes):
+            started = time.perf_counter()
+            response = await client.get(
+                "/bkt/snapshot", params={"student_id": f"P-{idx}", "skill_name": "6.EE.A.1"}
+            )
+            response.raise_for_status()
+            latencies.append(time.perf_counter() - started)
+        for response in await asyncio.gather(*llm_calls):
+            response.raise_for_status()
+
+    server.should_exit = True
+    await serve_task
+    return latencies
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(
+        description="Snapshot latency while a burst of slow LLM calls is in flight."
+    )
+    parser.add_argument("--burst", type=int, default=120, help="Concurrent /llm/problem calls.")
+    parser.add_argument("--probes", type=int, default=20, help="Sequential /bkt/snapshot calls.")
+    parser.add_argument("--llm-delay", type=float, default=2.0, help="Stub LLM latency in seconds.")
+    args = parser.parse_args()
+
+    # Memory mode keeps the database out of the measurement.
+    for name in ("SUPABASE_DB_URL", "DATABASE_URL", "SUPABASE_DATABASE_URL"):
+        os.environ.pop(name, None)
+    stub = start_stub_llm(args.llm_delay)
+    os.environ["DEEPSEEK_API_KEY"] = "bench"
+    os.environ["DEEPSEEK_BASE_URL"] = f"http://127.0.0.1:{stub.server_port}"
+    import main as api
+
+    if api.USE_DB:
+        print("Database URL still configured; refusing to run.", file=sys.stderr)
+        return 1
+
+    results = {}
+    for label, app in (("sync handlers", legacy_app()), ("async handlers", api.app)):
+        latencies = asyncio.run(measure(app, args.burst, args.probes))
+        results[label] = max(latencies)
+        print(
+            f"{label:>15}: snapshot p50 {statistics.median(latencies) * 1000:8.1f} ms, "
+            f"max {results[label] * 1000:8.1f} ms during {args.burst} LLM calls"
+        )
+    stub.shutdown()
+    print(f"worst-case improvement: {results['sync handlers'] / results['async handlers']:.1f}x")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
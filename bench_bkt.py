@@ -0,0 +1,68 @@
+import argparse
+import time
+
+import numpy as np
+
+from bkt import replay_mastery_batch, update_mastery, update_mastery_batch
+
+
+def _time(fn) -> float:
+    start = time.perf_counter()
+    fn()
+    return time.perf_counter() - start
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Benchmark scalar vs batch BKT updates.")
+    parser.add_argument("--pairs", type=int, default=2_000_000, help="Student-skill pairs.")
+    parser.add_argument("--steps", type=int, default=10, help="Observations replayed per pair.")
+    parser.add_argument(
+        "--scalar-sample",
+        type=int,
+        default=200_000,
+        help="Updates timed with the scalar function (extrapolated to --pairs).",
+    )
+    parser.add_argument("--seed", type=int, default=7)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    priors = rng.random(args.pairs)
+    correct = rng.random(args.pairs) < 0.6
+    guess = rng.uniform(0.05, 0.3, args.pairs)
+    slip = rng.uniform(0.05, 0.2, args.pairs)
+    transit = rng.uniform(0.05, 0.3, args.pairs)
+
+    sample = min(args.scalar_sample, args.pairs)
+    scalar_out = np.empty(sample)
+
+    def run_scalar() -> None:
+        for i in range(sample):
+            scalar_out[i] = update_mastery(
+                priors[i], bool(correct[i]), guess[i], slip[i], transit[i]
+            )
+
+    scalar_seconds = _time(run_scalar) * (args.pairs / sample)
+    batch_out = update_mastery_batch(priors, correct, guess, slip, transit)
+    batch_seconds = _time(lambda: update_mastery_batch(priors, correct, guess, slip, transit))
+    max_diff = float(np.max(np.abs(batch_out[:sample] - scalar_out)))
+
+    print(f"single update, {args.pairs:,} pairs")
+    print(f"  scalar (extrapolated): {scalar_seconds:8.3f}s  {args.pairs / scalar_seconds:14,.0f} updates/s")
+    print(f"  batch:                 {batch_seconds:8.3f}s  {args.pairs / batch_seconds:14,.0f} updates/s")
+    print(f"  speedup: {scalar_seconds / batch_seconds:.1f}x  max |diff|: {max_diff:.2e}")
+
+    observations = (rng.random((args.pairs, args.steps)) < 0.6).astype(np.int8)
+    total = args.pairs * args.steps
+    replay_seconds = _time(
+        lambda: replay_mastery_batch(priors, observations, guess, slip, transit)
+    )
+    per_update = scalar_seconds / args.pairs
+    print(f"sequence replay, {args.pairs:,} pairs x {args.steps} steps = {total:,} updates")
+    print(f"  scalar (extrapolated): {per_update * total:8.3f}s")
+    print(f"  batch:                 {replay_seconds:8.3f}s  {total / replay_seconds:14,.0f} updates/s")
+    print(f"  speedup: {per_update * total / replay_seconds:.1f}x")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
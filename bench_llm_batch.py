@@ -0,0 +1,71 @@
+import argparse
+import asyncio
+import os
+import time
+
+from bench_async_api import start_stub_llm
+
+
+async def produce(llm, total: int, batch_size: int, concurrency: int) -> int:
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one_call() -> int:
+        async with semaphore:
+            if batch_size == 1:
+                problem = await llm.generate_problem_with_llm_async(
+                    skill_name="6.EE.A.1", mastery=0.5, zpd_status="challenge"
+                )
+                return 1 if problem else 0
+            problems = await llm.generate_problems_with_llm_async(
+                skill_name="6.EE.A.1", mastery=0.5, zpd_status="challenge", count=batch_size
+            )
+            return len(problems)
+
+    calls = -(-total // batch_size)
+    return sum(await asyncio.gather(*(one_call() for _ in range(calls))))
+
+
+async def bench(args: argparse.Namespace) -> int:
+    import llm
+
+    for batch_size in (1, args.batch_size):
+        before = llm.STATS.snapshot()
+        started = time.perf_counter()
+        produced = await produce(llm, args.problems, batch_size, args.concurrency)
+        elapsed = time.perf_counter() - started
+        after = llm.STATS.snapshot()
+        calls = after["calls"] - before["calls"]
+        prompt_tokens = after["prompt_tokens"] - before["prompt_tokens"]
+        completion_tokens = after["completion_tokens"] - before["completion_tokens"]
+        print(
+            f"batch={batch_size:>2}: {produced / elapsed:7.1f} problems/s, {calls:>4} calls, "
+            f"{prompt_tokens / max(produced, 1):6.1f} prompt + "
+            f"{completion_tokens / max(produced, 1):5.1f} completion tokens/problem"
+        )
+    await llm.close_llm_clients()
+    return 0
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(
+        description="Problems/sec and tokens per problem for single vs batched LLM generation."
+    )
+    parser.add_argument("--problems", type=int, default=200)
+    parser.add_argument("--batch-size", type=int, default=5)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--delay", type=float, default=0.4, help="Stub latency per completion.")
+    parser.add_argument("--item-delay", type=float, default=0.05, help="Stub latency per problem.")
+    args = parser.parse_args()
+
+    stub = start_stub_llm(args.delay)
+    stub.item_delay = args.item_delay
+    os.environ["DEEPSEEK_API_KEY"] = "bench"
+    os.environ["DEEPSEEK_BASE_URL"] = f"http://127.0.0.1:{stub.server_port}"
+    try:
+        return asyncio.run(bench(args))
+    finally:
+        stub.shutdown()
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,102 @@
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+from openai import AsyncOpenAI
+
+from bench_async_api import start_stub_llm
+
+
+async def per_call_clients(base_url: str, calls: int) -> float:
+    # The old shape: a fresh client (and TCP connection) for every completion.
+    started = time.perf_counter()
+    for _ in range(calls):
+        client = AsyncOpenAI(api_key="bench", base_url=base_url, max_retries=0)
+        await client.chat.completions.create(
+            model="bench", messages=[{"role": "user", "content": "x"}]
+        )
+        await client.close()
+    return time.perf_counter() - started
+
+
+async def shared_client(llm, calls: int) -> float:
+    started = time.perf_counter()
+    for _ in range(calls):
+        await llm.generate_problem_with_llm_async(
+            skill_name="6.EE.A.1", mastery=0.5, zpd_status="challenge"
+        )
+    return time.perf_counter() - started
+
+
+async def bench(args: argparse.Namespace, stub) -> int:
+    import llm
+
+    base_url = os.environ["DEEPSEEK_BASE_URL"]
+    fresh = await per_call_clients(base_url, args.calls)
+    shared = await shared_client(llm, args.calls)
+    print(f"  per-call client: {fresh / args.calls * 1000:7.2f} ms/call")
+    print(f"    shared client: {shared / args.calls * 1000:7.2f} ms/call ({fresh / shared:.1f}x)")
+
+    # Hung upstream: every call must end within the budget.
+    stub.delay = args.timeout * 3
+    started = time.perf_counter()
+    result = await llm.generate_problem_with_llm_async(
+        skill_name="6.EE.A.1", mastery=0.5, zpd_status="challenge"
+    )
+    elapsed = time.perf_counter() - started
+    print(f"     hung upstream: returned {result} after {elapsed:.2f}s (budget {args.timeout}s)")
+    if result is not None or elapsed > args.timeout + 0.5:
+        print("deadline not enforced", file=sys.stderr)
+        return 1
+
+    # Failing upstream: the breaker opens and later calls skip the network.
+    stub.delay = 0.0
+    stub.status = 500
+    while llm.BREAKER.state != "open":
+        await llm.generate_problem_with_llm_async(
+            skill_name="6.EE.A.1", mastery=0.5, zpd_status="challenge"
+        )
+    started = time.perf_counter()
+    for _ in range(args.calls):
+        await llm.generate_problem_with_llm_async(
+            skill_name="6.EE.A.1", mastery=0.5, zpd_status="challenge"
+        )
+    open_cost = (time.perf_counter() - started) / args.calls
+    print(f"     breaker open: {open_cost * 1e6:7.1f} us/call")
+
+    # Recovered upstream: after the cooldown one probe closes the breaker.
+    stub.status = 200
+    await asyncio.sleep(args.cooldown)
+    await llm.generate_problem_with_llm_async(
+        skill_name="6.EE.A.1", mastery=0.5, zpd_status="challenge"
+    )
+    print(f"  after cooldown: breaker {llm.BREAKER.state}")
+    print(llm.llm_metrics())
+    await llm.close_llm_clients()
+    return 0 if llm.BREAKER.state == "closed" else 1
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(
+        description="Exercise the shared LLM client against a local stub: reuse, deadline, breaker."
+    )
+    parser.add_argument("--calls", type=int, default=200)
+    parser.add_argument("--timeout", type=float, default=1.0)
+    parser.add_argument("--cooldown", type=float, default=1.0)
+    args = parser.parse_args()
+
+    stub = start_stub_llm(0.0)
+    os.environ["DEEPSEEK_API_KEY"] = "bench"
+    os.environ["DEEPSEEK_BASE_URL"] = f"http://127.0.0.1:{stub.server_port}"
+    os.environ["LLM_TIMEOUT_SECONDS"] = str(args.timeout)
+    os.environ["LLM_BREAKER_COOLDOWN_SECONDS"] = str(args.cooldown)
+    try:
+        return asyncio.run(bench(args, stub))
+    finally:
+        stub.shutdown()
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
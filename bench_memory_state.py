@@ -0,0 +1,101 @@
+import argparse
+import gc
+import os
+import tempfile
+import time
+import tracemalloc
+import uuid
+from typing import Any, Callable, Dict, List, Tuple
+
+from memory_store import LearnerRecord, LearnerStateStore
+
+
+def fill_dicts(students: List[str], skills: List[str]) -> Any:
+    # The old layout: two tuple-keyed dicts holding one dict per pair.
+    memory_state: Dict[Tuple[str, str], Dict[str, Any]] = {}
+    intervention_state: Dict[Tuple[str, str], Dict[str, Any]] = {}
+    for student_id in students:
+        for skill_name in skills:
+            key = (student_id, skill_name)
+            memory_state[key] = {
+                "prior_skill_mastery": 0.3,
+                "learning_velocity": 0.0,
+                "attempt_count": 1,
+            }
+            intervention_state[key] = {"intervention_active": False, "recovery_streak": 0}
+    return memory_state, intervention_state
+
+
+def fill_store(students: List[str], skills: List[str], max_entries: int) -> Any:
+    store = LearnerStateStore(max_entries=max_entries, ttl_seconds=0, spill_path=None)
+    record = LearnerRecord(0.3, 0.0, 1, False, 0)
+    for student_id in students:
+        for skill_name in skills:
+            store.put(student_id, skill_name, record)
+    return store
+
+
+def measure(label: str, pairs: int, build: Callable[[], Any]) -> float:
+    gc.collect()
+    tracemalloc.start()
+    started = time.perf_counter()
+    result = build()
+    elapsed = time.perf_counter() - started
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    print(
+        f"{label:>6}: {current / pairs:7.1f} bytes/pair retained, "
+        f"{peak / 2**20:7.1f} MiB peak, {pairs / elapsed / 1000:7.1f}k inserts/s"
+    )
+    return current
+
+
+def spill_roundtrip(students: List[str], skills: List[str], max_entries: int) -> None:
+    # A bounded store spills evicted pairs to disk and reloads them on demand.
+    with tempfile.TemporaryDirectory() as tmp:
+        store = LearnerStateStore(
+            max_entries=max_entries, ttl_seconds=0, spill_path=os.path.join(tmp, "state.db")
+        )
+        record = LearnerRecord(0.3, 0.0, 1, False, 0)
+        started = time.perf_counter()
+        for student_id in students:
+            for skill_name in skills:
+                store.put(student_id, skill_name, record)
+        elapsed = time.perf_counter() - started
+        reloaded = store.get(students[0], skills[0])
+        metrics = store.metrics()
+        store.close()
+    print(
+        f" bound: {metrics['entries']} live of {len(students) * len(skills)} pairs, "
+        f"{metrics['evictions']} spilled in {elapsed:.1f}s, first pair reloaded: {reloaded is not None}"
+    )
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(
+        description="Memory per student-skill pair: tuple-keyed dicts vs LearnerStateStore."
+    )
+    parser.add_argument("--students", type=int, default=50000)
+    parser.add_argument("--skills", type=int, default=20)
+    parser.add_argument(
+        "--bound", type=int, default=100000, help="max_entries for the spill run (0 skips it)."
+    )
+    args = parser.parse_args()
+
+    # Ids are allocated up front so both layouts share the same string objects.
+    students = [str(uuid.uuid4()) for _ in range(args.students)]
+    skills = [f"6.EE.A.{index}" for index in range(args.skills)]
+    pairs = len(students) * len(skills)
+    print(f"{pairs} student-skill pairs ({args.students} students x {args.skills} skills)")
+
+    dicts = measure("dicts", pairs, lambda: fill_dicts(students, skills))
+    store = measure("store", pairs, lambda: fill_store(students, skills, pairs))
+    print(f"memory reduction: {dicts / store:.1f}x")
+    if args.bound:
+        spill_roundtrip(students, skills, args.bound)
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
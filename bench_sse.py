@@ -0,0 +1,84 @@
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+from typing import List, Tuple
+
+from bench_async_api import free_port, start_stub_llm
+
+
+async def first_prompt(client, path: str) -> Tuple[float, float]:
+    # Seconds until prompt text is readable, and until the response is complete.
+    started = time.perf_counter()
+    seen = None
+    body = b""
+    async with client.stream("POST", path, json={"skill_name": "6.EE.A.1"}) as response:
+        response.raise_for_status()
+        async for chunk in response.aiter_raw():
+            body += chunk
+            if seen is None and (b"event: prompt" in body or b'"prompt"' in body):
+                seen = time.perf_counter() - started
+    return seen or 0.0, time.perf_counter() - started
+
+
+async def bench(args: argparse.Namespace) -> int:
+    import httpx
+    import uvicorn
+
+    import main as api
+
+    port = free_port()
+    server = uvicorn.Server(uvicorn.Config(api.app, port=port, log_level="warning"))
+    serve_task = asyncio.create_task(server.serve())
+    while not server.started:
+        await asyncio.sleep(0.01)
+
+    results = {}
+    async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{port}", timeout=60) as client:
+        for label, path in (("blocking", "/llm/problem"), ("streaming", "/llm/problem/stream")):
+            samples: List[Tuple[float, float]] = []
+            for _ in range(args.requests):
+                samples.append(await first_prompt(client, path))
+            results[label] = statistics.median(sample[0] for sample in samples)
+            total = statistics.median(sample[1] for sample in samples)
+            print(
+                f"{label:>10}: first prompt text {results[label] * 1000:7.1f} ms, "
+                f"complete {total * 1000:7.1f} ms"
+            )
+
+    server.should_exit = True
+    await serve_task
+    print(f"time-to-first-prompt improvement: {results['blocking'] / results['streaming']:.1f}x")
+    return 0
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(
+        description="Time to first prompt text for /llm/problem vs its SSE variant against a stub LLM."
+    )
+    parser.add_argument("--requests", type=int, default=10)
+    parser.add_argument("--delay", type=float, default=0.3, help="Stub time to first token.")
+    parser.add_argument("--token-delay", type=float, default=0.05, help="Stub delay per chunk.")
+    args = parser.parse_args()
+
+    # Memory mode and no pool, so every request reaches the LLM.
+    for name in ("SUPABASE_DB_URL", "DATABASE_URL", "SUPABASE_DATABASE_URL"):
+        os.environ.pop(name, None)
+    os.environ["PROBLEM_POOL_ENABLED"] = "0"
+    stub = start_stub_llm(args.delay)
+    stub.token_delay = args.token_delay
+    os.environ["DEEPSEEK_API_KEY"] = "bench"
+    os.environ["DEEPSEEK_BASE_URL"] = f"http://127.0.0.1:{stub.server_port}"
+    try:
+        return asyncio.run(bench(args))
+    except Exception as exc:
+        print(f"Benchmark failed: {exc}", file=sys.stderr)
+        return 1
+    finally:
+        stub.shutdown()
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -1,4 +1,22 @@
-﻿from typing import Dict
+﻿import csv
+import os
+from pathlib import Path
+from typing import Any, Dict, Mapping, Optional, Tuple, Union
+
+import numpy as np
+from dotenv import load_dotenv
+
+load_dotenv()
+
+ArrayLike = Union[float, np.ndarray]
+
+DEFAULT_PRIOR = float(os.getenv("DEFAULT_SKILL_PRIOR", "0.3"))
+MASTERY_SNAP_THRESHOLD = float(os.getenv("MASTERY_SNAP_THRESHOLD", "0.99"))
+MAX_HINTS_PER_QUESTION = int(os.getenv("MAX_HINTS_PER_QUESTION", "3"))
+
+BKT_PARAM_NAMES = ("guess", "slip", "transit")
+
+_SKILL_BKT_PARAMS: Optional[Dict[str, Dict[str, float]]] = None
 
 DEFAULT_BKT_PARAMS: Dict[str, float] = {
     "guess": 0.2,
@@ -41,6 +59,154 @@ def update_mastery(
     return _clamp_prob(next_mastery)
 
 
+def advance_learner_state(
+    prior: float,
+    correct: bool,
+    attempt_count: int,
+    hints_used: Optional[int],
+    intervention: Dict[str, Any],
+    params: Dict[str, float],
+) -> Tuple[float, Dict[str, Any]]:
+    active_before = bool(intervention.get("intervention_active"))
+    recovery_streak = int(intervention.get("recovery_streak") or 0)
+    trigger_now = attempt_count > 3
+    active_for_update = active_before or trigger_now
+
+    if active_for_update:
+        next_mastery = prior
+    else:
+        next_mastery = update_mastery(prior, correct, **params)
+        if next_mastery >= MASTERY_SNAP_THRESHOLD:
+            next_mastery = 1.0
+
+    active = active_before
+    if trigger_now and not active_before:
+        active = True
+        recovery_streak = 0
+    elif active_before:
+        used_max_hints = hints_used is not None and hints_used >= MAX_HINTS_PER_QUESTION
+        if correct and not used_max_hints:
+            recovery_streak += 1
+        else:
+            recovery_streak = 0
+        if recovery_streak >= 3:
+            active = False
+            recovery_streak = 0
+
+    return next_mastery, {"intervention_active": active, "recovery_streak": recovery_streak}
+
+
+def skill_params_loaded() -> bool:
+    return _SKILL_BKT_PARAMS is not None
+
+
+def set_skill_params(table: Mapping[str, Mapping[str, float]]) -> None:
+    global _SKILL_BKT_PARAMS
+    params: Dict[str, Dict[str, float]] = {}
+    for skill_name, values in table.items():
+        merged = dict(DEFAULT_BKT_PARAMS)
+        for name in BKT_PARAM_NAMES:
+            if values.get(name) is not None:
+                merged[name] = _clamp_prob(float(values[name]))
+        params[skill_name] = merged
+    _SKILL_BKT_PARAMS = params
+
+
+def get_skill_params(skill_name: Optional[str]) -> Dict[str, float]:
+    if _SKILL_BKT_PARAMS and skill_name in _SKILL_BKT_PARAMS:
+        return _SKILL_BKT_PARAMS[skill_name]
+    return DEFAULT_BKT_PARAMS
+
+
+def load_skill_params_csv(path: Union[str, Path]) -> Dict[str, Dict[str, float]]:
+    table: Dict[str, Dict[str, float]] = {}
+    with open(path, "r", encoding="utf-8") as handle:
+        for row in csv.DictReader(handle):
+            skill_name = (row.get("skill_name") or "").strip()
+            if not skill_name:
+                continue
+            table[skill_name] = {
+                name: float(row[name]) for name in BKT_PARAM_NAMES if row.get(name)
+            }
+    return table
+
+
+def _clamp_array(values: ArrayLike, size: int) -> np.ndarray:
+    arr = np.asarray(values, dtype=np.float64)
+    arr = np.nan_to_num(arr, nan=0.0, posinf=1.0, neginf=0.0)
+    arr = np.clip(arr, 0.0, 1.0)
+    return np.broadcast_to(arr, (size,)) if arr.ndim == 0 else arr
+
+
+def _step(
+    prior: np.ndarray,
+    correct: np.ndarray,
+    guess: np.ndarray,
+    slip: np.ndarray,
+    transit: np.ndarray,
+) -> np.ndarray:
+    numerator = np.where(correct, prior * (1.0 - slip), prior * slip)
+    denominator = numerator + np.where(
+        correct, (1.0 - prior) * guess, (1.0 - prior) * (1.0 - guess)
+    )
+    with np.errstate(divide="ignore", invalid="ignore"):
+        posterior = np.where(denominator == 0, prior, numerator / denominator)
+    next_mastery = posterior + (1.0 - posterior) * transit
+    return np.clip(next_mastery, 0.0, 1.0)
+
+
+def update_mastery_batch(
+    priors: ArrayLike,
+    correct: ArrayLike,
+    guess: ArrayLike = DEFAULT_BKT_PARAMS["guess"],
+    slip: ArrayLike = DEFAULT_BKT_PARAMS["slip"],
+    transit: ArrayLike = DEFAULT_BKT_PARAMS["transit"],
+) -> np.ndarray:
+    correct_arr = np.asarray(correct, dtype=bool).reshape(-1)
+    size = correct_arr.shape[0]
+    prior = _clamp_array(priors, size).reshape(-1)
+    if prior.shape[0] != size:
+        raise ValueError("priors and correct must have the same length")
+    guess_arr = _clamp_array(guess, size)
+    slip_arr = _clamp_array(slip, size)
+    transit_arr = _clamp_array(transit, size)
+    return _step(prior, correct_arr, guess_arr, slip_arr, transit_arr)
+
+
+def replay_mastery_batch(
+    priors: ArrayLike,
+    observations: np.ndarray,
+    guess: ArrayLike = DEFAULT_BKT_PARAMS["guess"],
+    slip: ArrayLike = DEFAULT_BKT_PARAMS["slip"],
+    transit: ArrayLike = DEFAULT_BKT_PARAMS["transit"],
+    return_trajectory: bool = False,
+) -> np.ndarray:
+    # observations: (pairs, steps) of 1 = correct, 0 = incorrect, -1 = padding.
+    # Padded steps leave mastery unchanged so ragged histories share one matrix.
+    obs = np.asarray(observations)
+    if obs.ndim != 2:
+        raise ValueError("observations must be a 2-D (pairs, steps) array")
+    size, steps = obs.shape
+    mastery = np.array(_clamp_array(priors, size), dtype=np.float64).reshape(-1)
+    if mastery.shape[0] != size:
+        raise ValueError("priors and observations must have the same number of rows")
+    guess_arr = _clamp_array(guess, size)
+    slip_arr = _clamp_array(slip, size)
+    transit_arr = _clamp_array(transit, size)
+
+    trajectory: Optional[np.ndarray] = None
+    if return_trajectory:
+        trajectory = np.empty((size, steps), dtype=np.float64)
+    for step in range(steps):
+        column = obs[:, step]
+        observed = column >= 0
+        updated = _step(mastery, column > 0, guess_arr, slip_arr, transit_arr)
+        mastery = np.where(observed, updated, mastery)
+        if trajectory is not None:
+            trajectory[:, step] = mastery
+    return trajectory if trajectory is not None else mastery
+
+
 def main() -> None:
     print("bkt module ready")
 
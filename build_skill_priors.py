@@ -1,38 +1,306 @@
- PD_GLOB = r"C:\Users\tanne\Downloads\merged data\*\pdets*.csv"
-  PL_GLOB = r"C:\Users\tanne\Downloads\merged data\*\plogs*.csv"
-  con = duckdb.connect()
-
-  query = f"""
-  copy (
-    with pdets as (
-      select
-        cast(problem_id as bigint) as problem_id,
-        trim(skill) as skill_name
-      from read_csv_auto('{PD_GLOB}', union_by_name=true)
-      cross join unnest(
-        string_split(
-          replace(replace(replace(replace(skills, '[', ''), ']', ''), '''', ''), '"', ''),
-          ','
+import argparse
+import glob
+import hashlib
+import json
+import os
+import shutil
+import sys
+import time
+from typing import Dict, List, Optional, Tuple
+
+MANIFEST_NAME = "manifest.json"
+# Bumped when a projection changes, so every file is reconverted.
+MANIFEST_VERSION = 2
+
+# Typed projections of the raw ASSISTments exports. pdets is exploded to one
+# row per (problem, skill) at conversion time so no later run parses skills;
+# plogs keeps only the columns the priors need, so exports without student
+# or timing columns convert too.
+PDETS_SELECT = """
+select distinct
+  cast(problem_id as bigint) as problem_id,
+  trim(skill) as skill_name
+from {source}
+cross join unnest(
+  string_split(
+    replace(replace(replace(replace(skills, '[', ''), ']', ''), '''', ''), '"', ''),
+    ','
+  )
+) as t(skill)
+where skills is not null and skills <> '' and skills <> '[]' and trim(skill) <> ''
+"""
+PLOGS_SELECT = """
+select
+  cast(problem_id as bigint) as problem_id,
+  cast(correct as tinyint) as correct
+from {source}
+where correct in (0, 1)
+"""
+# Per-plogs-file sums; priors are the ratio of their totals.
+PARTIAL_SELECT = """
+select p.skill_name, sum(l.correct)::bigint as correct, count(*)::bigint as attempts
+from {plogs} l
+join (select distinct problem_id, skill_name from {pdets}) p using (problem_id)
+group by p.skill_name
+"""
+PRIORS_SELECT = """
+select skill_name, (sum(correct) / sum(attempts))::double as prior_mastery
+from {partials}
+group by skill_name
+having sum(attempts) > 0
+order by skill_name
+"""
+
+FileState = Dict[str, object]
+
+
+def _sql_str(value: str) -> str:
+    return "'" + value.replace("'", "''") + "'"
+
+
+def _csv_source(path: str) -> str:
+    return f"read_csv_auto({_sql_str(path)}, union_by_name=true)"
+
+
+def _parquet_source(pattern: str) -> str:
+    return f"read_parquet({_sql_str(pattern)})"
+
+
+def _file_id(path: str) -> str:
+    return hashlib.sha1(os.path.abspath(path).encode("utf-8")).hexdigest()[:16]
+
+
+def _fingerprint(path: str) -> Tuple[int, int]:
+    stat = os.stat(path)
+    return stat.st_size, stat.st_mtime_ns
+
+
+def load_manifest(parquet_dir: str) -> Dict[str, object]:
+    path = os.path.join(parquet_dir, MANIFEST_NAME)
+    if os.path.exists(path):
+        with open(path, "r", encoding="utf-8") as handle:
+            manifest = json.load(handle)
+        if manifest.get("version") == MANIFEST_VERSION:
+            return manifest
+    return {"version": MANIFEST_VERSION, "files": {}, "pdets_key": None}
+
+
+def save_manifest(parquet_dir: str, manifest: Dict[str, object]) -> None:
+    # Written last and atomically: an interrupted run just redoes its files.
+    path = os.path.join(parquet_dir, MANIFEST_NAME)
+    with open(path + ".tmp", "w", encoding="utf-8") as handle:
+        json.dump(manifest, handle, indent=2, sort_keys=True)
+    os.replace(path + ".tmp", path)
+
+
+def discover(pattern: str, kind: str) -> Dict[str, FileState]:
+    files: Dict[str, FileState] = {}
+    for path in sorted(glob.glob(pattern, recursive=True)):
+        size, mtime_ns = _fingerprint(path)
+        files[os.path.abspath(path)] = {
+            "kind": kind,
+            "id": _file_id(path),
+            "size": size,
+            "mtime_ns": mtime_ns,
+        }
+    return files
+
+
+def partition_dir(parquet_dir: str, kind: str, file_id: str) -> str:
+    return os.path.join(parquet_dir, kind, f"source={file_id}")
+
+
+def convert(con, parquet_dir: str, path: str, state: FileState) -> None:
+    # One Hive-style partition per source file, so a changed CSV only
+    # replaces its own Parquet.
+    kind = str(state["kind"])
+    target = partition_dir(parquet_dir, kind, str(state["id"]))
+    shutil.rmtree(target, ignore_errors=True)
+    os.makedirs(target)
+    select = (PDETS_SELECT if kind == "pdets" else PLOGS_SELECT).format(source=_csv_source(path))
+    con.execute(
+        f"copy ({select}) to {_sql_str(os.path.join(target, 'data.parquet'))} "
+        "(format parquet, compression zstd)"
+    )
+
+
+def aggregate_partial(con, parquet_dir: str, file_id: str) -> None:
+    target = partition_dir(parquet_dir, "partials", file_id)
+    shutil.rmtree(target, ignore_errors=True)
+    os.makedirs(target)
+    select = PARTIAL_SELECT.format(
+        plogs=_parquet_source(os.path.join(partition_dir(parquet_dir, "plogs", file_id), "*.parquet")),
+        pdets=_parquet_source(os.path.join(parquet_dir, "pdets", "*", "*.parquet")),
+    )
+    con.execute(f"copy ({select}) to {_sql_str(os.path.join(target, 'data.parquet'))} (format parquet)")
+
+
+def pdets_key(files: Dict[str, FileState]) -> str:
+    # Any change to the problem -> skill mapping invalidates every partial.
+    digest = hashlib.sha1()
+    for path, state in sorted(files.items()):
+        if state["kind"] == "pdets":
+            digest.update(f"{path}|{state['size']}|{state['mtime_ns']}\n".encode("utf-8"))
+    return digest.hexdigest()
+
+
+def write_priors(con, parquet_dir: str, out_csv: str) -> int:
+    select = PRIORS_SELECT.format(
+        partials=_parquet_source(os.path.join(parquet_dir, "partials", "*", "*.parquet"))
+    )
+    con.execute(f"copy ({select}) to {_sql_str(out_csv)} (header, delimiter ',')")
+    row = con.execute(f"select count(*) from ({select})").fetchone()
+    return int(row[0]) if row else 0
+
+
+def cold_csv_priors(con, pdets_glob: str, plogs_glob: str) -> Dict[str, float]:
+    # The pre-Parquet path: parse every CSV and aggregate in one pass.
+    pdets = f"({PDETS_SELECT.format(source=_csv_source(pdets_glob))})"
+    plogs = f"({PLOGS_SELECT.format(source=_csv_source(plogs_glob))})"
+    partials = f"({PARTIAL_SELECT.format(plogs=plogs, pdets=pdets)})"
+    return dict(con.execute(PRIORS_SELECT.format(partials=partials)).fetchall())
+
+
+def warm_parquet_priors(con, parquet_dir: str) -> Dict[str, float]:
+    # Everything recomputed, but from the typed Parquet instead of the CSVs.
+    pdets = _parquet_source(os.path.join(parquet_dir, "pdets", "*", "*.parquet"))
+    plogs = _parquet_source(os.path.join(parquet_dir, "plogs", "*", "*.parquet"))
+    partials = f"({PARTIAL_SELECT.format(plogs=plogs, pdets=pdets)})"
+    return dict(con.execute(PRIORS_SELECT.format(partials=partials)).fetchall())
+
+
+def compare(con, args: argparse.Namespace) -> None:
+    started = time.perf_counter()
+    cold = cold_csv_priors(con, args.pdets_glob, args.plogs_glob)
+    cold_seconds = time.perf_counter() - started
+    started = time.perf_counter()
+    warm = warm_parquet_priors(con, args.parquet_dir)
+    warm_seconds = time.perf_counter() - started
+    drift = max((abs(cold[skill] - warm.get(skill, -1.0)) for skill in cold), default=0.0)
+    print(f"cold CSV:     {cold_seconds:8.2f}s  ({len(cold)} skills)")
+    print(f"warm Parquet: {warm_seconds:8.2f}s  ({len(warm)} skills)")
+    print(f"speedup: {cold_seconds / max(warm_seconds, 1e-9):.1f}x, max prior difference {drift:.2e}")
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(
+        description=(
+            "Build per-skill prior mastery from the ASSISTments pdets/plogs CSVs. "
+            "CSVs are converted once to typed Parquet; later runs only process "
+            "new or changed files."
         )
-      ) as t(skill)
-      where skills is not null and skills <> '' and skills <> '[]'
-    ),
-    plogs as (
-      select
-        cast(problem_id as bigint) as problem_id,
-        correct
-      from read_csv_auto('{PL_GLOB}', union_by_name=true)
-      where correct in (0, 1)
-    )
-    select
-      skill_name,
-      avg(correct)::double as prior_mastery
-    from plogs
-    join pdets using (problem_id)
-    where skill_name is not null and skill_name <> ''
-    group by skill_name
-  ) to '{OUT_CSV}' (header, delimiter ',');
-  """
-
-  con.execute(query)
-  print("Wrote:", OUT_CSV)
\ No newline at end of file
+    )
+    parser.add_argument("--pdets-glob", default=os.getenv("ASSISTMENTS_PDETS_GLOB"))
+    parser.add_argument("--plogs-glob", default=os.getenv("ASSISTMENTS_PLOGS_GLOB"))
+    parser.add_argument(
+        "--parquet-dir",
+        default=os.getenv("ASSISTMENTS_PARQUET_DIR", "assistments_parquet"),
+        help="Converted Parquet, per-file aggregates and the manifest of processed files.",
+    )
+    parser.add_argument(
+        "--out-csv",
+        default=os.getenv("SKILL_PRIORS_CSV", "skill_priors.csv"),
+        help="skill_name,prior_mastery CSV for load_skill_priors.py.",
+    )
+    parser.add_argument(
+        "--force", action="store_true", help="Reconvert and re-aggregate every source file."
+    )
+    parser.add_argument(
+        "--compare",
+        action="store_true",
+        help="Also time a cold run straight from the CSVs against a full run from Parquet.",
+    )
+    parser.add_argument("--threads", type=int, default=0, help="DuckDB threads (0 = DuckDB default).")
+    args = parser.parse_args()
+
+    if not args.pdets_glob or not args.plogs_glob:
+        print("Set --pdets-glob and --plogs-glob (or ASSISTMENTS_*_GLOB).", file=sys.stderr)
+        return 1
+    try:
+        import duckdb
+    except ImportError:
+        print("duckdb is required: pip install duckdb", file=sys.stderr)
+        return 1
+
+    sources = {**discover(args.pdets_glob, "pdets"), **discover(args.plogs_glob, "plogs")}
+    if not any(state["kind"] == "pdets" for state in sources.values()):
+        print(f"No files match {args.pdets_glob}", file=sys.stderr)
+        return 1
+    if not any(state["kind"] == "plogs" for state in sources.values()):
+        print(f"No files match {args.plogs_glob}", file=sys.stderr)
+        return 1
+
+    os.makedirs(args.parquet_dir, exist_ok=True)
+    manifest = {"version": MANIFEST_VERSION, "files": {}, "pdets_key": None}
+    if not args.force:
+        manifest = load_manifest(args.parquet_dir)
+    processed: Dict[str, FileState] = dict(manifest["files"])
+
+    changed = [
+        path
+        for path, state in sources.items()
+        if processed.get(path) != state
+        or not os.path.isdir(partition_dir(args.parquet_dir, str(state["kind"]), str(state["id"])))
+    ]
+    removed = [path for path in processed if path not in sources]
+
+    con = duckdb.connect()
+    if args.threads:
+        con.execute(f"set threads = {int(args.threads)}")
+    started = time.perf_counter()
+    try:
+        for path in removed:
+            state = processed[path]
+            for kind in (str(state["kind"]), "partials"):
+                shutil.rmtree(partition_dir(args.parquet_dir, kind, str(state["id"])), ignore_errors=True)
+        for path in changed:
+            file_started = time.perf_counter()
+            convert(con, args.parquet_dir, path, sources[path])
+            print(f"converted {path} in {time.perf_counter() - file_started:.2f}s")
+        converted = time.perf_counter() - started
+
+        key = pdets_key(sources)
+        plogs_files = {path: state for path, state in sources.items() if state["kind"] == "plogs"}
+        if key != manifest.get("pdets_key"):
+            stale: List[str] = list(plogs_files)
+        else:
+            stale = [
+                path
+                for path, state in plogs_files.items()
+                if path in changed
+                or not os.path.isdir(partition_dir(args.parquet_dir, "partials", str(state["id"])))
+            ]
+        for path in stale:
+            aggregate_partial(con, args.parquet_dir, str(plogs_files[path]["id"]))
+        aggregated = time.perf_counter() - started - converted
+
+        skills: Optional[int] = None
+        if changed or removed or stale or not os.path.exists(args.out_csv):
+            skills = write_priors(con, args.parquet_dir, args.out_csv)
+        written = time.perf_counter() - started - converted - aggregated
+
+        manifest = {"version": MANIFEST_VERSION, "files": sources, "pdets_key": key}
+        save_manifest(args.parquet_dir, manifest)
+
+        print(
+            f"convert: {len(changed)} of {len(sources)} files in {converted:.2f}s "
+            f"({len(removed)} removed)"
+        )
+        print(f"aggregate: {len(stale)} of {len(plogs_files)} plogs files in {aggregated:.2f}s")
+        if skills is None:
+            print(f"{args.out_csv} is up to date.")
+        else:
+            print(f"wrote {skills} skill priors to {args.out_csv} in {written:.2f}s")
+
+        if args.compare:
+            compare(con, args)
+    except (duckdb.Error, OSError) as exc:
+        print(f"Build failed: {exc}", file=sys.stderr)
+        return 1
+    finally:
+        con.close()
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
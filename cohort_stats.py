@@ -0,0 +1,365 @@
+import asyncio
+import logging
+import os
+from typing import Any, Dict, List, Optional, Sequence, Set, Tuple
+
+import psycopg
+
+from db import DbOp, Query, async_pooled_connection, run_op_async, table_mapping_op
+
+logger = logging.getLogger("aits")
+
+COHORT_STATS_ENABLED = os.getenv("COHORT_STATS_ENABLED", "1").lower() not in ("0", "false", "no")
+COHORT_FLUSH_SECONDS = float(os.getenv("COHORT_FLUSH_SECONDS", "2.0"))
+# Fixed by migration 6, which builds the initial histograms.
+COHORT_BUCKETS = 20
+# Every student, whatever their class.
+ALL_STUDENTS = "*"
+
+PairKey = Tuple[str, str]
+CohortKey = Tuple[str, str]
+
+
+def mastery_bucket(mastery: float) -> int:
+    return min(max(int(mastery * COHORT_BUCKETS), 0), COHORT_BUCKETS - 1)
+
+
+def histogram_percentile(histogram: Sequence[int], mastery: float) -> Optional[float]:
+    # Mid-rank: everyone in lower buckets plus half of the student's own
+    # bucket, which keeps ties (e.g. many snapped to 1.0) in the middle.
+    total = sum(histogram)
+    if total <= 0:
+        return None
+    bucket = mastery_bucket(mastery)
+    return 100.0 * (sum(histogram[:bucket]) + 0.5 * histogram[bucket]) / total
+
+
+class CohortDelta:
+    __slots__ = ("attempts", "correct", "students", "mastery_sum", "histogram")
+
+    def __init__(self) -> None:
+        self.attempts = 0
+        self.correct = 0
+        self.students = 0
+        self.mastery_sum = 0.0
+        self.histogram = [0] * COHORT_BUCKETS
+
+    def remove(self, mastery: float) -> None:
+        self.students -= 1
+        self.mastery_sum -= mastery
+        self.histogram[mastery_bucket(mastery)] -= 1
+
+    def add(self, mastery: float) -> None:
+        self.students += 1
+        self.mastery_sum += mastery
+        self.histogram[mastery_bucket(mastery)] += 1
+
+
+def cohorts_of(class_id: Optional[str]) -> Tuple[str, ...]:
+    return (ALL_STUDENTS,) if not class_id else (ALL_STUDENTS, class_id)
+
+
+def flush_cohorts_op(answers: Dict[PairKey, List[int]], moved: Set[str]) -> DbOp[int]:
+    # Each bkt_state row remembers the class and mastery it is counted under,
+    # so a flush moves exactly those contributions to the current values.
+    mapping = yield from table_mapping_op("bkt_state")
+    mastery_col = mapping.pick(("prior_skill_mastery", "prior_mastery", "mastery"))
+    if not mastery_col or "cohort_mastery" not in mapping.columns:
+        return 0
+    pairs = sorted(answers)
+    rows = yield Query(
+        f"""
+        select b.student_id, b.skill_name, b.{mastery_col} as mastery,
+               b.cohort_class_id, b.cohort_mastery, s.class_id
+        from public.bkt_state b
+        join (
+            select * from unnest(%(students)s::text[], %(skills)s::text[]) as p(student_id, skill_name)
+            union
+            select m.student_id, m.skill_name from public.bkt_state m
+            where m.student_id = any(%(moved)s::text[])
+        ) k on k.student_id = b.student_id and k.skill_name = b.skill_name
+        left join public.students s on s.student_id = b.student_id
+        order by b.student_id, b.skill_name
+        for update of b
+        """,
+        {
+            "students": [pair[0] for pair in pairs],
+            "skills": [pair[1] for pair in pairs],
+            "moved": sorted(moved),
+        },
+        "all",
+        prepare=True,
+    )
+    deltas: Dict[CohortKey, CohortDelta] = {}
+    accounted = []
+    for row in rows:
+        skill_name = row["skill_name"]
+        mastery = float(row["mastery"] or 0.0)
+        if row["cohort_mastery"] is not None:
+            for cohort in cohorts_of(row["cohort_class_id"]):
+                deltas.setdefault((cohort, skill_name), CohortDelta()).remove(
+                    float(row["cohort_mastery"])
+                )
+        for cohort in cohorts_of(row["class_id"]):
+            delta = deltas.setdefault((cohort, skill_name), CohortDelta())
+            delta.add(mastery)
+            counts = answers.get((row["student_id"], skill_name))
+            if counts:
+                delta.attempts += counts[0]
+                delta.correct += counts[1]
+        accounted.append((row["student_id"], skill_name, row["class_id"], mastery))
+    if not deltas:
+        return 0
+
+    keys = sorted(deltas)
+    yield Query(
+        """
+        insert into public.cohort_skill_stats as c (
+            class_id, skill_name, attempts, correct, students, mastery_sum, histogram, updated_at
+        )
+        select v.class_id, v.skill_name, v.attempts, v.correct, v.students, v.mastery_sum,
+               v.histogram::int[], now()
+        from unnest(
+            %s::text[], %s::text[], %s::bigint[], %s::bigint[], %s::int[], %s::float8[], %s::text[]
+        ) as v(class_id, skill_name, attempts, correct, students, mastery_sum, histogram)
+        on conflict (class_id, skill_name) do update set
+            attempts = c.attempts + excluded.attempts,
+            correct = c.correct + excluded.correct,
+            students = c.students + excluded.students,
+            mastery_sum = c.mastery_sum + excluded.mastery_sum,
+            histogram = (
+                select array_agg(a + b order by i)
+                from unnest(c.histogram, excluded.histogram) with ordinality as h(a, b, i)
+            ),
+            updated_at = excluded.updated_at
+        """,
+        (
+            [key[0] for key in keys],
+            [key[1] for key in keys],
+            [deltas[key].attempts for key in keys],
+            [deltas[key].correct for key in keys],
+            [deltas[key].students for key in keys],
+            [deltas[key].mastery_sum for key in keys],
+            ["{" + ",".join(map(str, deltas[key].histogram)) + "}" for key in keys],
+        ),
+        prepare=True,
+    )
+    yield Query(
+        """
+        update public.bkt_state b
+        set cohort_class_id = v.class_id, cohort_mastery = v.mastery
+        from unnest(%s::text[], %s::text[], %s::text[], %s::float8[])
+            as v(student_id, skill_name, class_id, mastery)
+        where b.student_id = v.student_id and b.skill_name = v.skill_name
+        """,
+        (
+            [row[0] for row in accounted],
+            [row[1] for row in accounted],
+            [row[2] for row in accounted],
+            [row[3] for row in accounted],
+        ),
+        prepare=True,
+    )
+    return len(keys)
+
+
+def rebuild_cohort_stats_op() -> DbOp[int]:
+    # Recomputes every cohort from bkt_state and attempts, for bulk rewrites
+    # of bkt_state (rebuild_bkt_state.py) that bypass the incremental path.
+    mapping = yield from table_mapping_op("bkt_state")
+    mastery_col = mapping.pick(("prior_skill_mastery", "prior_mastery", "mastery"))
+    if not mastery_col or "cohort_mastery" not in mapping.columns:
+        return 0
+    attempts = yield from table_mapping_op("attempts")
+    correct_sql = "0::bigint"
+    if "correct" in attempts.columns:
+        correct_sql = "count(*) filter (where a.correct::text in ('true', '1'))"
+    yield Query(
+        f"""
+        update public.bkt_state b
+        set cohort_class_id = (select s.class_id from public.students s where s.student_id = b.student_id),
+            cohort_mastery = coalesce(b.{mastery_col}, 0)
+        """
+    )
+    yield Query("delete from public.cohort_skill_stats")
+    return (
+        yield Query(
+            f"""
+            with m as (
+                select c.class_id, b.skill_name, b.cohort_mastery as mastery,
+                       least(greatest(floor(b.cohort_mastery * %(buckets)s)::int, 0), %(buckets)s - 1) as bucket
+                from public.bkt_state b
+                cross join lateral (values (%(all)s), (b.cohort_class_id)) as c(class_id)
+                where c.class_id is not null
+            ),
+            counts as (
+                select class_id, skill_name, bucket, count(*)::int as n
+                from m group by class_id, skill_name, bucket
+            ),
+            totals as (
+                select class_id, skill_name, count(*)::int as students, sum(mastery) as mastery_sum
+                from m group by class_id, skill_name
+            ),
+            answered as (
+                select c.class_id, a.skill_name,
+                       count(*) as attempts, {correct_sql} as correct
+                from public.attempts a
+                left join public.students s on s.student_id = a.student_id
+                cross join lateral (values (%(all)s), (s.class_id)) as c(class_id)
+                where c.class_id is not null
+                group by c.class_id, a.skill_name
+            )
+            insert into public.cohort_skill_stats (
+                class_id, skill_name, attempts, correct, students, mastery_sum, histogram
+            )
+            select coalesce(t.class_id, a.class_id),
+                   coalesce(t.skill_name, a.skill_name),
+                   coalesce(a.attempts, 0),
+                   coalesce(a.correct, 0),
+                   coalesce(t.students, 0),
+                   coalesce(t.mastery_sum, 0),
+                   array(
+                       select coalesce(n.n, 0)
+                       from generate_series(0, %(buckets)s - 1) as g(i)
+                       left join counts n
+                         on n.class_id = t.class_id and n.skill_name = t.skill_name and n.bucket = g.i
+                       order by g.i
+                   )
+            from totals t
+            full join answered a on a.class_id = t.class_id and a.skill_name = t.skill_name
+            """,
+            {"buckets": COHORT_BUCKETS, "all": ALL_STUDENTS},
+            "rowcount",
+        )
+    )
+
+
+class CohortAggregator:
+    # Answers only touch an in-process dict; a background task folds them into
+    # cohort_skill_stats every flush_seconds in a single transaction.
+    def __init__(self, flush_seconds: float = COHORT_FLUSH_SECONDS) -> None:
+        self.flush_seconds = max(0.05, flush_seconds)
+        self._answers: Dict[PairKey, List[int]] = {}
+        self._moved: Set[str] = set()
+        self._runner: Optional[asyncio.Task] = None
+        self._flush_lock = asyncio.Lock()
+        self.flushes = 0
+        self.failures = 0
+        self.cohorts_updated = 0
+        self.last_error: Optional[str] = None
+
+    def record(self, student_id: str, skill_name: str, correct: bool) -> None:
+        counts = self._answers.setdefault((student_id, skill_name), [0, 0])
+        counts[0] += 1
+        counts[1] += int(correct)
+
+    def student_moved(self, student_id: str) -> None:
+        self._moved.add(student_id)
+
+    def pending(self) -> int:
+        return len(self._answers) + len(self._moved)
+
+    def start(self) -> None:
+        if self._runner is None:
+            self._runner = asyncio.create_task(self._run(), name="cohort-stats")
+
+    async def stop(self) -> None:
+        if self._runner is not None:
+            runner, self._runner = self._runner, None
+            runner.cancel()
+            await asyncio.gather(runner, return_exceptions=True)
+        await self.flush()
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.flush_seconds)
+            await self.flush()
+
+    async def flush(self) -> bool:
+        async with self._flush_lock:
+            if not self._answers and not self._moved:
+                return True
+            answers, self._answers = self._answers, {}
+            moved, self._moved = self._moved, set()
+            try:
+                async with async_pooled_connection() as conn:
+                    updated = await run_op_async(conn, flush_cohorts_op(answers, moved))
+            except (psycopg.Error, RuntimeError) as exc:
+                # Counts are additive, so the batch simply rides along with the next one.
+                for key, counts in answers.items():
+                    merged = self._answers.setdefault(key, [0, 0])
+                    merged[0] += counts[0]
+                    merged[1] += counts[1]
+                self._moved |= moved
+                self.failures += 1
+                self.last_error = str(exc)
+                logger.warning("cohort_stats.flush_failed", extra={"error": str(exc)})
+                return False
+            self.flushes += 1
+            self.cohorts_updated += updated
+            return True
+
+    def metrics(self) -> Dict[str, Any]:
+        return {
+            "pending": self.pending(),
+            "flush_seconds": self.flush_seconds,
+            "flushes": self.flushes,
+            "cohorts_updated": self.cohorts_updated,
+            "failures": self.failures,
+            "last_error": self.last_error,
+        }
+
+
+_AGGREGATOR: Optional[CohortAggregator] = None
+
+
+def start_cohort_stats() -> None:
+    global _AGGREGATOR
+    if COHORT_STATS_ENABLED and _AGGREGATOR is None:
+        _AGGREGATOR = CohortAggregator()
+        _AGGREGATOR.start()
+
+
+async def stop_cohort_stats() -> None:
+    global _AGGREGATOR
+    if _AGGREGATOR is not None:
+        aggregator, _AGGREGATOR = _AGGREGATOR, None
+        await aggregator.stop()
+
+
+def record_cohort_answer(student_id: str, skill_name: str, correct: bool) -> None:
+    if _AGGREGATOR is not None:
+        _AGGREGATOR.record(student_id, skill_name, correct)
+
+
+def record_class_change(student_id: str) -> None:
+    if _AGGREGATOR is not None:
+        _AGGREGATOR.student_moved(student_id)
+
+
+async def flush_cohort_stats() -> bool:
+    if _AGGREGATOR is None:
+        return True
+    return await _AGGREGATOR.flush()
+
+
+def cohort_stats_metrics() -> Dict[str, Any]:
+    if _AGGREGATOR is None:
+        return {"enabled": False}
+    return {"enabled": True, **_AGGREGATOR.metrics()}
+
+
+def cohort_rows_op(class_id: str, skill_name: Optional[str] = None) -> DbOp[List[Dict[str, Any]]]:
+    rows = yield Query(
+        """
+        select skill_name, attempts, correct, students, mastery_sum, histogram
+        from public.cohort_skill_stats
+        where class_id = %(class_id)s
+          and (%(skill_name)s::text is null or skill_name = %(skill_name)s)
+        order by skill_name
+        """,
+        {"class_id": class_id, "skill_name": skill_name},
+        "all",
+        prepare=True,
+    )
+    return rows
@@ -1,15 +1,74 @@
 ﻿import os
+from contextlib import asynccontextmanager
 from datetime import datetime, timezone
-from typing import Any, Dict, Iterable, Optional, Set
+from functools import lru_cache
+from typing import (
+    Any,
+    AsyncIterator,
+    Dict,
+    FrozenSet,
+    Generator,
+    Iterable,
+    List,
+    NamedTuple,
+    Optional,
+    Set,
+    Tuple,
+    TypeVar,
+)
 
 import psycopg
 from psycopg.rows import dict_row
+from psycopg_pool import AsyncConnectionPool
 
 from dotenv import load_dotenv
 
 load_dotenv()
 
-_TABLE_COLUMNS_CACHE: Dict[str, Set[str]] = {}
+
+DB_POOL_ENABLED = os.getenv("DB_POOL_ENABLED", "1").lower() not in ("0", "false", "no")
+DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", "1"))
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "10"))
+DB_POOL_MAX_WAITING = int(os.getenv("DB_POOL_MAX_WAITING", "0"))
+DB_POOL_MAX_LIFETIME = float(os.getenv("DB_POOL_MAX_LIFETIME", "1800"))
+DB_POOL_MAX_IDLE = float(os.getenv("DB_POOL_MAX_IDLE", "300"))
+# Server-side prepared statements; turn off behind a transaction-mode pooler
+# that cannot keep them (e.g. PgBouncer without max_prepared_statements).
+DB_PREPARE_STATEMENTS = os.getenv("DB_PREPARE_STATEMENTS", "1").lower() not in ("0", "false", "no")
+
+_ASYNC_POOL: Optional[AsyncConnectionPool] = None
+
+T = TypeVar("T")
+
+
+class Query(NamedTuple):
+    sql: str
+    params: Any = None
+    fetch: Optional[str] = None  # "one", "all", "rowcount" or None
+    # True prepares on first use; None leaves it to psycopg's prepare_threshold.
+    prepare: Optional[bool] = None
+
+
+class TableMapping(NamedTuple):
+    name: str
+    columns: FrozenSet[str]
+
+    def pick(self, candidates: Iterable[str]) -> Optional[str]:
+        return pick_column(self.columns, candidates)
+
+    def filter(self, payload: Dict[str, Any]) -> Dict[str, Any]:
+        return {key: value for key, value in payload.items() if key in self.columns}
+
+
+_TABLE_MAPPINGS: Dict[str, TableMapping] = {}
+_SCHEMA_GENERATION = 0
+
+
+# A DB operation is a generator that yields Query objects and is sent back
+# each query's result. Writing request-path logic this way lets the same code
+# run on a sync connection (scripts) or an async one (API handlers).
+DbOp = Generator[Query, Any, T]
 
 
 def normalize_db_url(db_url: str) -> str:
@@ -36,35 +95,222 @@ def get_connection() -> Optional[psycopg.Connection]:
     return psycopg.connect(db_url, row_factory=dict_row)
 
 
-def get_table_columns(conn: psycopg.Connection, table_name: str) -> Set[str]:
-    if table_name in _TABLE_COLUMNS_CACHE:
-        return _TABLE_COLUMNS_CACHE[table_name]
-    with conn.cursor() as cur:
-        cur.execute(
+def _pool_kwargs() -> Dict[str, Any]:
+    # Waiters are served in arrival order; `timeout` bounds how long a
+    # request queues for a connection before failing with PoolTimeout.
+    connection_kwargs: Dict[str, Any] = {"row_factory": dict_row}
+    if not DB_PREPARE_STATEMENTS:
+        connection_kwargs["prepare_threshold"] = None
+    return {
+        "kwargs": connection_kwargs,
+        "min_size": DB_POOL_MIN_SIZE,
+        "max_size": max(DB_POOL_MIN_SIZE, DB_POOL_MAX_SIZE),
+        "timeout": DB_POOL_TIMEOUT,
+        "max_waiting": DB_POOL_MAX_WAITING,
+        "max_lifetime": DB_POOL_MAX_LIFETIME,
+        "max_idle": DB_POOL_MAX_IDLE,
+        "name": "aits",
+    }
+
+
+async def open_async_pool() -> Optional[AsyncConnectionPool]:
+    global _ASYNC_POOL
+    if not DB_POOL_ENABLED or _ASYNC_POOL is not None:
+        return _ASYNC_POOL
+    db_url = get_db_url()
+    if not db_url:
+        return None
+    pool = AsyncConnectionPool(
+        db_url, check=AsyncConnectionPool.check_connection, open=False, **_pool_kwargs()
+    )
+    await pool.open()
+    _ASYNC_POOL = pool
+    return _ASYNC_POOL
+
+
+async def close_async_pool() -> None:
+    global _ASYNC_POOL
+    if _ASYNC_POOL is not None:
+        pool, _ASYNC_POOL = _ASYNC_POOL, None
+        await pool.close()
+
+
+@asynccontextmanager
+async def async_pooled_connection() -> AsyncIterator[psycopg.AsyncConnection]:
+    if _ASYNC_POOL is not None:
+        async with _ASYNC_POOL.connection() as conn:
+            yield conn
+        return
+    db_url = get_db_url()
+    if not db_url:
+        raise RuntimeError("SUPABASE_DB_URL not set")
+    conn = await psycopg.AsyncConnection.connect(db_url, row_factory=dict_row)
+    async with conn:
+        yield conn
+
+
+def _query_result(cur: Any, query: Query) -> Any:
+    if query.fetch == "one":
+        return cur.fetchone()
+    if query.fetch == "all":
+        return cur.fetchall()
+    if query.fetch == "rowcount":
+        return cur.rowcount
+    return None
+
+
+def _prepare(query: Query) -> Optional[bool]:
+    return query.prepare if DB_PREPARE_STATEMENTS else False
+
+
+def run_op(conn: psycopg.Connection, op: DbOp[T]) -> T:
+    result: Any = None
+    try:
+        while True:
+            query = op.send(result)
+            with conn.cursor() as cur:
+                cur.execute(query.sql, query.params, prepare=_prepare(query))
+                result = _query_result(cur, query)
+    except StopIteration as stop:
+        return stop.value
+
+
+async def run_op_async(conn: psycopg.AsyncConnection, op: DbOp[T]) -> T:
+    result: Any = None
+    try:
+        while True:
+            query = op.send(result)
+            async with conn.cursor() as cur:
+                await cur.execute(query.sql, query.params, prepare=_prepare(query))
+                if query.fetch == "one":
+                    result = await cur.fetchone()
+                elif query.fetch == "all":
+                    result = await cur.fetchall()
+                else:
+                    result = _query_result(cur, query)
+    except StopIteration as stop:
+        return stop.value
+
+
+def resolve_schema_op(table_names: Iterable[str]) -> DbOp[Dict[str, TableMapping]]:
+    # One catalog read for every table not resolved yet; the mappings stay
+    # until invalidate_schema() (after migrations or an observed ALTER).
+    missing = [name for name in dict.fromkeys(table_names) if name not in _TABLE_MAPPINGS]
+    if missing:
+        rows = yield Query(
             """
-            select column_name
+            select table_name, column_name
             from information_schema.columns
-            where table_schema = 'public' and table_name = %s
+            where table_schema = 'public' and table_name = any(%s)
             """,
-            (table_name,),
+            (missing,),
+            "all",
         )
-        cols = {row["column_name"] for row in cur.fetchall()}
-    _TABLE_COLUMNS_CACHE[table_name] = cols
-    return cols
+        found: Dict[str, Set[str]] = {name: set() for name in missing}
+        for row in rows:
+            found[row["table_name"]].add(row["column_name"])
+        for name, columns in found.items():
+            _TABLE_MAPPINGS[name] = TableMapping(name, frozenset(columns))
+    return dict(_TABLE_MAPPINGS)
+
+
+def resolve_schema(conn: psycopg.Connection, table_names: Iterable[str]) -> Dict[str, TableMapping]:
+    return run_op(conn, resolve_schema_op(table_names))
 
 
-def pick_column(columns: Set[str], candidates: Iterable[str]) -> Optional[str]:
+def table_mapping_op(table_name: str) -> DbOp[TableMapping]:
+    mapping = _TABLE_MAPPINGS.get(table_name)
+    if mapping is None:
+        yield from resolve_schema_op((table_name,))
+        mapping = _TABLE_MAPPINGS[table_name]
+    return mapping
+
+
+def table_columns_op(table_name: str) -> DbOp[FrozenSet[str]]:
+    mapping = yield from table_mapping_op(table_name)
+    return mapping.columns
+
+
+def get_table_columns(conn: psycopg.Connection, table_name: str) -> FrozenSet[str]:
+    return run_op(conn, table_columns_op(table_name))
+
+
+def invalidate_schema(table_name: Optional[str] = None) -> None:
+    global _SCHEMA_GENERATION
+    if table_name is None:
+        _TABLE_MAPPINGS.clear()
+    else:
+        _TABLE_MAPPINGS.pop(table_name, None)
+    _SCHEMA_GENERATION += 1
+
+
+def schema_generation() -> int:
+    # Bumped on every invalidation, for caches derived from more than a mapping.
+    return _SCHEMA_GENERATION
+
+
+# Statement text depends only on its arguments, so each (table, column set)
+# is compiled once and the identical string lets the server reuse the plan.
+@lru_cache(maxsize=512)
+def insert_sql(table: str, columns: Tuple[str, ...], ignore_conflicts: bool = False) -> str:
+    placeholders = ", ".join(["%s"] * len(columns))
+    sql = f"insert into public.{table} ({', '.join(columns)}) values ({placeholders})"
+    if ignore_conflicts:
+        sql += " on conflict do nothing"
+    return sql
+
+
+@lru_cache(maxsize=512)
+def update_sql(table: str, set_columns: Tuple[str, ...], where_columns: Tuple[str, ...]) -> str:
+    assignments = ", ".join(f"{col} = %s" for col in set_columns)
+    where_clause = " and ".join(f"{col} = %s" for col in where_columns)
+    return f"update public.{table} set {assignments} where {where_clause}"
+
+
+@lru_cache(maxsize=512)
+def unnest_insert_sql(
+    table: str, typed_columns: Tuple[Tuple[str, str], ...], ignore_conflicts: bool = False
+) -> str:
+    columns = ", ".join(col for col, _ in typed_columns)
+    casts = ", ".join(f"%s::{sql_type}[]" for _, sql_type in typed_columns)
+    sql = f"insert into public.{table} ({columns}) select * from unnest({casts})"
+    if ignore_conflicts:
+        sql += " on conflict do nothing"
+    return sql
+
+
+@lru_cache(maxsize=512)
+def unnest_update_sql(
+    table: str, typed_columns: Tuple[Tuple[str, str], ...], where_columns: Tuple[str, ...]
+) -> str:
+    columns = ", ".join(col for col, _ in typed_columns)
+    casts = ", ".join(f"%s::{sql_type}[]" for _, sql_type in typed_columns)
+    assignments = ", ".join(
+        f"{col} = v.{col}" for col, _ in typed_columns if col not in where_columns
+    )
+    matches = " and ".join(f"t.{col} = v.{col}" for col in where_columns)
+    return (
+        f"update public.{table} t set {assignments} "
+        f"from unnest({casts}) as v({columns}) where {matches}"
+    )
+
+
+def pick_column(columns: FrozenSet[str], candidates: Iterable[str]) -> Optional[str]:
     for candidate in candidates:
         if candidate in columns:
             return candidate
     return None
 
 
+def filter_payload_op(table_name: str, payload: Dict[str, Any]) -> DbOp[Dict[str, Any]]:
+    mapping = yield from table_mapping_op(table_name)
+    return mapping.filter(payload)
+
+
 def filter_payload_for_table(
     conn: psycopg.Connection, table_name: str, payload: Dict[str, Any]
 ) -> Dict[str, Any]:
-    columns = get_table_columns(conn, table_name)
-    return {key: value for key, value in payload.items() if key in columns}
+    return run_op(conn, filter_payload_op(table_name, payload))
 
 
 def fetch_skill_prior(
@@ -84,21 +330,80 @@ def fetch_skill_prior(
             return float(row[prior_col])
     return default
 
-def ensure_student(conn: psycopg.Connection, student_id: str) -> None:
-    columns = get_table_columns(conn, "students")
+def fetch_skill_priors(conn: psycopg.Connection) -> Dict[str, float]:
+    columns = get_table_columns(conn, "skills")
+    prior_col = pick_column(columns, ("prior_mastery", "prior_skill_mastery", "prior"))
+    if not prior_col:
+        return {}
+    with conn.cursor() as cur:
+        cur.execute(f"select skill_name, {prior_col} from public.skills")
+        rows = cur.fetchall()
+    return {
+        row["skill_name"]: float(row[prior_col])
+        for row in rows
+        if row.get(prior_col) is not None
+    }
+
+
+def fetch_skill_bkt_params(conn: psycopg.Connection) -> Dict[str, Dict[str, float]]:
+    columns = get_table_columns(conn, "skills")
+    param_cols = {
+        name: col
+        for name, col in (("guess", "bkt_guess"), ("slip", "bkt_slip"), ("transit", "bkt_transit"))
+        if col in columns
+    }
+    if not param_cols:
+        return {}
+    select_sql = ", ".join(param_cols.values())
+    with conn.cursor() as cur:
+        cur.execute(f"select skill_name, {select_sql} from public.skills")
+        rows = cur.fetchall()
+    table: Dict[str, Dict[str, float]] = {}
+    for row in rows:
+        values = {
+            name: float(row[col]) for name, col in param_cols.items() if row.get(col) is not None
+        }
+        if values:
+            table[row["skill_name"]] = values
+    return table
+
+
+def ensure_student_op(student_id: str) -> DbOp[bool]:
+    columns = yield from table_columns_op("students")
     if "student_id" not in columns:
-        return
-    insert_cols = ["student_id"]
-    values = [student_id]
+        return False
+    insert_cols: Tuple[str, ...] = ("student_id",)
+    values: List[Any] = [student_id]
     if "created_at" in columns:
-        insert_cols.append("created_at")
+        insert_cols += ("created_at",)
         values.append(datetime.now(timezone.utc))
-    columns_sql = ", ".join(insert_cols)
-    placeholders = ", ".join(["%s"] * len(values))
-    query = (
-        f"insert into public.students ({columns_sql}) values ({placeholders}) "
-        "on conflict (student_id) do nothing"
+    inserted = yield Query(
+        insert_sql("students", insert_cols, ignore_conflicts=True), values, "rowcount", prepare=True
     )
-    with conn.cursor() as cur:
-        cur.execute(query, values)
+    return inserted == 1
+
 
+def ensure_student(conn: psycopg.Connection, student_id: str) -> bool:
+    return run_op(conn, ensure_student_op(student_id))
+
+
+def ensure_students_op(student_ids: Iterable[str]) -> DbOp[Set[str]]:
+    # Bulk ensure_student_op; returns the ids that were newly created.
+    ids = list(dict.fromkeys(student_ids))
+    columns = yield from table_columns_op("students")
+    if "student_id" not in columns or not ids:
+        return set()
+    if "created_at" in columns:
+        query = (
+            "insert into public.students (student_id, created_at) "
+            "select unnest(%s::text[]), %s on conflict (student_id) do nothing returning student_id"
+        )
+        params: Any = (ids, datetime.now(timezone.utc))
+    else:
+        query = (
+            "insert into public.students (student_id) "
+            "select unnest(%s::text[]) on conflict (student_id) do nothing returning student_id"
+        )
+        params = (ids,)
+    rows = yield Query(query, params, "all", prepare=True)
+    return {row["student_id"] for row in rows}
@@ -0,0 +1,268 @@
+import argparse
+import csv
+import os
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
+from typing import Dict, Iterator, List, Optional, Set, Tuple
+
+import numpy as np
+
+from bkt import BKT_PARAM_NAMES, replay_mastery_batch
+from db import get_connection
+from migrations import apply_migrations
+
+SkillSequences = Tuple[str, List[List[int]]]
+
+GRID_CELL_BUDGET = 4_000_000
+PRIOR_BOUNDS = (0.01, 0.99)
+PROB_EPSILON = 1e-6
+
+
+def _frange(start: float, stop: float, step: float) -> np.ndarray:
+    return np.round(np.arange(start, stop + step / 2, step), 4)
+
+
+def build_grid(step: float) -> np.ndarray:
+    guess = _frange(0.05, 0.40, step)
+    slip = _frange(0.05, 0.40, step)
+    transit = _frange(0.02, 0.50, step)
+    mesh = np.meshgrid(guess, slip, transit, indexing="ij")
+    return np.stack([axis.reshape(-1) for axis in mesh], axis=1)
+
+
+def _pad_sequences(sequences: List[List[int]], max_steps: int) -> np.ndarray:
+    steps = min(max(len(seq) for seq in sequences), max_steps)
+    obs = np.full((len(sequences), steps), -1, dtype=np.int8)
+    for row, seq in enumerate(sequences):
+        trimmed = seq[:steps]
+        obs[row, : len(trimmed)] = trimmed
+    return obs
+
+
+def _log_likelihood(prior: float, obs: np.ndarray, grid: np.ndarray) -> np.ndarray:
+    # Scores every grid row against every sequence in one replay by tiling
+    # the observation matrix once per (guess, slip, transit) combination.
+    students, steps = obs.shape
+    combos = grid.shape[0]
+    tiled = np.tile(obs, (combos, 1))
+    guess = np.repeat(grid[:, 0], students)
+    slip = np.repeat(grid[:, 1], students)
+    transit = np.repeat(grid[:, 2], students)
+    trajectory = replay_mastery_batch(
+        prior, tiled, guess, slip, transit, return_trajectory=True
+    )
+    before = np.empty_like(trajectory)
+    before[:, 0] = prior
+    before[:, 1:] = trajectory[:, :-1]
+    p_correct = before * (1.0 - slip[:, None]) + (1.0 - before) * guess[:, None]
+    p_correct = np.clip(p_correct, PROB_EPSILON, 1.0 - PROB_EPSILON)
+    log_p = np.where(tiled > 0, np.log(p_correct), np.log(1.0 - p_correct))
+    log_p = np.where(tiled >= 0, log_p, 0.0)
+    return log_p.sum(axis=1).reshape(combos, students).sum(axis=1)
+
+
+def fit_skill(
+    skill_name: str, sequences: List[List[int]], grid_step: float, max_steps: int
+) -> Dict[str, object]:
+    obs = _pad_sequences(sequences, max_steps)
+    first = obs[:, 0]
+    prior = float(np.clip(first[first >= 0].mean(), *PRIOR_BOUNDS))
+    grid = build_grid(grid_step)
+
+    students, steps = obs.shape
+    chunk = max(1, GRID_CELL_BUDGET // max(1, grid.shape[0] * steps))
+    totals = np.zeros(grid.shape[0], dtype=np.float64)
+    for start in range(0, students, chunk):
+        totals += _log_likelihood(prior, obs[start : start + chunk], grid)
+
+    best = int(np.argmax(totals))
+    result: Dict[str, object] = {
+        "skill_name": skill_name,
+        "prior": prior,
+        "students": students,
+        "observations": int((obs >= 0).sum()),
+        "log_likelihood": float(totals[best]),
+    }
+    for idx, name in enumerate(BKT_PARAM_NAMES):
+        result[name] = float(grid[best, idx])
+    return result
+
+
+def _group_rows(rows: Iterator[Tuple[str, str, int]], min_students: int) -> Iterator[SkillSequences]:
+    current_skill: Optional[str] = None
+    current_student: Optional[str] = None
+    sequences: List[List[int]] = []
+    for skill_name, student_id, correct in rows:
+        if skill_name != current_skill:
+            if current_skill is not None and len(sequences) >= min_students:
+                yield current_skill, sequences
+            current_skill = skill_name
+            current_student = None
+            sequences = []
+        if student_id != current_student:
+            sequences.append([])
+            current_student = student_id
+        sequences[-1].append(1 if correct else 0)
+    if current_skill is not None and len(sequences) >= min_students:
+        yield current_skill, sequences
+
+
+def iter_attempt_rows_db(conn, batch_size: int) -> Iterator[Tuple[str, str, int]]:
+    with conn.cursor(name="bkt_fit_attempts") as cur:
+        cur.itersize = batch_size
+        cur.execute(
+            """
+            select skill_name, student_id, correct
+            from public.attempts
+            where skill_name is not null and correct is not null
+            order by skill_name, student_id, created_at
+            """
+        )
+        for row in cur:
+            yield row["skill_name"], row["student_id"], row["correct"]
+
+
+def iter_attempt_rows_assistments(
+    pdets_glob: str, plogs_glob: str, batch_size: int
+) -> Iterator[Tuple[str, str, int]]:
+    import duckdb
+
+    con = duckdb.connect()
+    query = f"""
+    with pdets as (
+      select
+        cast(problem_id as bigint) as problem_id,
+        trim(skill) as skill_name
+      from read_csv_auto('{pdets_glob}', union_by_name=true)
+      cross join unnest(
+        string_split(
+          replace(replace(replace(replace(skills, '[', ''), ']', ''), '''', ''), '"', ''),
+          ','
+        )
+      ) as t(skill)
+      where skills is not null and skills <> '' and skills <> '[]'
+    ),
+    plogs as (
+      select
+        cast(problem_id as bigint) as problem_id,
+        cast(student_id as varchar) as student_id,
+        start_time,
+        correct
+      from read_csv_auto('{plogs_glob}', union_by_name=true)
+      where correct in (0, 1)
+    )
+    select skill_name, student_id, correct
+    from plogs
+    join pdets using (problem_id)
+    where skill_name is not null and skill_name <> ''
+    order by skill_name, student_id, start_time
+    """
+    result = con.execute(query)
+    while True:
+        chunk = result.fetchmany(batch_size)
+        if not chunk:
+            break
+        for skill_name, student_id, correct in chunk:
+            yield skill_name, student_id, int(correct)
+
+
+def store_params(conn, results: List[Dict[str, object]]) -> None:
+    # The bkt_* columns come from migration 7.
+    apply_migrations(conn)
+    with conn.cursor() as cur:
+        cur.executemany(
+            """
+            update public.skills
+            set bkt_guess = %s, bkt_slip = %s, bkt_transit = %s
+            where skill_name = %s
+            """,
+            [
+                (result["guess"], result["slip"], result["transit"], result["skill_name"])
+                for result in results
+            ],
+        )
+
+
+def write_csv(path: str, results: List[Dict[str, object]]) -> None:
+    fields = ["skill_name", *BKT_PARAM_NAMES, "prior", "students", "observations", "log_likelihood"]
+    with open(path, "w", encoding="utf-8", newline="") as handle:
+        writer = csv.DictWriter(handle, fieldnames=fields)
+        writer.writeheader()
+        for result in results:
+            writer.writerow({field: result[field] for field in fields})
+
+
+def fit_all(
+    skills: Iterator[SkillSequences], workers: int, grid_step: float, max_steps: int
+) -> List[Dict[str, object]]:
+    results: List[Dict[str, object]] = []
+    pending: Set[Future] = set()
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for skill_name, sequences in skills:
+            # Bound in-flight skills so the reader never holds the whole log.
+            if len(pending) >= workers * 2:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                results.extend(future.result() for future in done)
+            pending.add(pool.submit(fit_skill, skill_name, sequences, grid_step, max_steps))
+        for future in pending:
+            results.append(future.result())
+    results.sort(key=lambda item: str(item["skill_name"]))
+    return results
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Fit per-skill BKT guess/slip/transit.")
+    parser.add_argument(
+        "--source",
+        choices=("db", "assistments"),
+        default="db",
+        help="Read public.attempts or the raw ASSISTments problem logs.",
+    )
+    parser.add_argument("--pdets-glob", default=os.getenv("ASSISTMENTS_PDETS_GLOB"))
+    parser.add_argument("--plogs-glob", default=os.getenv("ASSISTMENTS_PLOGS_GLOB"))
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--grid-step", type=float, default=0.05)
+    parser.add_argument("--max-steps", type=int, default=200, help="Truncate longer histories.")
+    parser.add_argument("--min-students", type=int, default=5)
+    parser.add_argument("--batch-size", type=int, default=50_000)
+    parser.add_argument("--out-csv", help="Also write fitted parameters to this CSV.")
+    parser.add_argument(
+        "--no-store", action="store_true", help="Do not write parameters to public.skills."
+    )
+    args = parser.parse_args()
+
+    conn = None
+    if args.source == "db" or not args.no_store:
+        conn = get_connection()
+        if not conn:
+            print("SUPABASE_DB_URL not set.", file=sys.stderr)
+            return 1
+
+    started = time.perf_counter()
+    if args.source == "db":
+        rows = iter_attempt_rows_db(conn, args.batch_size)
+    else:
+        if not args.pdets_glob or not args.plogs_glob:
+            print("Set --pdets-glob and --plogs-glob for the assistments source.", file=sys.stderr)
+            return 1
+        rows = iter_attempt_rows_assistments(args.pdets_glob, args.plogs_glob, args.batch_size)
+
+    skills = _group_rows(rows, args.min_students)
+    if conn is not None:
+        with conn:
+            results = fit_all(skills, args.workers, args.grid_step, args.max_steps)
+            if not args.no_store:
+                store_params(conn, results)
+    else:
+        results = fit_all(skills, args.workers, args.grid_step, args.max_steps)
+
+    if args.out_csv:
+        write_csv(args.out_csv, results)
+    elapsed = time.perf_counter() - started
+    print(f"Fitted {len(results)} skills in {elapsed:.1f}s using {args.workers} workers.")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -10,8 +10,8 @@ import { BlockMath } from 'react-katex';
 import { useStudentModel } from '../state/studentModelContext.jsx';
 import {
   fetchBktSnapshot,
-  generateProblem,
   sendOpikTrace,
+  streamProblem,
   submitAnswer,
 } from '../services/api.js';
 
@@ -102,6 +102,7 @@ const WorksheetPanel = ({ embedded = false }) => {
     },
   ]);
   const [problemStatus, setProblemStatus] = useState('idle');
+  const [streamingPrompt, setStreamingPrompt] = useState(null);
 
   const masteryPercent = Math.round(model.priorSkillMastery * 100);
   const masteryReached = masteryPercent >= 95;
@@ -141,13 +142,21 @@ const WorksheetPanel = ({ embedded = false }) => {
 
   useEffect(() => {
     let active = true;
+    const controller = new AbortController();
+    const timeout = setTimeout(() => controller.abort(), 10000);
     const loadProblem = async () => {
       setProblemStatus('loading');
       try {
-        const data = await generateProblem({
+        const data = await streamProblem({
           skillName: model.skillName,
           zpdStatus: model.zpdStatus,
           studentId: model.studentId,
+          signal: controller.signal,
+          onPrompt: (text) => {
+            if (active) {
+              setStreamingPrompt(text);
+            }
+          },
         });
         if (active && data?.latex) {
           setProblem({
@@ -169,7 +178,9 @@ const WorksheetPanel = ({ embedded = false }) => {
           resetAttempts();
         }
       } finally {
+        clearTimeout(timeout);
         if (active) {
+          setStreamingPrompt(null);
           setProblemStatus('idle');
         }
       }
@@ -178,6 +189,8 @@ const WorksheetPanel = ({ embedded = false }) => {
     loadProblem();
     return () => {
       active = false;
+      clearTimeout(timeout);
+      controller.abort();
     };
   }, [
     model.skillName,
@@ -396,10 +409,12 @@ const WorksheetPanel = ({ embedded = false }) => {
             </div>
 
             <div className="text-center py-4">
-              <p className="text-sm text-slate-500 mb-3">{problem.prompt}</p>
-              <div className="text-3xl font-bold text-slate-800">
-                <BlockMath math={problem.latex} />
-              </div>
+              <p className="text-sm text-slate-500 mb-3">{streamingPrompt ?? problem.prompt}</p>
+              {streamingPrompt === null && (
+                <div className="text-3xl font-bold text-slate-800">
+                  <BlockMath math={problem.latex} />
+                </div>
+              )}
             </div>
 
             <div className="w-full max-w-sm mx-auto">
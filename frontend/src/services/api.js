@@ -1,7 +1,9 @@
 import axios from 'axios';
 
+const API_URL = import.meta.env.VITE_API_URL || 'http://localhost:8000';
+
 const apiClient = axios.create({
-  baseURL: import.meta.env.VITE_API_URL || 'http://localhost:8000',
+  baseURL: API_URL,
   timeout: 10000,
 });
 
@@ -12,11 +14,27 @@ export const fetchBktSnapshot = async ({ studentId, skillName }) => {
   return response.data;
 };
 
+// Every skill for a student in one request; skillNames optionally narrows it.
+export const fetchBktSnapshots = async ({ studentId, skillNames }) => {
+  const params = { student_id: studentId };
+  if (skillNames?.length) {
+    params.skills = skillNames.join(',');
+  }
+  const response = await apiClient.get('/bkt/snapshots', { params });
+  return response.data;
+};
+
 export const submitAnswer = async (payload) => {
   const response = await apiClient.post('/answers', payload);
   return response.data;
 };
 
+// Ordered answers (e.g. a worksheet or an offline queue); one snapshot per answer.
+export const submitAnswers = async (payloads) => {
+  const response = await apiClient.post('/answers/batch', payloads);
+  return response.data;
+};
+
 export const generateProblem = async ({ skillName, zpdStatus, studentId }) => {
   const response = await apiClient.post('/llm/problem', {
     student_id: studentId,
@@ -26,9 +44,93 @@ export const generateProblem = async ({ skillName, zpdStatus, studentId }) => {
   return response.data;
 };
 
+// Streams /llm/problem/stream: onPrompt receives the prompt text so far, and
+// the promise resolves with the final validated problem.
+export const streamProblem = async ({ skillName, zpdStatus, studentId, onPrompt, signal }) => {
+  const response = await fetch(`${API_URL}/llm/problem/stream`, {
+    method: 'POST',
+    headers: { 'Content-Type': 'application/json' },
+    body: JSON.stringify({
+      student_id: studentId,
+      skill_name: skillName,
+      zpd_status: zpdStatus,
+    }),
+    signal,
+  });
+  if (!response.ok || !response.body) {
+    throw new Error(`Problem stream failed with status ${response.status}`);
+  }
+
+  const reader = response.body.getReader();
+  const decoder = new TextDecoder();
+  let buffer = '';
+  let prompt = '';
+  while (true) {
+    const { done, value } = await reader.read();
+    if (done) {
+      break;
+    }
+    buffer += decoder.decode(value, { stream: true });
+    let boundary = buffer.indexOf('\n\n');
+    while (boundary !== -1) {
+      const block = buffer.slice(0, boundary);
+      buffer = buffer.slice(boundary + 2);
+      boundary = buffer.indexOf('\n\n');
+
+      let event = 'message';
+      const dataLines = [];
+      block.split('\n').forEach((line) => {
+        if (line.startsWith('event:')) {
+          event = line.slice(6).trim();
+        } else if (line.startsWith('data:')) {
+          dataLines.push(line.slice(5).trim());
+        }
+      });
+      const data = dataLines.length ? JSON.parse(dataLines.join('\n')) : {};
+
+      if (event === 'prompt') {
+        prompt += data.text ?? '';
+        onPrompt?.(prompt);
+      } else if (event === 'reset') {
+        prompt = '';
+        onPrompt?.(prompt);
+      } else if (event === 'problem') {
+        reader.cancel();
+        return data;
+      }
+    }
+  }
+  throw new Error('Problem stream ended without a problem');
+};
+
+// Traces are queued and sent together to the bulk endpoint; tracing never
+// blocks the interaction that produced it.
+const TRACE_FLUSH_MS = 2000;
+const TRACE_BATCH_SIZE = 20;
+let traceQueue = [];
+let traceTimer = null;
+
+const flushOpikTraces = async () => {
+  clearTimeout(traceTimer);
+  traceTimer = null;
+  const batch = traceQueue;
+  traceQueue = [];
+  if (batch.length === 0) return;
+  try {
+    await apiClient.post('/opik/traces', batch);
+  } catch (error) {
+    // Dropped traces are acceptable; the answer log is the record of truth.
+  }
+};
+
 export const sendOpikTrace = async (payload) => {
-  const response = await apiClient.post('/opik/trace', payload);
-  return response.data;
+  traceQueue.push(payload);
+  if (traceQueue.length >= TRACE_BATCH_SIZE) {
+    flushOpikTraces();
+  } else if (!traceTimer) {
+    traceTimer = setTimeout(flushOpikTraces, TRACE_FLUSH_MS);
+  }
+  return { status: 'queued' };
 };
 
 export const fetchCourses = async ({ studentId }) => {
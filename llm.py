@@ -1,13 +1,150 @@
+import asyncio
 import json
 import logging
 import os
 import re
-from typing import Any, Dict, Optional
+import threading
+import time
+from collections import deque
+from typing import (
+    Any,
+    AsyncIterator,
+    Callable,
+    Deque,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+    TypeVar,
+)
 
-from openai import OpenAI
+import httpx
+from openai import APITimeoutError, AsyncOpenAI, OpenAI
 
 logger = logging.getLogger("aits")
 
+DEEPSEEK_BASE_URL = os.getenv("DEEPSEEK_BASE_URL", "https://api.deepseek.com")
+# Whole-call budget, including connecting and reading the completion.
+LLM_TIMEOUT_SECONDS = float(os.getenv("LLM_TIMEOUT_SECONDS", "8"))
+LLM_BATCH_TIMEOUT_SECONDS = float(os.getenv("LLM_BATCH_TIMEOUT_SECONDS", "45"))
+# Successful calls slower than this still count against the circuit breaker.
+LLM_SLOW_SECONDS = float(os.getenv("LLM_SLOW_SECONDS", "5"))
+LLM_MAX_CONNECTIONS = int(os.getenv("LLM_MAX_CONNECTIONS", "20"))
+LLM_KEEPALIVE_SECONDS = float(os.getenv("LLM_KEEPALIVE_SECONDS", "60"))
+LLM_BREAKER_FAILURES = int(os.getenv("LLM_BREAKER_FAILURES", "5"))
+LLM_BREAKER_COOLDOWN_SECONDS = float(os.getenv("LLM_BREAKER_COOLDOWN_SECONDS", "30"))
+
+_CLIENT: Optional[OpenAI] = None
+_ASYNC_CLIENT: Optional[AsyncOpenAI] = None
+_CLIENT_LOCK = threading.Lock()
+
+T = TypeVar("T")
+
+_PROMPT_START = re.compile(r'"prompt"\s*:\s*"')
+
+
+class CircuitBreaker:
+    # closed: calls go through. open: calls are refused until the cooldown
+    # ends. half_open: one probe call decides whether to close or reopen.
+    def __init__(self, failure_threshold: int, cooldown_seconds: float) -> None:
+        self.failure_threshold = max(1, failure_threshold)
+        self.cooldown_seconds = cooldown_seconds
+        self.state = "closed"
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self.probing = False
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.state == "closed":
+                return True
+            if self.state == "open":
+                if time.monotonic() - self.opened_at < self.cooldown_seconds:
+                    return False
+                self.state = "half_open"
+            if self.probing:
+                return False
+            self.probing = True
+            return True
+
+    def abandon(self) -> None:
+        # A caller went away mid-call; free the probe slot without a verdict.
+        with self._lock:
+            self.probing = False
+
+    def record(self, ok: bool) -> None:
+        with self._lock:
+            self.probing = False
+            if ok:
+                self.state = "closed"
+                self.consecutive_failures = 0
+                return
+            self.consecutive_failures += 1
+            if self.state == "half_open" or self.consecutive_failures >= self.failure_threshold:
+                if self.state != "open":
+                    logger.warning(
+                        "llm.breaker.opened", extra={"failures": self.consecutive_failures}
+                    )
+                self.state = "open"
+                self.opened_at = time.monotonic()
+
+
+class LlmStats:
+    def __init__(self, window: int = 512) -> None:
+        self.calls = 0
+        self.successes = 0
+        self.errors = 0
+        self.timeouts = 0
+        self.slow = 0
+        self.invalid = 0
+        self.short_circuited = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.latencies: Deque[float] = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def count(self, field: str) -> None:
+        with self._lock:
+            setattr(self, field, getattr(self, field) + 1)
+
+    def add_tokens(self, prompt_tokens: int, completion_tokens: int) -> None:
+        with self._lock:
+            self.prompt_tokens += prompt_tokens
+            self.completion_tokens += completion_tokens
+
+    def observe(self, seconds: float) -> None:
+        with self._lock:
+            self.latencies.append(seconds)
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            ordered = sorted(self.latencies)
+            counters = {
+                name: getattr(self, name)
+                for name in (
+                    "calls", "successes", "errors", "timeouts", "slow", "invalid",
+                    "short_circuited", "prompt_tokens", "completion_tokens",
+                )
+            }
+
+        def percentile(q: float) -> Optional[float]:
+            if not ordered:
+                return None
+            return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+        return {
+            **counters,
+            "latency_p50": percentile(0.5),
+            "latency_p95": percentile(0.95),
+            "latency_max": ordered[-1] if ordered else None,
+        }
+
+
+BREAKER = CircuitBreaker(LLM_BREAKER_FAILURES, LLM_BREAKER_COOLDOWN_SECONDS)
+STATS = LlmStats()
+
 
 def _extract_json(text: str) -> Optional[Dict[str, Any]]:
     try:
@@ -22,16 +159,7 @@ def _extract_json(text: str) -> Optional[Dict[str, Any]]:
             return None
 
 
-def generate_problem_with_llm(
-    *, skill_name: str, mastery: float, zpd_status: str
-) -> Optional[Dict[str, str]]:
-    api_key = os.getenv("DEEPSEEK_API_KEY")
-    if not api_key:
-        return None
-
-    model = os.getenv("DEEPSEEK_MODEL", "deepseek-chat")
-    client = OpenAI(api_key=api_key, base_url="https://api.deepseek.com")
-
+def _build_messages(skill_name: str, mastery: float, zpd_status: str) -> List[Dict[str, str]]:
     system_prompt = (
         "You are a math tutor. Generate ONE practice problem for the given skill. "
         "Return ONLY valid JSON with keys: prompt, latex, answer. "
@@ -43,24 +171,74 @@ Mastery (0-1): {mastery:.2f}
 ZPD: {zpd_status}
 Target the most common misconception for this skill and keep the problem concise."""
 
-    try:
-        response = client.chat.completions.create(
-            model=model,
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": user_prompt},
-            ],
-            temperature=0.7,
-        )
-    except Exception as exc:
-        logger.warning("llm.problem.call_failed", extra={"error": str(exc)})
-        return None
+    return [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": user_prompt},
+    ]
+
+
+def _build_batch_messages(
+    skill_name: str, mastery: float, zpd_status: str, count: int
+) -> List[Dict[str, str]]:
+    system_prompt = (
+        f"You are a math tutor. Generate {count} different practice problems for the given skill. "
+        "Return ONLY a JSON array of objects, each with keys: prompt, latex, answer. "
+        "Each answer must be a short string (number or short expression)."
+    )
+
+    user_prompt = f"""Skill: {skill_name}
+Mastery (0-1): {mastery:.2f}
+ZPD: {zpd_status}
+Count: {count}
+Vary the numbers and target common misconceptions for this skill; keep each problem concise."""
+
+    return [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": user_prompt},
+    ]
+
+
+def _iter_problems(text: str) -> Iterator[Dict[str, str]]:
+    # Decodes every complete {...} in the text, so a truncated or partly
+    # malformed array still yields the problems before and after the damage.
+    decoder = json.JSONDecoder()
+    pos = text.find("{")
+    while pos != -1:
+        try:
+            value, end = decoder.raw_decode(text, pos)
+        except json.JSONDecodeError:
+            pos = text.find("{", pos + 1)
+            continue
+        problem = _validate_problem(value) if isinstance(value, dict) else None
+        if problem is not None:
+            yield problem
+            pos = text.find("{", end)
+        else:
+            # A wrapper such as {"problems": [...]}: look inside it.
+            pos = text.find("{", pos + 1)
+
+
+def _parse_problems(content: Optional[str], limit: int) -> List[Dict[str, str]]:
+    problems: List[Dict[str, str]] = []
+    seen = set()
+    for problem in _iter_problems(content or ""):
+        if (problem["latex"], problem["answer"]) in seen:
+            continue
+        seen.add((problem["latex"], problem["answer"]))
+        problems.append(problem)
+        if len(problems) >= limit:
+            break
+    return problems
 
-    content = response.choices[0].message.content.strip()
-    data = _extract_json(content)
+
+def _parse_problem(content: Optional[str]) -> Optional[Dict[str, str]]:
+    data = _extract_json((content or "").strip())
     if not data:
         return None
+    return _validate_problem(data)
+
 
+def _validate_problem(data: Dict[str, Any]) -> Optional[Dict[str, str]]:
     prompt = str(data.get("prompt", "")).strip()
     latex = str(data.get("latex", "")).strip()
     answer = str(data.get("answer", "")).strip()
@@ -68,3 +246,287 @@ Target the most common misconception for this skill and keep the problem concise
         return None
 
     return {"prompt": prompt, "latex": latex, "answer": answer}
+
+
+def _client_options(api_key: str) -> Dict[str, Any]:
+    # Retries would overrun the latency budget; the breaker and the
+    # template fallback handle failures instead.
+    return {
+        "api_key": api_key,
+        "base_url": DEEPSEEK_BASE_URL,
+        "timeout": httpx.Timeout(LLM_TIMEOUT_SECONDS, connect=min(2.0, LLM_TIMEOUT_SECONDS)),
+        "max_retries": 0,
+    }
+
+
+def _limits() -> httpx.Limits:
+    return httpx.Limits(
+        max_connections=LLM_MAX_CONNECTIONS,
+        max_keepalive_connections=LLM_MAX_CONNECTIONS,
+        keepalive_expiry=LLM_KEEPALIVE_SECONDS,
+    )
+
+
+def get_client() -> Optional[OpenAI]:
+    global _CLIENT
+    api_key = os.getenv("DEEPSEEK_API_KEY")
+    if not api_key:
+        return None
+    if _CLIENT is None:
+        with _CLIENT_LOCK:
+            if _CLIENT is None:
+                _CLIENT = OpenAI(
+                    http_client=httpx.Client(limits=_limits()), **_client_options(api_key)
+                )
+    return _CLIENT
+
+
+def get_async_client() -> Optional[AsyncOpenAI]:
+    global _ASYNC_CLIENT
+    api_key = os.getenv("DEEPSEEK_API_KEY")
+    if not api_key:
+        return None
+    if _ASYNC_CLIENT is None:
+        # Shared so concurrent requests reuse its keep-alive connections.
+        _ASYNC_CLIENT = AsyncOpenAI(
+            http_client=httpx.AsyncClient(limits=_limits()), **_client_options(api_key)
+        )
+    return _ASYNC_CLIENT
+
+
+async def close_llm_clients() -> None:
+    global _CLIENT, _ASYNC_CLIENT
+    if _ASYNC_CLIENT is not None:
+        client, _ASYNC_CLIENT = _ASYNC_CLIENT, None
+        await client.close()
+    if _CLIENT is not None:
+        client, _CLIENT = _CLIENT, None
+        client.close()
+
+
+def _record_usage(response: Any) -> None:
+    usage = getattr(response, "usage", None)
+    if usage is not None:
+        STATS.add_tokens(usage.prompt_tokens or 0, usage.completion_tokens or 0)
+
+
+def _finish_call(started: float, slow_after: float, result: Optional[T]) -> Optional[T]:
+    elapsed = time.perf_counter() - started
+    STATS.observe(elapsed)
+    slow = elapsed > slow_after
+    if slow:
+        STATS.count("slow")
+    if not result:
+        STATS.count("invalid")
+    else:
+        STATS.count("successes")
+    BREAKER.record(bool(result) and not slow)
+    return result
+
+
+def _fail_call(started: float, exc: Exception) -> None:
+    STATS.observe(time.perf_counter() - started)
+    timed_out = isinstance(exc, (asyncio.TimeoutError, APITimeoutError))
+    STATS.count("timeouts" if timed_out else "errors")
+    BREAKER.record(False)
+    logger.warning("llm.problem.call_failed", extra={"error": str(exc)})
+
+
+def _complete(
+    messages: List[Dict[str, str]], parse: Callable[[Optional[str]], Optional[T]]
+) -> Optional[T]:
+    client = get_client()
+    if client is None:
+        return None
+    if not BREAKER.allow():
+        STATS.count("short_circuited")
+        return None
+
+    model = os.getenv("DEEPSEEK_MODEL", "deepseek-chat")
+    STATS.count("calls")
+    started = time.perf_counter()
+    try:
+        response = client.chat.completions.create(
+            model=model, messages=messages, temperature=0.7
+        )
+    except Exception as exc:
+        _fail_call(started, exc)
+        return None
+
+    _record_usage(response)
+    return _finish_call(started, LLM_SLOW_SECONDS, parse(response.choices[0].message.content))
+
+
+async def _complete_async(
+    messages: List[Dict[str, str]],
+    parse: Callable[[Optional[str]], Optional[T]],
+    timeout: float = LLM_TIMEOUT_SECONDS,
+    slow_after: float = LLM_SLOW_SECONDS,
+) -> Optional[T]:
+    client = get_async_client()
+    if client is None:
+        return None
+    if not BREAKER.allow():
+        STATS.count("short_circuited")
+        return None
+
+    model = os.getenv("DEEPSEEK_MODEL", "deepseek-chat")
+    STATS.count("calls")
+    started = time.perf_counter()
+    try:
+        # The httpx timeout bounds each read; wait_for bounds the whole call.
+        response = await asyncio.wait_for(
+            client.chat.completions.create(
+                model=model, messages=messages, temperature=0.7, timeout=timeout
+            ),
+            timeout,
+        )
+    except asyncio.CancelledError:
+        BREAKER.abandon()
+        raise
+    except Exception as exc:
+        _fail_call(started, exc)
+        return None
+
+    _record_usage(response)
+    return _finish_call(started, slow_after, parse(response.choices[0].message.content))
+
+
+def generate_problem_with_llm(
+    *, skill_name: str, mastery: float, zpd_status: str
+) -> Optional[Dict[str, str]]:
+    return _complete(_build_messages(skill_name, mastery, zpd_status), _parse_problem)
+
+
+async def generate_problem_with_llm_async(
+    *, skill_name: str, mastery: float, zpd_status: str
+) -> Optional[Dict[str, str]]:
+    return await _complete_async(_build_messages(skill_name, mastery, zpd_status), _parse_problem)
+
+
+async def generate_problems_with_llm_async(
+    *, skill_name: str, mastery: float, zpd_status: str, count: int
+) -> List[Dict[str, str]]:
+    # Background callers only, so it gets the longer batch budget.
+    problems = await _complete_async(
+        _build_batch_messages(skill_name, mastery, zpd_status, count),
+        lambda content: _parse_problems(content, count),
+        timeout=LLM_BATCH_TIMEOUT_SECONDS,
+        slow_after=LLM_BATCH_TIMEOUT_SECONDS,
+    )
+    return problems or []
+
+
+def _decode_partial_string(body: str) -> Optional[str]:
+    # The tail may end inside an escape sequence; drop up to one escape's worth.
+    for cut in range(7):
+        try:
+            return json.loads(f'"{body[:len(body) - cut]}"', strict=False)
+        except json.JSONDecodeError:
+            continue
+    return None
+
+
+class PromptScanner:
+    # Pulls the "prompt" string value out of a JSON object while it is still
+    # being streamed, returning only the text not seen before.
+    def __init__(self) -> None:
+        self.buffer = ""
+        self.start: Optional[int] = None
+        self.emitted = 0
+        self.done = False
+
+    def feed(self, text: str) -> str:
+        self.buffer += text
+        if self.done:
+            return ""
+        if self.start is None:
+            match = _PROMPT_START.search(self.buffer)
+            if not match:
+                return ""
+            self.start = match.end()
+        raw = self.buffer[self.start:]
+        escaped = False
+        for idx, char in enumerate(raw):
+            if escaped:
+                escaped = False
+            elif char == "\\":
+                escaped = True
+            elif char == '"':
+                raw = raw[:idx]
+                self.done = True
+                break
+        decoded = _decode_partial_string(raw)
+        if decoded is None or len(decoded) <= self.emitted:
+            return ""
+        fresh = decoded[self.emitted:]
+        self.emitted = len(decoded)
+        return fresh
+
+
+async def stream_problem_with_llm(
+    *, skill_name: str, mastery: float, zpd_status: str
+) -> AsyncIterator[Tuple[str, Any]]:
+    # Yields ("prompt", text) as the prompt becomes readable, then exactly one
+    # ("problem", validated problem or None).
+    client = get_async_client()
+    if client is None:
+        yield "problem", None
+        return
+    if not BREAKER.allow():
+        STATS.count("short_circuited")
+        yield "problem", None
+        return
+
+    model = os.getenv("DEEPSEEK_MODEL", "deepseek-chat")
+    STATS.count("calls")
+    started = time.perf_counter()
+    deadline = time.monotonic() + LLM_TIMEOUT_SECONDS
+    scanner = PromptScanner()
+    parts: List[str] = []
+    stream = None
+    try:
+        stream = await asyncio.wait_for(
+            client.chat.completions.create(
+                model=model,
+                messages=_build_messages(skill_name, mastery, zpd_status),
+                temperature=0.7,
+                stream=True,
+            ),
+            LLM_TIMEOUT_SECONDS,
+        )
+        chunks = stream.__aiter__()
+        while True:
+            try:
+                chunk = await asyncio.wait_for(
+                    chunks.__anext__(), max(0.0, deadline - time.monotonic())
+                )
+            except StopAsyncIteration:
+                break
+            delta = chunk.choices[0].delta.content if chunk.choices else None
+            if not delta:
+                continue
+            parts.append(delta)
+            fresh = scanner.feed(delta)
+            if fresh:
+                yield "prompt", fresh
+    except (asyncio.CancelledError, GeneratorExit):
+        BREAKER.abandon()
+        raise
+    except Exception as exc:
+        _fail_call(started, exc)
+        yield "problem", None
+        return
+    finally:
+        if stream is not None:
+            await stream.close()
+
+    yield "problem", _finish_call(started, LLM_SLOW_SECONDS, _parse_problem("".join(parts)))
+
+
+def llm_metrics() -> Dict[str, Any]:
+    return {
+        "breaker": BREAKER.state,
+        "consecutive_failures": BREAKER.consecutive_failures,
+        **STATS.snapshot(),
+    }
@@ -1,28 +1,140 @@
-﻿import logging
+﻿import json
+import logging
 import os
 import random
-import uuid
-from datetime import datetime, timezone
-from typing import Any, Dict, List, Optional, Tuple
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+from pathlib import Path
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Iterable, List, NamedTuple, Optional, Set, Tuple, TypeVar
 
 import psycopg
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.encoders import jsonable_encoder
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import Response, StreamingResponse
 from pydantic import BaseModel, Field
 
-from bkt import DEFAULT_BKT_PARAMS, update_mastery
+from attempt_log import (
+    ATTEMPT_COLUMNS,
+    ATTEMPT_COLUMN_TYPES,
+    ATTEMPT_LOG_WRITE_BEHIND,
+    attempt_log_enabled,
+    attempt_log_metrics,
+    log_attempt,
+    log_attempts,
+    start_attempt_log,
+    stop_attempt_log,
+)
+from bkt import (
+    DEFAULT_PRIOR,
+    MASTERY_SNAP_THRESHOLD,
+    MAX_HINTS_PER_QUESTION,
+    advance_learner_state,
+    get_skill_params,
+    load_skill_params_csv,
+    set_skill_params,
+    skill_params_loaded,
+)
+from cohort_stats import (
+    ALL_STUDENTS,
+    cohort_rows_op,
+    cohort_stats_metrics,
+    histogram_percentile,
+    record_class_change,
+    record_cohort_answer,
+    start_cohort_stats,
+    stop_cohort_stats,
+)
 from db import (
-    ensure_student,
-    fetch_skill_prior,
-    filter_payload_for_table,
+    DbOp,
+    Query,
+    TableMapping,
+    async_pooled_connection,
+    close_async_pool,
+    ensure_student_op,
+    ensure_students_op,
     get_connection,
     get_db_url,
-    get_table_columns,
-    pick_column,
+    insert_sql,
+    open_async_pool,
+    resolve_schema,
+    run_op,
+    run_op_async,
+    schema_generation,
+    table_columns_op,
+    table_mapping_op,
+    unnest_insert_sql,
+    unnest_update_sql,
+    update_sql,
+)
+from llm import (
+    close_llm_clients,
+    generate_problem_with_llm_async,
+    get_async_client,
+    llm_metrics,
+    stream_problem_with_llm,
+)
+from memory_store import LearnerRecord, LearnerStateStore
+from migrations import apply_migrations
+from opik_traces import ingest_traces, start_trace_ingest, stop_trace_ingest, trace_ingest_metrics
+from problem_pool import (
+    pop_pooled_problem,
+    problem_pool_metrics,
+    start_problem_pool,
+    stop_problem_pool,
+)
+from problem_store import bank_problem_op, serve_stored_problem_op
+from skill_table import (
+    cached_skill_prior,
+    load_skill_table,
+    skill_table_loaded,
+    skill_table_op,
+    start_skill_table_listener,
+    stop_skill_table_listener,
 )
-from llm import generate_problem_with_llm
+from view_cache import StudentViewCache, etag_matches
 
-app = FastAPI(title="Adaptive Intelligent Tutoring System API")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    if USE_DB:
+        # One-off startup work stays on a plain sync connection; requests use the async pool.
+        conn = get_connection()
+        with conn:
+            if MIGRATE_ON_STARTUP:
+                applied = apply_migrations(conn)
+                if applied:
+                    logger.info("db.migrations.applied", extra={"versions": applied})
+            # Resolve every table's columns once; migrations above invalidate it.
+            resolve_schema(conn, APP_TABLES)
+            seed_course_catalog(conn)
+            load_skill_table(conn)
+            backfill_learning_paths(conn)
+        await open_async_pool()
+        if SKILL_TABLE_LISTEN:
+            start_skill_table_listener()
+        if ATTEMPT_LOG_WRITE_BEHIND:
+            start_attempt_log()
+        start_cohort_stats()
+    if PROBLEM_POOL_ENABLED and get_async_client() is not None:
+        start_problem_pool(catalog_skills())
+    start_trace_ingest(USE_DB)
+    yield
+    await stop_problem_pool()
+    await close_llm_clients()
+    stop_skill_table_listener()
+    # Drains buffered attempts, so it must run while the pool is still open.
+    await stop_attempt_log()
+    await stop_trace_ingest()
+    await stop_cohort_stats()
+    await close_async_pool()
+    if MEMORY_STORE.snapshot():
+        logger.info("memory_state.snapshot", extra=MEMORY_STORE.metrics())
+    MEMORY_STORE.close()
+
+
+app = FastAPI(title="Adaptive Intelligent Tutoring System API", lifespan=lifespan)
 logger = logging.getLogger("aits")
 
 cors_origins = os.getenv("CORS_ORIGINS")
@@ -37,16 +149,35 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["ETag"],
 )
 
 DB_URL = get_db_url()
 USE_DB = bool(DB_URL)
 
-DEFAULT_PRIOR = float(os.getenv("DEFAULT_SKILL_PRIOR", "0.3"))
-
 COURSE_UNLOCK_THRESHOLD = float(os.getenv("COURSE_UNLOCK_MASTERY", "1.0"))
-MASTERY_SNAP_THRESHOLD = float(os.getenv("MASTERY_SNAP_THRESHOLD", "0.99"))
-MAX_HINTS_PER_QUESTION = int(os.getenv("MAX_HINTS_PER_QUESTION", "3"))
+SKILL_BKT_PARAMS_CSV = os.getenv("SKILL_BKT_PARAMS_CSV")
+SKILL_TABLE_LISTEN = os.getenv("SKILL_TABLE_LISTEN", "1").lower() not in ("0", "false", "no")
+MIGRATE_ON_STARTUP = os.getenv("MIGRATE_ON_STARTUP", "1").lower() not in ("0", "false", "no")
+BKT_ATOMIC_UPDATE = os.getenv("BKT_ATOMIC_UPDATE", "1").lower() not in ("0", "false", "no")
+APP_TABLES = (
+    "students",
+    "bkt_state",
+    "attempts",
+    "skills",
+    "courses",
+    "enrollments",
+    "assignments",
+    "problems",
+    "opik_traces",
+    "problem_bank",
+    "problem_served",
+    "cohort_skill_stats",
+)
+# Largest /answers/batch and /opik/traces requests.
+ANSWERS_BATCH_MAX = int(os.getenv("ANSWERS_BATCH_MAX", "500"))
+TRACES_BATCH_MAX = int(os.getenv("TRACES_BATCH_MAX", "500"))
+PROBLEM_POOL_ENABLED = os.getenv("PROBLEM_POOL_ENABLED", "1").lower() not in ("0", "false", "no")
 
 COURSE_CATALOG = [
     {
@@ -95,6 +226,29 @@ COURSE_CATALOG = [
 
 COURSE_BY_ID = {course["id"]: course for course in COURSE_CATALOG}
 
+
+def build_course_index(
+    catalog: List[Dict[str, Any]],
+) -> Tuple[Dict[str, List[str]], Dict[str, List[str]]]:
+    courses_by_skill: Dict[str, List[str]] = {}
+    course_children: Dict[str, List[str]] = {}
+    for course in catalog:
+        if course.get("target_skill"):
+            courses_by_skill.setdefault(course["target_skill"], []).append(course["id"])
+        if course.get("parent_id"):
+            course_children.setdefault(course["parent_id"], []).append(course["id"])
+    return courses_by_skill, course_children
+
+
+COURSES_BY_SKILL, COURSE_CHILDREN = build_course_index(COURSE_CATALOG)
+# Skills every dashboard shows, recorded or not.
+CATALOG_SKILLS = tuple(COURSES_BY_SKILL)
+
+
+def catalog_skills() -> List[str]:
+    return list(CATALOG_SKILLS)
+
+
 DEFAULT_COURSES = [
     {
         "id": course["id"],
@@ -109,8 +263,15 @@ DEFAULT_COURSES = [
     for course in COURSE_CATALOG
 ]
 
-MEMORY_STATE: Dict[Tuple[str, str], Dict[str, Any]] = {}
-INTERVENTION_STATE: Dict[Tuple[str, str], Dict[str, Any]] = {}
+# Learner state without a DB, plus the intervention flags in both modes.
+MEMORY_STORE = LearnerStateStore()
+# Serialized /courses and /assignments responses, invalidated by answers.
+VIEW_CACHE = StudentViewCache()
+
+T = TypeVar("T")
+
+# Answer counters are int columns in Postgres and int32 in the in-memory store.
+MAX_COUNTER = 2**31 - 1
 
 
 class SnapshotResponse(BaseModel):
@@ -121,14 +282,18 @@ class SnapshotResponse(BaseModel):
     recovery_streak: int = 0
 
 
+class SkillSnapshot(SnapshotResponse):
+    skill_name: str
+
+
 class AnswerPayload(BaseModel):
     student_id: str
     skill_name: str
     answer: Optional[str] = None
     correct: bool
-    attempt_count: int = Field(ge=0)
-    time_on_task: Optional[int] = Field(default=None, ge=0)
-    hints_used: Optional[int] = Field(default=None, ge=0)
+    attempt_count: int = Field(ge=0, le=MAX_COUNTER)
+    time_on_task: Optional[int] = Field(default=None, ge=0, le=MAX_COUNTER)
+    hints_used: Optional[int] = Field(default=None, ge=0, le=MAX_COUNTER)
 
 
 class ProblemRequest(BaseModel):
@@ -176,6 +341,34 @@ class OpikTracePayload(BaseModel):
     source: Optional[str] = None
 
 
+class ClassAssignment(BaseModel):
+    class_id: Optional[str] = None
+
+
+class CohortSkill(BaseModel):
+    skill_name: str
+    students: int
+    attempts: int
+    class_avg_performance: Optional[float] = None
+    mean_mastery: Optional[float] = None
+    histogram: List[int]
+    student_mastery: Optional[float] = None
+    relative_to_class: Optional[float] = None
+    peer_comparison_percentile: Optional[float] = None
+
+
+class CohortResponse(BaseModel):
+    class_id: str
+    class_size: Optional[int] = None
+    attempts: int = 0
+    class_avg_performance: Optional[float] = None
+    mean_mastery: Optional[float] = None
+    student_id: Optional[str] = None
+    relative_to_class: Optional[float] = None
+    peer_comparison_percentile: Optional[float] = None
+    skills: List[CohortSkill] = Field(default_factory=list)
+
+
 def build_problem(skill_name: str, zpd_status: Optional[str]) -> ProblemResponse:
     status = (zpd_status or "challenge").lower()
     harder = status in {"stretch", "challenge"}
@@ -233,147 +426,160 @@ def clamp_mastery(value: Optional[float]) -> float:
     return float(value)
 
 
-def ensure_courses_schema(conn: psycopg.Connection) -> None:
-    with conn.cursor() as cur:
-        cur.execute(
-            """
-            create table if not exists public.courses (
-                id text primary key,
-                title text not null,
-                module text,
-                summary text,
-                parent_id text references public.courses(id),
-                target_skill text,
-                sequence int,
-                created_at timestamptz default now()
-            );
-            """
-        )
-        cur.execute(
-            """
-            create table if not exists public.enrollments (
-                student_id text not null references public.students(student_id),
-                course_id text not null references public.courses(id),
-                progress numeric default 0,
-                status text,
-                created_at timestamptz default now(),
-                primary key (student_id, course_id)
-            );
-            """
-        )
-        cur.execute(
-            """
-            create table if not exists public.assignments (
-                id text primary key,
-                student_id text not null references public.students(student_id),
-                course_id text references public.courses(id),
-                title text not null,
-                assignment_type text,
-                skill_name text,
-                problem_count integer default 0,
-                completion_rate numeric default 0,
-                status text,
-                created_at timestamptz default now()
-            );
-            """
-        )
-        cur.execute(
-            "create unique index if not exists assignments_student_course_idx on public.assignments(student_id, course_id);"
+def skill_bkt_params(skill_name: str) -> Dict[str, float]:
+    # In DB mode the skill table (loaded at startup) has already filled this cache.
+    if not skill_params_loaded():
+        if SKILL_BKT_PARAMS_CSV and Path(SKILL_BKT_PARAMS_CSV).exists():
+            set_skill_params(load_skill_params_csv(SKILL_BKT_PARAMS_CSV))
+        else:
+            set_skill_params({})
+    return get_skill_params(skill_name)
+
+
+def _catalog_arrays() -> Dict[str, List[Any]]:
+    return {
+        "ids": [course["id"] for course in COURSE_CATALOG],
+        "titles": [course["title"] for course in COURSE_CATALOG],
+        "modules": [course.get("module") for course in COURSE_CATALOG],
+        "summaries": [course.get("summary") for course in COURSE_CATALOG],
+        "parent_ids": [course.get("parent_id") for course in COURSE_CATALOG],
+        "target_skills": [course.get("target_skill") for course in COURSE_CATALOG],
+        "sequences": [course.get("sequence") for course in COURSE_CATALOG],
+    }
+
+
+def courses_affected_by_skill(skill_name: str) -> List[str]:
+    affected: List[str] = []
+    for course_id in COURSES_BY_SKILL.get(skill_name, []):
+        affected.append(course_id)
+        affected.extend(COURSE_CHILDREN.get(course_id, []))
+    return list(dict.fromkeys(affected))
+
+
+def skill_prior_op(skill_name: str) -> DbOp[float]:
+    if not skill_table_loaded():
+        yield from skill_table_op()
+    return cached_skill_prior(skill_name, DEFAULT_PRIOR)
+
+
+def seed_course_catalog_op() -> DbOp[None]:
+    yield Query(
+        """
+        insert into public.courses (id, title, module, summary, parent_id, target_skill, sequence)
+        select * from unnest(
+            %(ids)s::text[], %(titles)s::text[], %(modules)s::text[], %(summaries)s::text[],
+            %(parent_ids)s::text[], %(target_skills)s::text[], %(sequences)s::int[]
         )
-        cur.execute("alter table public.courses add column if not exists module text;")
-        cur.execute("alter table public.courses add column if not exists summary text;")
-        cur.execute("alter table public.courses add column if not exists parent_id text;")
-        cur.execute("alter table public.courses add column if not exists target_skill text;")
-        cur.execute("alter table public.courses add column if not exists sequence int;")
-        cur.execute("alter table public.enrollments add column if not exists progress numeric default 0;")
-        cur.execute("alter table public.enrollments add column if not exists status text;")
-        cur.execute("alter table public.assignments add column if not exists assignment_type text;")
-        cur.execute("alter table public.assignments add column if not exists skill_name text;")
-        cur.execute("alter table public.assignments add column if not exists problem_count integer default 0;")
-        cur.execute("alter table public.assignments add column if not exists completion_rate numeric default 0;")
-        cur.execute("alter table public.assignments add column if not exists status text;")
-
-
-def seed_courses_for_student(conn: psycopg.Connection, student_id: str) -> None:
-    with conn.cursor() as cur:
-        for course in COURSE_CATALOG:
-            cur.execute(
-                """
-                insert into public.courses (id, title, module, summary, parent_id, target_skill, sequence)
-                values (%s, %s, %s, %s, %s, %s, %s)
-                on conflict (id) do update set
-                    title = excluded.title,
-                    module = excluded.module,
-                    summary = excluded.summary,
-                    parent_id = excluded.parent_id,
-                    target_skill = excluded.target_skill,
-                    sequence = excluded.sequence
-                """,
-                (
-                    course["id"],
-                    course["title"],
-                    course.get("module"),
-                    course.get("summary"),
-                    course.get("parent_id"),
-                    course.get("target_skill"),
-                    course.get("sequence"),
-                ),
-            )
-        for course in COURSE_CATALOG:
-            status = "Assigned" if not course.get("parent_id") else "Locked"
-            cur.execute(
-                """
-                insert into public.enrollments (student_id, course_id, progress, status)
-                values (%s, %s, %s, %s)
-                on conflict (student_id, course_id) do nothing
-                """,
-                (student_id, course["id"], 0.0, status),
-            )
-            cur.execute(
-                """
-                update public.enrollments
-                set status = %s
-                where student_id = %s and course_id = %s and status is null
-                """,
-                (status, student_id, course["id"]),
-            )
-            cur.execute(
-                """
-                update public.enrollments
-                set progress = 0
-                where student_id = %s and course_id = %s and progress is null
-                """,
-                (student_id, course["id"]),
-            )
+        on conflict (id) do update set
+            title = excluded.title,
+            module = excluded.module,
+            summary = excluded.summary,
+            parent_id = excluded.parent_id,
+            target_skill = excluded.target_skill,
+            sequence = excluded.sequence
+        """,
+        _catalog_arrays(),
+    )
 
 
-def fetch_courses_db(conn: psycopg.Connection, student_id: str) -> List[CourseItem]:
-    with conn.cursor() as cur:
-        cur.execute(
-            """
-            select c.id,
-                   c.title,
-                   c.module,
-                   c.target_skill,
-                   c.parent_id,
-                   c.sequence,
-                   e.progress,
-                   e.status
-            from public.enrollments e
-            join public.courses c on c.id = e.course_id
-            where e.student_id = %s
-            order by c.sequence nulls last, c.title
-            """,
-            (student_id,),
+def seed_course_catalog(conn: psycopg.Connection) -> None:
+    run_op(conn, seed_course_catalog_op())
+
+
+def seed_enrollments_op(student_id: str, course_ids: List[str]) -> DbOp[None]:
+    yield Query(
+        """
+        insert into public.enrollments (student_id, course_id, progress, status)
+        select %(student_id)s, c.id, 0,
+               case when c.parent_id is null then 'Assigned' else 'Locked' end
+        from public.courses c
+        where c.id = any(%(ids)s::text[])
+        on conflict (student_id, course_id) do nothing
+        """,
+        {"student_id": student_id, "ids": course_ids},
+    )
+    yield Query(
+        """
+        update public.enrollments e
+        set status = coalesce(
+                e.status,
+                case when c.parent_id is null then 'Assigned' else 'Locked' end
+            ),
+            progress = coalesce(e.progress, 0)
+        from public.courses c
+        where c.id = e.course_id
+          and e.student_id = %(student_id)s
+          and e.course_id = any(%(ids)s::text[])
+          and (e.status is null or e.progress is null)
+        """,
+        {"student_id": student_id, "ids": course_ids},
+    )
+
+
+def seed_courses_for_student_op(student_id: str) -> DbOp[None]:
+    yield from seed_course_catalog_op()
+    yield from seed_enrollments_op(student_id, [course["id"] for course in COURSE_CATALOG])
+
+
+def mastery_sql_op(skill_expr: str) -> DbOp[str]:
+    # Student mastery for a skill, falling back to the skill prior, as one SQL expression.
+    # Expects %(student_id)s and %(default_prior)s parameters.
+    bkt_mapping = yield from table_mapping_op("bkt_state")
+    skill_mapping = yield from table_mapping_op("skills")
+    return mastery_sql(
+        skill_expr,
+        bkt_mapping.pick(("prior_skill_mastery", "prior_mastery", "mastery")),
+        skill_mapping.pick(("prior_mastery", "prior_skill_mastery", "prior")),
+    )
+
+
+@lru_cache(maxsize=32)
+def mastery_sql(skill_expr: str, mastery_col: Optional[str], prior_col: Optional[str]) -> str:
+    sources = []
+    if mastery_col:
+        sources.append(
+            f"(select b.{mastery_col} from public.bkt_state b "
+            f"where b.student_id = %(student_id)s and b.skill_name = {skill_expr} "
+            f"and b.{mastery_col} is not null limit 1)"
+        )
+    if prior_col:
+        sources.append(
+            f"(select s.{prior_col} from public.skills s "
+            f"where s.skill_name = {skill_expr} and s.{prior_col} is not null limit 1)"
         )
-        rows = cur.fetchall()
+    sources.append("%(default_prior)s")
+    return f"least(greatest(coalesce({', '.join(sources)})::float8, 0), 1)"
+
+
+def fetch_courses_op(student_id: str) -> DbOp[List[CourseItem]]:
+    mastery = yield from mastery_sql_op("c.target_skill")
+    rows = yield Query(
+        f"""
+        select c.id,
+               c.title,
+               c.module,
+               c.target_skill,
+               c.parent_id,
+               c.sequence,
+               e.progress,
+               e.status,
+               {mastery} as mastery
+        from public.enrollments e
+        join public.courses c on c.id = e.course_id
+        where e.student_id = %(student_id)s
+        order by c.sequence nulls last, c.title
+        """,
+        {"student_id": student_id, "default_prior": DEFAULT_PRIOR},
+        "all",
+        prepare=True,
+    )
     courses: List[CourseItem] = []
     for row in rows:
         status = row.get("status")
         progress = float(row.get("progress") or 0.0)
         target_skill = row.get("target_skill")
         if status != "Locked":
-            computed = fetch_mastery(conn, student_id, target_skill, DEFAULT_PRIOR)
+            computed = float(row.get("mastery") if target_skill else DEFAULT_PRIOR)
             progress = computed
             if computed >= COURSE_UNLOCK_THRESHOLD:
                 status = "Completed"
@@ -396,158 +602,134 @@ def fetch_courses_db(conn: psycopg.Connection, student_id: str) -> List[CourseIt
     return courses
 
 
-def fetch_mastery(
-    conn: psycopg.Connection,
-    student_id: str,
-    skill_name: Optional[str],
-    default_prior: float,
-) -> float:
-    if not skill_name:
-        return default_prior
-    columns = get_table_columns(conn, "bkt_state")
-    mastery_col = pick_column(columns, ("prior_skill_mastery", "prior_mastery", "mastery"))
-    if not mastery_col:
-        return fetch_skill_prior(conn, skill_name, default_prior)
-    with conn.cursor() as cur:
-        cur.execute(
-            f"select {mastery_col} from public.bkt_state where student_id = %s and skill_name = %s limit 1",
-            (student_id, skill_name),
-        )
-        row = cur.fetchone()
-    if row and row.get(mastery_col) is not None:
-        return clamp_mastery(row.get(mastery_col))
-    return fetch_skill_prior(conn, skill_name, default_prior)
-
-
-def update_enrollment_progress(conn: psycopg.Connection, student_id: str) -> None:
-    with conn.cursor() as cur:
-        cur.execute(
-            """
-            select e.course_id, e.status, c.target_skill, c.parent_id
-            from public.enrollments e
-            join public.courses c on c.id = e.course_id
-            where e.student_id = %s
-            """,
-            (student_id,),
-        )
-        rows = cur.fetchall()
-
-    for row in rows:
-        status = row.get("status")
-        if status == "Locked":
-            continue
-        course_id = row.get("course_id")
-        target_skill = row.get("target_skill")
-        mastery = fetch_mastery(conn, student_id, target_skill, DEFAULT_PRIOR)
-        progress = clamp_mastery(mastery)
-        next_status = status
-        if progress >= COURSE_UNLOCK_THRESHOLD:
-            next_status = "Completed"
-        elif status in (None, "", "Assigned") and progress > 0:
-            next_status = "In Progress"
-        payload = {
+def update_enrollment_progress_op(
+    student_id: str, course_ids: Optional[List[str]] = None
+) -> DbOp[None]:
+    mastery = yield from mastery_sql_op("c.target_skill")
+    yield Query(
+        f"""
+        update public.enrollments e
+        set progress = m.mastery,
+            status = case
+                when m.mastery >= %(threshold)s then 'Completed'
+                when coalesce(e.status, '') in ('', 'Assigned') and m.mastery > 0
+                    then 'In Progress'
+                else e.status
+            end
+        from (
+            select c.id as course_id,
+                   case when c.target_skill is null then %(default_prior)s::float8
+                        else {mastery} end as mastery
+            from public.courses c
+        ) m
+        where e.student_id = %(student_id)s
+          and e.course_id = m.course_id
+          and e.status is distinct from 'Locked'
+          and (%(course_ids)s::text[] is null or e.course_id = any(%(course_ids)s::text[]))
+        """,
+        {
             "student_id": student_id,
-            "course_id": course_id,
-            "progress": progress,
-            "status": next_status,
-        }
-        update_record(conn, "enrollments", payload, ("student_id", "course_id"))
-
+            "course_ids": course_ids,
+            "default_prior": DEFAULT_PRIOR,
+            "threshold": COURSE_UNLOCK_THRESHOLD,
+        },
+        prepare=True,
+    )
 
-def unlock_courses_for_student(conn: psycopg.Connection, student_id: str) -> None:
-    with conn.cursor() as cur:
-        cur.execute(
-            """
-            select e.course_id, e.status, parent.target_skill as parent_skill
-            from public.enrollments e
-            join public.courses c on c.id = e.course_id
-            join public.courses parent on parent.id = c.parent_id
-            where e.student_id = %s and c.parent_id is not null
-            """,
-            (student_id,),
-        )
-        rows = cur.fetchall()
 
-    for row in rows:
-        if row.get("status") != "Locked":
-            continue
-        parent_skill = row.get("parent_skill")
-        mastery = fetch_mastery(conn, student_id, parent_skill, DEFAULT_PRIOR)
-        if mastery >= COURSE_UNLOCK_THRESHOLD:
-            payload = {
-                "student_id": student_id,
-                "course_id": row.get("course_id"),
-                "status": "Assigned",
-            }
-            update_record(conn, "enrollments", payload, ("student_id", "course_id"))
+def unlock_courses_op(student_id: str, course_ids: Optional[List[str]] = None) -> DbOp[None]:
+    mastery = yield from mastery_sql_op("parent.target_skill")
+    yield Query(
+        f"""
+        update public.enrollments e
+        set status = 'Assigned'
+        from public.courses c
+        join public.courses parent on parent.id = c.parent_id
+        where e.course_id = c.id
+          and e.student_id = %(student_id)s
+          and e.status = 'Locked'
+          and (%(course_ids)s::text[] is null or e.course_id = any(%(course_ids)s::text[]))
+          and case when parent.target_skill is null then %(default_prior)s::float8
+                   else {mastery} end >= %(threshold)s
+        """,
+        {
+            "student_id": student_id,
+            "course_ids": course_ids,
+            "default_prior": DEFAULT_PRIOR,
+            "threshold": COURSE_UNLOCK_THRESHOLD,
+        },
+        prepare=True,
+    )
 
 
-def ensure_assignments_for_student(conn: psycopg.Connection, student_id: str) -> None:
-    with conn.cursor() as cur:
-        cur.execute(
-            """
-            select e.course_id, e.status, e.progress, c.title, c.target_skill
-            from public.enrollments e
-            join public.courses c on c.id = e.course_id
-            where e.student_id = %s and e.status != 'Locked'
-            """,
-            (student_id,),
+def ensure_assignments_op(
+    student_id: str, course_ids: Optional[List[str]] = None
+) -> DbOp[None]:
+    configs = [
+        (course["id"], course.get("assignment", {})) for course in COURSE_CATALOG
+    ]
+    yield Query(
+        """
+        insert into public.assignments (
+            id, student_id, course_id, title, assignment_type, skill_name,
+            problem_count, completion_rate, status, created_at
         )
-        rows = cur.fetchall()
-
-    now = datetime.now(timezone.utc)
-    for row in rows:
-        course_id = row.get("course_id")
-        course = COURSE_BY_ID.get(course_id, {})
-        assignment_config = course.get("assignment", {})
-        title = assignment_config.get("name") or f"{row.get('title')} Practice"
-        assignment_payload = {
+        select gen_random_uuid()::text,
+               e.student_id,
+               e.course_id,
+               coalesce(cfg.name, c.title || ' Practice'),
+               coalesce(cfg.assignment_type, 'Practice'),
+               c.target_skill,
+               coalesce(cfg.problem_count, 10),
+               least(greatest(coalesce(e.progress, 0), 0), 1),
+               e.status,
+               now()
+        from public.enrollments e
+        join public.courses c on c.id = e.course_id
+        left join unnest(
+            %(course_ids)s::text[], %(names)s::text[], %(types)s::text[], %(counts)s::int[]
+        ) as cfg(course_id, name, assignment_type, problem_count)
+            on cfg.course_id = e.course_id
+        where e.student_id = %(student_id)s
+          and e.status != 'Locked'
+          and (%(filter_ids)s::text[] is null or e.course_id = any(%(filter_ids)s::text[]))
+        on conflict (student_id, course_id) do update set
+            title = excluded.title,
+            assignment_type = excluded.assignment_type,
+            skill_name = excluded.skill_name,
+            problem_count = excluded.problem_count,
+            completion_rate = excluded.completion_rate,
+            status = excluded.status
+        """,
+        {
             "student_id": student_id,
-            "course_id": course_id,
-            "title": title,
-            "assignment_type": assignment_config.get("assignment_type", "Practice"),
-            "skill_name": row.get("target_skill"),
-            "problem_count": assignment_config.get("problem_count", 10),
-            "completion_rate": clamp_mastery(row.get("progress")),
-            "status": row.get("status"),
-        }
-        with conn.cursor() as cur:
-            cur.execute(
-                """
-                select id from public.assignments
-                where student_id = %s and course_id = %s
-                limit 1
-                """,
-                (student_id, course_id),
-            )
-            existing = cur.fetchone()
-        if existing:
-            update_record(conn, "assignments", assignment_payload, ("student_id", "course_id"))
-            continue
-        assignment_payload["id"] = str(uuid.uuid4())
-        assignment_payload["created_at"] = now
-        insert_record(conn, "assignments", assignment_payload)
+            "filter_ids": course_ids,
+            "course_ids": [course_id for course_id, _ in configs],
+            "names": [config.get("name") for _, config in configs],
+            "types": [config.get("assignment_type") for _, config in configs],
+            "counts": [config.get("problem_count") for _, config in configs],
+        },
+    )
 
 
-def fetch_assignments_db(conn: psycopg.Connection, student_id: str) -> List[AssignmentItem]:
-    with conn.cursor() as cur:
-        cur.execute(
-            """
-            select a.id,
-                   a.title,
-                   a.assignment_type,
-                   a.skill_name,
-                   a.problem_count,
-                   a.completion_rate,
-                   a.status,
-                   a.created_at
-            from public.assignments a
-            where a.student_id = %s
-            order by a.created_at desc
-            """,
-            (student_id,),
-        )
-        rows = cur.fetchall()
+def fetch_assignments_op(student_id: str) -> DbOp[List[AssignmentItem]]:
+    rows = yield Query(
+        """
+        select a.id,
+               a.title,
+               a.assignment_type,
+               a.skill_name,
+               a.problem_count,
+               a.completion_rate,
+               a.status,
+               a.created_at
+        from public.assignments a
+        where a.student_id = %s
+        order by a.created_at desc
+        """,
+        (student_id,),
+        "all",
+    )
 
     assignments: List[AssignmentItem] = []
     for row in rows:
@@ -572,402 +754,1226 @@ def fetch_assignments_db(conn: psycopg.Connection, student_id: str) -> List[Assi
     return assignments
 
 
-def sync_learning_path(conn: psycopg.Connection, student_id: str) -> None:
-    ensure_courses_schema(conn)
-    seed_courses_for_student(conn, student_id)
-    update_enrollment_progress(conn, student_id)
-    unlock_courses_for_student(conn, student_id)
-    ensure_assignments_for_student(conn, student_id)
+def sync_learning_path_op(student_id: str, skill_name: Optional[str] = None) -> DbOp[None]:
+    yield from sync_skills_op(student_id, None if skill_name is None else [skill_name])
+
+
+def sync_skills_op(student_id: str, skill_names: Optional[Iterable[str]]) -> DbOp[None]:
+    # With skills, only courses targeting them and their children can change,
+    # so the catalog reseed and untouched enrollments are skipped.
+    if skill_names is None:
+        yield from seed_courses_for_student_op(student_id)
+        course_ids = None
+    else:
+        course_ids = list(
+            dict.fromkeys(
+                course_id
+                for skill_name in skill_names
+                for course_id in courses_affected_by_skill(skill_name)
+            )
+        )
+        if not course_ids:
+            return
+        yield from seed_enrollments_op(student_id, course_ids)
+    yield from update_enrollment_progress_op(student_id, course_ids)
+    yield from unlock_courses_op(student_id, course_ids)
+    yield from ensure_assignments_op(student_id, course_ids)
+
+
+def sync_learning_path(
+    conn: psycopg.Connection, student_id: str, skill_name: Optional[str] = None
+) -> None:
+    run_op(conn, sync_learning_path_op(student_id, skill_name))
+
+
+def insert_record_op(
+    table: str, payload: Dict[str, Any], ignore_conflicts: bool = False
+) -> DbOp[None]:
+    mapping = yield from table_mapping_op(table)
+    columns = tuple(col for col in payload if col in mapping.columns)
+    if not columns:
+        return
+    yield Query(
+        insert_sql(table, columns, ignore_conflicts),
+        [payload[col] for col in columns],
+        prepare=True,
+    )
 
 
-def insert_record(conn: psycopg.Connection, table: str, payload: Dict[str, Any]) -> None:
-    data = filter_payload_for_table(conn, table, payload)
-    if not data:
+def insert_rows_op(
+    table: str,
+    rows: List[Dict[str, Any]],
+    column_types: Dict[str, str],
+    ignore_conflicts: bool = False,
+) -> DbOp[None]:
+    # Many rows in one statement: each column travels as a typed array.
+    if not rows:
         return
-    columns = list(data.keys())
-    values = [data[col] for col in columns]
-    placeholders = ", ".join(["%s"] * len(columns))
-    query = f"insert into public.{table} ({', '.join(columns)}) values ({placeholders})"
-    with conn.cursor() as cur:
-        cur.execute(query, values)
+    mapping = yield from table_mapping_op(table)
+    typed = tuple((col, sql_type) for col, sql_type in column_types.items() if col in mapping.columns)
+    yield Query(
+        unnest_insert_sql(table, typed, ignore_conflicts),
+        [[row.get(col) for row in rows] for col, _ in typed],
+        prepare=True,
+    )
 
 
-def update_record(
-    conn: psycopg.Connection,
+def update_rows_op(
+    table: str,
+    rows: List[Dict[str, Any]],
+    column_types: Dict[str, str],
+    where_cols: Tuple[str, str],
+) -> DbOp[None]:
+    if not rows:
+        return
+    mapping = yield from table_mapping_op(table)
+    typed = tuple(
+        (col, sql_type)
+        for col, sql_type in column_types.items()
+        if col in mapping.columns or col in where_cols
+    )
+    yield Query(
+        unnest_update_sql(table, typed, tuple(where_cols)),
+        [[row.get(col) for row in rows] for col, _ in typed],
+        prepare=True,
+    )
+
+
+def update_record_op(
     table: str,
     payload: Dict[str, Any],
     where_cols: Tuple[str, str],
-) -> None:
-    data = filter_payload_for_table(conn, table, payload)
-    update_cols = [col for col in data if col not in where_cols]
+) -> DbOp[None]:
+    mapping = yield from table_mapping_op(table)
+    update_cols = tuple(col for col in payload if col in mapping.columns and col not in where_cols)
     if not update_cols:
         return
-    assignments = ", ".join([f"{col} = %s" for col in update_cols])
-    where_clause = " and ".join([f"{col} = %s" for col in where_cols])
-    values = [data[col] for col in update_cols] + [data[col] for col in where_cols]
-    query = f"update public.{table} set {assignments} where {where_clause}"
-    with conn.cursor() as cur:
-        cur.execute(query, values)
+    values = [payload[col] for col in update_cols] + [payload[col] for col in where_cols]
+    yield Query(update_sql(table, update_cols, tuple(where_cols)), values, prepare=True)
+
+
+def default_learner_record() -> LearnerRecord:
+    return LearnerRecord(DEFAULT_PRIOR, 0.0, 0, False, 0)
+
+
+def get_learner_record(student_id: str, skill_name: str) -> LearnerRecord:
+    record = MEMORY_STORE.get(student_id, skill_name)
+    if record is None:
+        record = default_learner_record()
+        MEMORY_STORE.put(student_id, skill_name, record)
+    return record
 
 
 def get_state_memory(student_id: str, skill_name: str) -> Dict[str, Any]:
-    key = (student_id, skill_name)
-    state = MEMORY_STATE.get(key)
-    if not state:
-        state = {
-            "prior_skill_mastery": DEFAULT_PRIOR,
-            "learning_velocity": 0.0,
-            "attempt_count": 0,
-        }
-        MEMORY_STATE[key] = state
-    return state
+    record = get_learner_record(student_id, skill_name)
+    return {
+        "prior_skill_mastery": record.mastery,
+        "learning_velocity": record.velocity,
+        "attempt_count": record.attempt_count,
+    }
 
 
 def get_intervention_state(student_id: str, skill_name: str) -> Dict[str, Any]:
-    key = (student_id, skill_name)
-    state = INTERVENTION_STATE.get(key)
-    if not state:
-        state = {"intervention_active": False, "recovery_streak": 0}
-        INTERVENTION_STATE[key] = state
-    return state
+    record = MEMORY_STORE.get(student_id, skill_name) or default_learner_record()
+    return {
+        "intervention_active": record.intervention_active,
+        "recovery_streak": record.recovery_streak,
+    }
 
 
-def get_state_db(student_id: str, skill_name: str) -> Dict[str, Any]:
-    conn = get_connection()
-    if not conn:
-        raise HTTPException(status_code=500, detail="SUPABASE_DB_URL not set")
+def set_intervention_state(student_id: str, skill_name: str, values: Dict[str, Any]) -> None:
+    record = MEMORY_STORE.get(student_id, skill_name) or default_learner_record()
+    MEMORY_STORE.put(
+        student_id,
+        skill_name,
+        record._replace(
+            intervention_active=bool(values["intervention_active"]),
+            recovery_streak=int(values["recovery_streak"]),
+        ),
+    )
 
-    try:
-        with conn:
-            ensure_student(conn, student_id)
-            columns = get_table_columns(conn, "bkt_state")
-            mastery_col = pick_column(columns, ("prior_skill_mastery", "prior_mastery", "mastery"))
-            attempt_col = pick_column(columns, ("attempt_count", "attempts"))
-            velocity_col = pick_column(columns, ("learning_velocity", "velocity"))
-            if not mastery_col:
-                raise HTTPException(status_code=500, detail="bkt_state missing mastery column")
-
-            with conn.cursor() as cur:
-                cur.execute(
-                    "select * from public.bkt_state where student_id = %s and skill_name = %s limit 1",
-                    (student_id, skill_name),
-                )
-                row = cur.fetchone()
 
-            if row:
-                return {
-                    "prior_skill_mastery": float(row.get(mastery_col) or DEFAULT_PRIOR),
-                    "learning_velocity": float(row.get(velocity_col) or 0.0) if velocity_col else 0.0,
-                    "attempt_count": int(row.get(attempt_col) or 0) if attempt_col else 0,
-                }
+class BktLayout(NamedTuple):
+    columns: Set[str]
+    mastery: str
+    attempts: Optional[str]
+    velocity: Optional[str]
+    # Intervention columns (migration 4); when absent the state stays in-process.
+    active: Optional[str]
+    streak: Optional[str]
+
+    @property
+    def persists_intervention(self) -> bool:
+        return bool(self.active and self.streak)
+
+    @property
+    def canonical(self) -> bool:
+        # The column names public.bkt_record_answer (migration 5) is written against.
+        return (
+            self.mastery == "prior_skill_mastery"
+            and self.attempts == "attempt_count"
+            and self.velocity == "learning_velocity"
+            and self.active == "intervention_active"
+            and self.streak == "recovery_streak"
+            and "updated_at" in self.columns
+        )
 
-            prior = fetch_skill_prior(conn, skill_name, DEFAULT_PRIOR)
-            now = datetime.now(timezone.utc)
-            insert_payload = {
-                "student_id": student_id,
-                "skill_name": skill_name,
-                mastery_col: prior,
-            }
-            if attempt_col:
-                insert_payload[attempt_col] = 0
-            if velocity_col:
-                insert_payload[velocity_col] = 0.0
-            if "created_at" in columns:
-                insert_payload["created_at"] = now
-            if "updated_at" in columns:
-                insert_payload["updated_at"] = now
 
-            insert_record(conn, "bkt_state", insert_payload)
+@lru_cache(maxsize=8)
+def bkt_layout(mapping: TableMapping) -> Optional[BktLayout]:
+    # Resolved once per schema version of bkt_state, not per request.
+    mastery_col = mapping.pick(("prior_skill_mastery", "prior_mastery", "mastery"))
+    if not mastery_col:
+        return None
+    return BktLayout(
+        mapping.columns,
+        mastery_col,
+        mapping.pick(("attempt_count", "attempts")),
+        mapping.pick(("learning_velocity", "velocity")),
+        mapping.pick(("intervention_active",)),
+        mapping.pick(("recovery_streak",)),
+    )
+
+
+def bkt_layout_op() -> DbOp[BktLayout]:
+    mapping = yield from table_mapping_op("bkt_state")
+    layout = bkt_layout(mapping)
+    if layout is None:
+        raise HTTPException(status_code=500, detail="bkt_state missing mastery column")
+    return layout
+
+
+def row_intervention(layout: BktLayout, row: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    if not row:
+        return {"intervention_active": False, "recovery_streak": 0}
+    return {
+        "intervention_active": bool(row.get(layout.active)),
+        "recovery_streak": int(row.get(layout.streak) or 0),
+    }
 
+
+def initial_state_row(
+    layout: BktLayout, student_id: str, skill_name: str, prior: float, now: datetime
+) -> Dict[str, Any]:
+    # Insert helpers drop any column the table does not have.
+    values: Dict[str, Any] = {"student_id": student_id, "skill_name": skill_name, layout.mastery: prior}
+    if layout.attempts:
+        values[layout.attempts] = 0
+    if layout.velocity:
+        values[layout.velocity] = 0.0
+    if layout.persists_intervention:
+        values[layout.active] = False
+        values[layout.streak] = 0
+    values["created_at"] = values["updated_at"] = now
+    return values
+
+
+def get_state_op(student_id: str, skill_name: str) -> DbOp[Dict[str, Any]]:
+    # Includes the intervention fields only when bkt_state persists them.
+    yield from ensure_student_op(student_id)
+    layout = yield from bkt_layout_op()
+    mastery_col, attempt_col, velocity_col = layout.mastery, layout.attempts, layout.velocity
+    row = yield Query(
+        "select * from public.bkt_state where student_id = %s and skill_name = %s limit 1",
+        (student_id, skill_name),
+        "one",
+        prepare=True,
+    )
+    intervention = row_intervention(layout, row) if layout.persists_intervention else {}
+
+    if row:
         return {
-            "prior_skill_mastery": float(prior),
-            "learning_velocity": 0.0,
-            "attempt_count": 0,
+            "prior_skill_mastery": float(row.get(mastery_col) or DEFAULT_PRIOR),
+            "learning_velocity": float(row.get(velocity_col) or 0.0) if velocity_col else 0.0,
+            "attempt_count": int(row.get(attempt_col) or 0) if attempt_col else 0,
+            **intervention,
         }
-    except psycopg.Error as exc:
-        raise HTTPException(status_code=500, detail=f"Database error: {exc}")
 
+    prior = yield from skill_prior_op(skill_name)
+    now = datetime.now(timezone.utc)
+    # A concurrent first answer may have created the row already.
+    yield from insert_record_op(
+        "bkt_state", initial_state_row(layout, student_id, skill_name, prior, now), ignore_conflicts=True
+    )
+    return {
+        "prior_skill_mastery": float(prior),
+        "learning_velocity": 0.0,
+        "attempt_count": 0,
+        **intervention,
+    }
 
-def update_state_memory(payload: AnswerPayload) -> Dict[str, Any]:
-    state = get_state_memory(payload.student_id, payload.skill_name)
-    prior = state["prior_skill_mastery"]
-    intervention = get_intervention_state(payload.student_id, payload.skill_name)
-    active_before = intervention["intervention_active"]
-    trigger_now = payload.attempt_count > 3
-    active_for_update = active_before or trigger_now
 
-    if active_for_update:
-        next_mastery = prior
-    else:
-        next_mastery = update_mastery(prior, payload.correct, **DEFAULT_BKT_PARAMS)
-        if next_mastery >= MASTERY_SNAP_THRESHOLD:
-            next_mastery = 1.0
-    velocity = next_mastery - prior
+def snapshot_skills(skill_names: Optional[List[str]], recorded: Iterable[str]) -> List[str]:
+    # The requested skills in order, or the catalog skills followed by any
+    # other skill the student has state for.
+    if skill_names is not None:
+        return list(dict.fromkeys(skill_names))
+    extra = sorted(set(recorded).difference(CATALOG_SKILLS))
+    return [*CATALOG_SKILLS, *extra]
+
+
+def get_states_op(
+    student_id: str, skill_names: Optional[List[str]] = None
+) -> DbOp[List[Dict[str, Any]]]:
+    # Pure read: pairs without a row are filled from the cached skill priors.
+    layout = yield from bkt_layout_op()
+    rows = yield Query(
+        """
+        select * from public.bkt_state
+        where student_id = %(student_id)s
+          and (%(skills)s::text[] is null or skill_name = any(%(skills)s::text[]))
+        """,
+        {"student_id": student_id, "skills": skill_names},
+        "all",
+        prepare=True,
+    )
+    by_skill: Dict[str, Dict[str, Any]] = {}
+    for row in rows:
+        by_skill.setdefault(row["skill_name"], row)
+    if not skill_table_loaded():
+        yield from skill_table_op()
+
+    states = []
+    for skill_name in snapshot_skills(skill_names, by_skill):
+        row = by_skill.get(skill_name)
+        if row is None:
+            states.append(
+                {
+                    "skill_name": skill_name,
+                    "prior_skill_mastery": cached_skill_prior(skill_name, DEFAULT_PRIOR),
+                    "learning_velocity": 0.0,
+                    "attempt_count": 0,
+                }
+            )
+            continue
+        state = {
+            "skill_name": skill_name,
+            "prior_skill_mastery": float(row.get(layout.mastery) or DEFAULT_PRIOR),
+            "learning_velocity": float(row.get(layout.velocity) or 0.0) if layout.velocity else 0.0,
+            "attempt_count": int(row.get(layout.attempts) or 0) if layout.attempts else 0,
+        }
+        if layout.persists_intervention:
+            state.update(row_intervention(layout, row))
+        states.append(state)
+    return states
+
+
+def get_states_memory(
+    student_id: str, skill_names: Optional[List[str]] = None
+) -> List[Dict[str, Any]]:
+    records = MEMORY_STORE.student_records(student_id)
+    states = []
+    for skill_name in snapshot_skills(skill_names, records):
+        record = records.get(skill_name) or default_learner_record()
+        states.append(
+            {
+                "skill_name": skill_name,
+                "prior_skill_mastery": record.mastery,
+                "learning_velocity": record.velocity,
+                "attempt_count": record.attempt_count,
+                "intervention_active": record.intervention_active,
+                "recovery_streak": record.recovery_streak,
+            }
+        )
+    return states
+
+
+def attempt_row(payload: AnswerPayload) -> Dict[str, Any]:
+    return {
+        "student_id": payload.student_id,
+        "skill_name": payload.skill_name,
+        "answer": payload.answer,
+        "attempt_count": payload.attempt_count,
+        "time_on_task": payload.time_on_task,
+        "hints_used": payload.hints_used,
+        "correct": payload.correct,
+        "created_at": datetime.now(timezone.utc),
+    }
+
 
-    if trigger_now and not active_before:
-        intervention["intervention_active"] = True
-        intervention["recovery_streak"] = 0
-    elif active_before:
-        hints_used = payload.hints_used
-        used_max_hints = (
-            hints_used is not None and hints_used >= MAX_HINTS_PER_QUESTION
+# schema_generation() -> whether public.bkt_record_answer exists.
+_BKT_RECORD_FUNCTION: Dict[int, bool] = {}
+
+
+def bkt_record_function_op() -> DbOp[bool]:
+    generation = schema_generation()
+    if generation not in _BKT_RECORD_FUNCTION:
+        row = yield Query(
+            """
+            select to_regprocedure(
+                'public.bkt_record_answer(text, text, boolean, int, int, text, int, '
+                'double precision, double precision, double precision, double precision, '
+                'double precision, int, boolean)'
+            ) is not null as present
+            """,
+            None,
+            "one",
+        )
+        _BKT_RECORD_FUNCTION.clear()
+        _BKT_RECORD_FUNCTION[generation] = bool(row and row["present"])
+    return _BKT_RECORD_FUNCTION[generation]
+
+
+def record_answer_op(
+    payload: AnswerPayload, write_attempt: bool
+) -> DbOp[Tuple[Dict[str, Any], Dict[str, Any]]]:
+    # Student, bkt_state row, BKT/intervention update and attempt in one
+    # statement; the row lock inside the function serializes racing answers.
+    attempt_columns = yield from table_columns_op("attempts")
+    attempt_in_call = write_attempt and set(ATTEMPT_COLUMNS) <= attempt_columns
+    prior = yield from skill_prior_op(payload.skill_name)
+    params = skill_bkt_params(payload.skill_name)
+    row = yield Query(
+        "select * from public.bkt_record_answer(%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)",
+        (
+            payload.student_id,
+            payload.skill_name,
+            payload.correct,
+            payload.attempt_count,
+            payload.hints_used,
+            payload.answer,
+            payload.time_on_task,
+            prior,
+            params["guess"],
+            params["slip"],
+            params["transit"],
+            MASTERY_SNAP_THRESHOLD,
+            MAX_HINTS_PER_QUESTION,
+            attempt_in_call,
+        ),
+        "one",
+        prepare=True,
+    )
+    if write_attempt and not attempt_in_call:
+        yield from insert_record_op("attempts", attempt_row(payload))
+    # A brand-new student has no enrollments yet, so give them the full sync.
+    yield from sync_learning_path_op(
+        payload.student_id, None if row["student_created"] else payload.skill_name
+    )
+    next_intervention = {
+        "intervention_active": bool(row["intervention_active"]),
+        "recovery_streak": int(row["recovery_streak"]),
+    }
+    state = {
+        "prior_skill_mastery": float(row["prior_skill_mastery"]),
+        "learning_velocity": float(row["learning_velocity"]),
+        "attempt_count": int(row["attempt_count"]),
+        **next_intervention,
+    }
+    return state, next_intervention
+
+
+def update_state_op(
+    payload: AnswerPayload, intervention: Dict[str, Any], write_attempt: bool = True
+) -> DbOp[Tuple[Dict[str, Any], Dict[str, Any]]]:
+    # `intervention` is the in-process fallback for schemas without the
+    # intervention columns; otherwise the row is the source of truth.
+    # With write_attempt off the caller hands the attempt to the write-behind log.
+    layout = yield from bkt_layout_op()
+    if BKT_ATOMIC_UPDATE and layout.canonical:
+        if (yield from bkt_record_function_op()):
+            return (yield from record_answer_op(payload, write_attempt))
+    created = yield from ensure_student_op(payload.student_id)
+    columns = layout.columns
+    mastery_col, attempt_col, velocity_col = layout.mastery, layout.attempts, layout.velocity
+    # The row lock serializes concurrent answers for the pair across workers.
+    lock_sql = "select * from public.bkt_state where student_id = %s and skill_name = %s limit 1 for update"
+    key = (payload.student_id, payload.skill_name)
+    row = yield Query(lock_sql, key, "one", prepare=True)
+    prior = yield from skill_prior_op(payload.skill_name)
+    if not row:
+        # Nothing to lock yet: create the row at the prior, yielding to a
+        # concurrent first answer, then lock whichever row won.
+        now = datetime.now(timezone.utc)
+        yield from insert_record_op(
+            "bkt_state", initial_state_row(layout, *key, prior, now), ignore_conflicts=True
         )
-        if payload.correct and not used_max_hints:
-            intervention["recovery_streak"] += 1
+        row = yield Query(lock_sql, key, "one", prepare=True)
+    if layout.persists_intervention:
+        intervention = row_intervention(layout, row)
+
+    if row:
+        prior = float(row.get(mastery_col) or DEFAULT_PRIOR)
+
+    next_mastery, next_intervention = advance_learner_state(
+        prior,
+        payload.correct,
+        payload.attempt_count,
+        payload.hints_used,
+        intervention,
+        skill_bkt_params(payload.skill_name),
+    )
+    velocity = next_mastery - prior
+    next_attempt = payload.attempt_count
+    now = datetime.now(timezone.utc)
+
+    update_payload = {
+        "student_id": payload.student_id,
+        "skill_name": payload.skill_name,
+        mastery_col: next_mastery,
+    }
+    if attempt_col:
+        update_payload[attempt_col] = next_attempt
+    if velocity_col:
+        update_payload[velocity_col] = velocity
+    if layout.persists_intervention:
+        update_payload[layout.active] = next_intervention["intervention_active"]
+        update_payload[layout.streak] = next_intervention["recovery_streak"]
+    if "updated_at" in columns:
+        update_payload["updated_at"] = now
+    yield from update_record_op("bkt_state", update_payload, ("student_id", "skill_name"))
+    if write_attempt:
+        yield from insert_record_op("attempts", {**attempt_row(payload), "created_at": now})
+    # A brand-new student has no enrollments yet, so give them the full sync.
+    yield from sync_learning_path_op(payload.student_id, None if created else payload.skill_name)
+
+    state = {
+        "prior_skill_mastery": float(next_mastery),
+        "learning_velocity": float(velocity),
+        "attempt_count": int(next_attempt),
+    }
+    if layout.persists_intervention:
+        state.update(next_intervention)
+    return state, next_intervention
+
+
+PairKey = Tuple[str, str]
+
+
+def bkt_column_types(layout: BktLayout) -> Dict[str, str]:
+    types = {"student_id": "text", "skill_name": "text", layout.mastery: "float8"}
+    if layout.attempts:
+        types[layout.attempts] = "int"
+    if layout.velocity:
+        types[layout.velocity] = "float8"
+    if layout.persists_intervention:
+        types[layout.active] = "bool"
+        types[layout.streak] = "int"
+    return types
+
+
+def update_states_batch_op(
+    payloads: List[AnswerPayload],
+    fallback: Dict[PairKey, Dict[str, Any]],
+    attempt_rows: Optional[List[Dict[str, Any]]],
+) -> DbOp[Tuple[List[Dict[str, Any]], Dict[PairKey, Dict[str, Any]], bool]]:
+    # Answers are applied in order in memory, then every touched bkt_state row
+    # is written with one bulk update. `fallback` and the returned
+    # interventions matter only when bkt_state lacks those columns;
+    # attempt_rows is None when the write-behind log takes the attempts.
+    created = yield from ensure_students_op(payload.student_id for payload in payloads)
+    layout = yield from bkt_layout_op()
+    pairs = sorted({(payload.student_id, payload.skill_name) for payload in payloads})
+    # Missing pairs are created at their prior first, yielding to any
+    # concurrent answer that creates them, so every pair has a row to lock.
+    # Both steps go in key order, which keeps overlapping batches from
+    # deadlocking.
+    now = datetime.now(timezone.utc)
+    seeds = []
+    for student_id, skill_name in pairs:
+        prior = yield from skill_prior_op(skill_name)
+        seeds.append(initial_state_row(layout, student_id, skill_name, prior, now))
+    yield from insert_rows_op(
+        "bkt_state",
+        seeds,
+        {**bkt_column_types(layout), "created_at": "timestamptz", "updated_at": "timestamptz"},
+        ignore_conflicts=True,
+    )
+    rows = yield Query(
+        """
+        select b.* from public.bkt_state b
+        join unnest(%s::text[], %s::text[]) as k(student_id, skill_name)
+          on b.student_id = k.student_id and b.skill_name = k.skill_name
+        order by b.student_id, b.skill_name
+        for update of b
+        """,
+        ([pair[0] for pair in pairs], [pair[1] for pair in pairs]),
+        "all",
+        prepare=True,
+    )
+    existing: Dict[PairKey, Dict[str, Any]] = {}
+    for row in rows:
+        existing.setdefault((row["student_id"], row["skill_name"]), row)
+
+    states: Dict[PairKey, Dict[str, Any]] = {}
+    for key in pairs:
+        row = existing.get(key)
+        if row:
+            mastery = float(row.get(layout.mastery) or DEFAULT_PRIOR)
+        else:
+            mastery = yield from skill_prior_op(key[1])
+        if layout.persists_intervention:
+            intervention = row_intervention(layout, row)
         else:
-            intervention["recovery_streak"] = 0
-        if intervention["recovery_streak"] >= 3:
-            intervention["intervention_active"] = False
-            intervention["recovery_streak"] = 0
+            intervention = fallback[key]
+        states[key] = {"mastery": mastery, "velocity": 0.0, "attempts": 0, "intervention": intervention}
+
+    snapshots: List[Dict[str, Any]] = []
+    for payload in payloads:
+        state = states[(payload.student_id, payload.skill_name)]
+        prior = state["mastery"]
+        next_mastery, next_intervention = advance_learner_state(
+            prior,
+            payload.correct,
+            payload.attempt_count,
+            payload.hints_used,
+            state["intervention"],
+            skill_bkt_params(payload.skill_name),
+        )
+        state.update(
+            mastery=next_mastery,
+            velocity=next_mastery - prior,
+            attempts=payload.attempt_count,
+            intervention=next_intervention,
+        )
+        snapshots.append(
+            {
+                "prior_skill_mastery": float(next_mastery),
+                "learning_velocity": float(next_mastery - prior),
+                "attempt_count": int(payload.attempt_count),
+                **next_intervention,
+            }
+        )
 
-    state.update(
-        {
-            "prior_skill_mastery": next_mastery,
-            "learning_velocity": velocity,
-            "attempt_count": payload.attempt_count,
-        }
+    now = datetime.now(timezone.utc)
+    column_types = bkt_column_types(layout)
+    updates: List[Dict[str, Any]] = []
+    for key, state in states.items():
+        values = {"student_id": key[0], "skill_name": key[1], layout.mastery: state["mastery"]}
+        if layout.attempts:
+            values[layout.attempts] = state["attempts"]
+        if layout.velocity:
+            values[layout.velocity] = state["velocity"]
+        if layout.persists_intervention:
+            values[layout.active] = bool(state["intervention"]["intervention_active"])
+            values[layout.streak] = int(state["intervention"]["recovery_streak"])
+        values["updated_at"] = now
+        updates.append(values)
+    yield from update_rows_op(
+        "bkt_state",
+        updates,
+        {**column_types, "updated_at": "timestamptz"},
+        ("student_id", "skill_name"),
+    )
+    if attempt_rows is not None:
+        yield from insert_rows_op("attempts", attempt_rows, ATTEMPT_COLUMN_TYPES)
+
+    skills_by_student: Dict[str, List[str]] = {}
+    for student_id, skill_name in pairs:
+        skills_by_student.setdefault(student_id, []).append(skill_name)
+    for student_id, skill_names in skills_by_student.items():
+        # New students get the full sync, as in the single-answer path.
+        yield from sync_skills_op(student_id, None if student_id in created else skill_names)
+
+    finals = {key: state["intervention"] for key, state in states.items()}
+    return snapshots, finals, layout.persists_intervention
+
+
+def seed_student_op(student_id: str) -> DbOp[None]:
+    yield from ensure_student_op(student_id)
+    yield from sync_learning_path_op(student_id)
+
+
+def backfill_learning_paths_op() -> DbOp[int]:
+    # Reads no longer sync, so students missing a catalog course (new in
+    # this deploy) are brought up to date once at startup.
+    mapping = yield from table_mapping_op("students")
+    if "student_id" not in mapping.columns:
+        return 0
+    rows = yield Query(
+        """
+        select s.student_id
+        from public.students s
+        cross join unnest(%s::text[]) as c(id)
+        where not exists (
+            select 1 from public.enrollments e
+            where e.student_id = s.student_id and e.course_id = c.id
+        )
+        group by s.student_id
+        """,
+        ([course["id"] for course in COURSE_CATALOG],),
+        "all",
     )
-    return {**state, **intervention}
+    for row in rows:
+        yield from sync_learning_path_op(row["student_id"])
+    return len(rows)
 
 
-def update_state_db(payload: AnswerPayload) -> Dict[str, Any]:
-    conn = get_connection()
-    if not conn:
-        raise HTTPException(status_code=500, detail="SUPABASE_DB_URL not set")
+def backfill_learning_paths(conn: psycopg.Connection) -> None:
+    backfilled = run_op(conn, backfill_learning_paths_op())
+    if backfilled:
+        logger.info("learning_path.backfilled", extra={"students": backfilled})
 
-    try:
-        with conn:
-            ensure_student(conn, payload.student_id)
-            columns = get_table_columns(conn, "bkt_state")
-            mastery_col = pick_column(columns, ("prior_skill_mastery", "prior_mastery", "mastery"))
-            attempt_col = pick_column(columns, ("attempt_count", "attempts"))
-            velocity_col = pick_column(columns, ("learning_velocity", "velocity"))
-            if not mastery_col:
-                raise HTTPException(status_code=500, detail="bkt_state missing mastery column")
-
-            with conn.cursor() as cur:
-                cur.execute(
-                    "select * from public.bkt_state where student_id = %s and skill_name = %s limit 1",
-                    (payload.student_id, payload.skill_name),
-                )
-                row = cur.fetchone()
 
-            prior = float(row.get(mastery_col) or DEFAULT_PRIOR) if row else fetch_skill_prior(
-                conn, payload.skill_name, DEFAULT_PRIOR
-            )
+def courses_op(student_id: str) -> DbOp[List[CourseItem]]:
+    # Answers keep enrollments current, so this is a pure read except for a
+    # student seen for the first time, who is seeded once.
+    courses = yield from fetch_courses_op(student_id)
+    if not courses:
+        yield from seed_student_op(student_id)
+        courses = yield from fetch_courses_op(student_id)
+    return courses
 
-            intervention = get_intervention_state(payload.student_id, payload.skill_name)
-            active_before = intervention["intervention_active"]
-            trigger_now = payload.attempt_count > 3
-            active_for_update = active_before or trigger_now
 
-            if active_for_update:
-                next_mastery = prior
-            else:
-                next_mastery = update_mastery(prior, payload.correct, **DEFAULT_BKT_PARAMS)
-                if next_mastery >= MASTERY_SNAP_THRESHOLD:
-                    next_mastery = 1.0
-            velocity = next_mastery - prior
-            next_attempt = payload.attempt_count
-            now = datetime.now(timezone.utc)
-            attempt_payload = {
-                "student_id": payload.student_id,
-                "skill_name": payload.skill_name,
-                "answer": payload.answer,
-                "attempt_count": payload.attempt_count,
-                "time_on_task": payload.time_on_task,
-                "hints_used": payload.hints_used,
-                "correct": payload.correct,
-                "created_at": now,
-            }
+def view_stamp_op(student_id: str) -> DbOp[Any]:
+    # Every answer, on any worker, rewrites a bkt_state row of the student,
+    # so this moves whenever a cached view of theirs may have changed.
+    mapping = yield from table_mapping_op("bkt_state")
+    if "updated_at" not in mapping.columns:
+        return None
+    row = yield Query(
+        """
+        select max(updated_at) as updated_at, count(*) as pairs
+        from public.bkt_state
+        where student_id = %s
+        """,
+        (student_id,),
+        "one",
+        prepare=True,
+    )
+    return (row["updated_at"], row["pairs"])
 
-            if row:
-                update_payload = {
-                    "student_id": payload.student_id,
-                    "skill_name": payload.skill_name,
-                    mastery_col: next_mastery,
-                }
-                if attempt_col:
-                    update_payload[attempt_col] = next_attempt
-                if velocity_col:
-                    update_payload[velocity_col] = velocity
-                if "updated_at" in columns:
-                    update_payload["updated_at"] = now
-                update_record(conn, "bkt_state", update_payload, ("student_id", "skill_name"))
-            else:
-                insert_payload = {
-                    "student_id": payload.student_id,
-                    "skill_name": payload.skill_name,
-                    mastery_col: next_mastery,
-                }
-                if attempt_col:
-                    insert_payload[attempt_col] = next_attempt
-                if velocity_col:
-                    insert_payload[velocity_col] = velocity
-                if "created_at" in columns:
-                    insert_payload["created_at"] = now
-                if "updated_at" in columns:
-                    insert_payload["updated_at"] = now
-                insert_record(conn, "bkt_state", insert_payload)
-            insert_record(conn, "attempts", attempt_payload)
-            sync_learning_path(conn, payload.student_id)
-
-        if trigger_now and not active_before:
-            intervention["intervention_active"] = True
-            intervention["recovery_streak"] = 0
-        elif active_before:
-            hints_used = payload.hints_used
-            used_max_hints = (
-                hints_used is not None and hints_used >= MAX_HINTS_PER_QUESTION
-            )
-            if payload.correct and not used_max_hints:
-                intervention["recovery_streak"] += 1
-            else:
-                intervention["recovery_streak"] = 0
-            if intervention["recovery_streak"] >= 3:
-                intervention["intervention_active"] = False
-                intervention["recovery_streak"] = 0
 
-        return {
-            "prior_skill_mastery": float(next_mastery),
-            "learning_velocity": float(velocity),
-            "attempt_count": int(next_attempt),
-            "intervention_active": bool(intervention["intervention_active"]),
-            "recovery_streak": int(intervention["recovery_streak"]),
+def assignments_op(student_id: str) -> DbOp[List[AssignmentItem]]:
+    assignments = yield from fetch_assignments_op(student_id)
+    if not assignments:
+        yield from seed_student_op(student_id)
+        assignments = yield from fetch_assignments_op(student_id)
+    return assignments
+
+
+def assign_class_op(student_id: str, class_id: Optional[str]) -> DbOp[None]:
+    yield from ensure_student_op(student_id)
+    yield Query(
+        "update public.students set class_id = %s where student_id = %s",
+        (class_id, student_id),
+    )
+
+
+def cohort_op(
+    class_id: str, skill_name: Optional[str] = None, student_id: Optional[str] = None
+) -> DbOp[CohortResponse]:
+    # Everything comes from the running totals: O(skills x buckets), no scans.
+    rows = yield from cohort_rows_op(class_id, skill_name)
+    class_size = None
+    if class_id != ALL_STUDENTS:
+        row = yield Query(
+            "select count(*) as n from public.students where class_id = %s", (class_id,), "one"
+        )
+        class_size = int(row["n"]) if row else 0
+        if not rows and not class_size:
+            raise HTTPException(status_code=404, detail=f"Unknown class {class_id}")
+    student_mastery: Dict[str, float] = {}
+    if student_id:
+        layout = yield from bkt_layout_op()
+        mastery_rows = yield Query(
+            f"""
+            select skill_name, {layout.mastery} as mastery from public.bkt_state
+            where student_id = %(student_id)s
+              and (%(skill_name)s::text is null or skill_name = %(skill_name)s)
+            """,
+            {"student_id": student_id, "skill_name": skill_name},
+            "all",
+        )
+        student_mastery = {
+            row["skill_name"]: float(row["mastery"] or 0.0) for row in mastery_rows
         }
+
+    skills = []
+    for row in rows:
+        students = int(row["students"])
+        attempts = int(row["attempts"])
+        mean = float(row["mastery_sum"]) / students if students > 0 else None
+        skill = CohortSkill(
+            skill_name=row["skill_name"],
+            students=students,
+            attempts=attempts,
+            class_avg_performance=int(row["correct"]) / attempts if attempts else None,
+            mean_mastery=mean,
+            histogram=list(row["histogram"]),
+        )
+        mastery = student_mastery.get(row["skill_name"])
+        if mastery is not None:
+            skill.student_mastery = mastery
+            skill.relative_to_class = mastery - mean if mean is not None else None
+            skill.peer_comparison_percentile = histogram_percentile(row["histogram"], mastery)
+        skills.append(skill)
+
+    attempts = sum(skill.attempts for skill in skills)
+    correct = sum(int(row["correct"]) for row in rows)
+    pairs = sum(skill.students for skill in skills)
+    mastery_total = sum(float(row["mastery_sum"]) for row in rows)
+    response = CohortResponse(
+        class_id=class_id,
+        class_size=class_size,
+        attempts=attempts,
+        class_avg_performance=correct / attempts if attempts else None,
+        mean_mastery=mastery_total / pairs if pairs > 0 else None,
+        skills=skills,
+    )
+    if student_id:
+        # Across skills: the student's average standing in each skill they have.
+        mine = [skill for skill in skills if skill.student_mastery is not None]
+        relative = [skill.relative_to_class for skill in mine if skill.relative_to_class is not None]
+        ranks = [
+            skill.peer_comparison_percentile
+            for skill in mine
+            if skill.peer_comparison_percentile is not None
+        ]
+        response.student_id = student_id
+        response.relative_to_class = sum(relative) / len(relative) if relative else None
+        response.peer_comparison_percentile = sum(ranks) / len(ranks) if ranks else None
+    return response
+
+
+async def run_db(op: DbOp[T]) -> T:
+    try:
+        async with async_pooled_connection() as conn:
+            return await run_op_async(conn, op)
     except psycopg.Error as exc:
         raise HTTPException(status_code=500, detail=f"Database error: {exc}")
 
 
+async def get_state_db(student_id: str, skill_name: str) -> Dict[str, Any]:
+    return await run_db(get_state_op(student_id, skill_name))
+
+
+def update_state_memory(payload: AnswerPayload) -> Dict[str, Any]:
+    record = get_learner_record(payload.student_id, payload.skill_name)
+    prior = record.mastery
+    next_mastery, next_intervention = advance_learner_state(
+        prior,
+        payload.correct,
+        payload.attempt_count,
+        payload.hints_used,
+        {
+            "intervention_active": record.intervention_active,
+            "recovery_streak": record.recovery_streak,
+        },
+        skill_bkt_params(payload.skill_name),
+    )
+    record = LearnerRecord(
+        next_mastery,
+        next_mastery - prior,
+        payload.attempt_count,
+        bool(next_intervention["intervention_active"]),
+        int(next_intervention["recovery_streak"]),
+    )
+    MEMORY_STORE.put(payload.student_id, payload.skill_name, record)
+    return {
+        "prior_skill_mastery": record.mastery,
+        "learning_velocity": record.velocity,
+        "attempt_count": record.attempt_count,
+        "intervention_active": record.intervention_active,
+        "recovery_streak": record.recovery_streak,
+    }
+
+
+async def update_state_db(payload: AnswerPayload) -> Dict[str, Any]:
+    intervention = get_intervention_state(payload.student_id, payload.skill_name)
+    write_behind = attempt_log_enabled()
+    state, next_intervention = await run_db(
+        update_state_op(payload, intervention, write_attempt=not write_behind)
+    )
+    VIEW_CACHE.bump(payload.student_id)
+    record_cohort_answer(payload.student_id, payload.skill_name, payload.correct)
+    if write_behind:
+        await log_attempt(attempt_row(payload))
+    if "intervention_active" not in state:
+        # Not persisted by this schema: advance the in-process state once committed.
+        set_intervention_state(payload.student_id, payload.skill_name, next_intervention)
+    return {
+        **state,
+        "intervention_active": bool(next_intervention["intervention_active"]),
+        "recovery_streak": int(next_intervention["recovery_streak"]),
+    }
+
+
+def batch_attempt_rows(payloads: List[AnswerPayload]) -> List[Dict[str, Any]]:
+    # Distinct, increasing timestamps keep the batch order for replays.
+    now = datetime.now(timezone.utc)
+    return [
+        {**attempt_row(payload), "created_at": now + timedelta(microseconds=index)}
+        for index, payload in enumerate(payloads)
+    ]
+
+
+async def update_states_batch_db(payloads: List[AnswerPayload]) -> List[Dict[str, Any]]:
+    pairs = {(payload.student_id, payload.skill_name) for payload in payloads}
+    fallback = {key: get_intervention_state(*key) for key in pairs}
+    attempt_rows = batch_attempt_rows(payloads)
+    write_behind = attempt_log_enabled()
+    snapshots, finals, persisted = await run_db(
+        update_states_batch_op(payloads, fallback, None if write_behind else attempt_rows)
+    )
+    for student_id in {payload.student_id for payload in payloads}:
+        VIEW_CACHE.bump(student_id)
+    for payload in payloads:
+        record_cohort_answer(payload.student_id, payload.skill_name, payload.correct)
+    if write_behind:
+        await log_attempts(attempt_rows)
+    if not persisted:
+        for (student_id, skill_name), values in finals.items():
+            set_intervention_state(student_id, skill_name, values)
+    return snapshots
+
+
 @app.get("/health")
-def health() -> Dict[str, Any]:
+async def health() -> Dict[str, Any]:
     return {"status": "ok", "db_enabled": USE_DB}
 
 
-@app.get("/courses", response_model=List[CourseItem])
-def list_courses(student_id: str) -> List[CourseItem]:
+async def cached_view(
+    request: Request, student_id: str, view: str, load: Callable[[], Awaitable[Any]]
+) -> Response:
+    # Repeat fetches revalidate with If-None-Match and get a 304; while the
+    # student's version and bkt_state stamp are unchanged, neither path runs
+    # the view query.
+    version = VIEW_CACHE.version(student_id)
+    stamp = await run_db(view_stamp_op(student_id)) if USE_DB else None
+    entry = VIEW_CACHE.get(student_id, view, version, stamp)
+    if entry is None:
+        body = json.dumps(jsonable_encoder(await load())).encode()
+        entry = VIEW_CACHE.put(student_id, view, version, body, stamp)
+    headers = {"ETag": entry.etag, "Cache-Control": "private, no-cache"}
+    if etag_matches(request.headers.get("if-none-match"), entry.etag):
+        VIEW_CACHE.record_not_modified()
+        return Response(status_code=304, headers=headers)
+    return Response(entry.body, media_type="application/json", headers=headers)
+
+
+async def load_courses(student_id: str) -> List[CourseItem]:
     if USE_DB:
-        conn = get_connection()
-        if not conn:
-            raise HTTPException(status_code=500, detail="SUPABASE_DB_URL not set")
-        try:
-            with conn:
-                ensure_student(conn, student_id)
-                sync_learning_path(conn, student_id)
-                courses = fetch_courses_db(conn, student_id)
-            if courses:
-                return courses
-        except psycopg.Error as exc:
-            raise HTTPException(status_code=500, detail=f"Database error: {exc}")
+        courses = await run_db(courses_op(student_id))
+        if courses:
+            return courses
     return [CourseItem(**course) for course in DEFAULT_COURSES]
 
 
-@app.get("/assignments", response_model=List[AssignmentItem])
-def list_assignments(student_id: str) -> List[AssignmentItem]:
+async def load_assignments(student_id: str) -> List[AssignmentItem]:
     if USE_DB:
-        conn = get_connection()
-        if not conn:
-            raise HTTPException(status_code=500, detail="SUPABASE_DB_URL not set")
-        try:
-            with conn:
-                ensure_student(conn, student_id)
-                sync_learning_path(conn, student_id)
-                assignments = fetch_assignments_db(conn, student_id)
-            if assignments:
-                return assignments
-        except psycopg.Error as exc:
-            raise HTTPException(status_code=500, detail=f"Database error: {exc}")
+        return await run_db(assignments_op(student_id))
     return []
 
 
+@app.get("/courses", response_model=List[CourseItem])
+async def list_courses(student_id: str, request: Request) -> Response:
+    return await cached_view(request, student_id, "courses", lambda: load_courses(student_id))
+
+
+@app.get("/assignments", response_model=List[AssignmentItem])
+async def list_assignments(student_id: str, request: Request) -> Response:
+    return await cached_view(
+        request, student_id, "assignments", lambda: load_assignments(student_id)
+    )
+
+
+@app.put("/students/{student_id}/class")
+async def assign_class(student_id: str, payload: ClassAssignment) -> Dict[str, Any]:
+    if not USE_DB:
+        raise HTTPException(status_code=503, detail="Classes require the database")
+    class_id = (payload.class_id or "").strip() or None
+    if class_id == ALL_STUDENTS:
+        raise HTTPException(status_code=400, detail=f"{ALL_STUDENTS} is reserved for all students")
+    await run_db(assign_class_op(student_id, class_id))
+    # The student's pairs move to the new class on the next aggregate flush.
+    record_class_change(student_id)
+    return {"student_id": student_id, "class_id": class_id}
+
+
+@app.get("/cohorts/{class_id}", response_model=CohortResponse)
+async def cohort(
+    class_id: str, skill_name: Optional[str] = None, student_id: Optional[str] = None
+) -> CohortResponse:
+    # class_id "*" is every student.
+    if not USE_DB:
+        raise HTTPException(status_code=503, detail="Cohort aggregates require the database")
+    return await run_db(cohort_op(class_id, skill_name, student_id))
+
+
+@app.get("/aggregates/cohorts")
+async def cohort_stats_status() -> Dict[str, Any]:
+    return cohort_stats_metrics()
+
+
+@app.get("/views/cache")
+async def view_cache_status() -> Dict[str, Any]:
+    return VIEW_CACHE.metrics()
+
+
 @app.get("/bkt/snapshot", response_model=SnapshotResponse)
-def bkt_snapshot(student_id: str, skill_name: str) -> SnapshotResponse:
+async def bkt_snapshot(student_id: str, skill_name: str) -> SnapshotResponse:
     if USE_DB:
-        state = get_state_db(student_id, skill_name)
+        state = await get_state_db(student_id, skill_name)
     else:
         state = get_state_memory(student_id, skill_name)
-    intervention = get_intervention_state(student_id, skill_name)
-    return SnapshotResponse(**{**state, **intervention})
+    if "intervention_active" not in state:
+        state.update(get_intervention_state(student_id, skill_name))
+    return SnapshotResponse(**state)
+
+
+@app.get("/bkt/snapshots", response_model=List[SkillSnapshot])
+async def bkt_snapshots(student_id: str, skills: Optional[str] = None) -> List[SkillSnapshot]:
+    # skills is a comma-separated filter; without it, every dashboard skill.
+    skill_names = None
+    if skills is not None:
+        skill_names = [name.strip() for name in skills.split(",") if name.strip()]
+    if USE_DB:
+        states = await run_db(get_states_op(student_id, skill_names))
+    else:
+        states = get_states_memory(student_id, skill_names)
+    for state in states:
+        if "intervention_active" not in state:
+            state.update(get_intervention_state(student_id, state["skill_name"]))
+    return [SkillSnapshot(**state) for state in states]
 
 
 @app.post("/answers", response_model=SnapshotResponse)
-def submit_answer(payload: AnswerPayload) -> SnapshotResponse:
+async def submit_answer(payload: AnswerPayload) -> SnapshotResponse:
     if USE_DB:
-        state = update_state_db(payload)
+        state = await update_state_db(payload)
     else:
         state = update_state_memory(payload)
     return SnapshotResponse(**state)
 
 
-@app.post("/llm/problem", response_model=ProblemResponse)
-def llm_problem(payload: ProblemRequest) -> ProblemResponse:
+@app.post("/answers/batch", response_model=List[SnapshotResponse])
+async def submit_answers(payloads: List[AnswerPayload]) -> List[SnapshotResponse]:
+    # Answers apply in list order; the response has one snapshot per answer.
+    if len(payloads) > ANSWERS_BATCH_MAX:
+        raise HTTPException(
+            status_code=413, detail=f"At most {ANSWERS_BATCH_MAX} answers per batch"
+        )
+    if not payloads:
+        return []
+    if USE_DB:
+        states = await update_states_batch_db(payloads)
+    else:
+        states = [update_state_memory(payload) for payload in payloads]
+    return [SnapshotResponse(**state) for state in states]
+
+
+def record_problem_op(
+    problem: ProblemResponse,
+    payload: ProblemRequest,
+    zpd_status: str,
+    mastery: float,
+    bankable: bool,
+) -> DbOp[None]:
+    now = datetime.now(timezone.utc)
+    problem_payload = {
+        "prompt": problem.prompt,
+        "answer": problem.answer,
+        "latex": problem.latex,
+        "skill_name": payload.skill_name,
+        "student_id": payload.student_id,
+        "zpd_status": zpd_status,
+        "created_at": now,
+    }
+    yield from insert_record_op("problems", problem_payload)
+    if bankable:
+        if payload.student_id:
+            yield from ensure_student_op(payload.student_id)
+        yield from bank_problem_op(
+            payload.student_id, payload.skill_name, zpd_status, mastery, problem.model_dump()
+        )
+
+
+async def store_problem(
+    problem: ProblemResponse,
+    payload: ProblemRequest,
+    zpd_status: str,
+    mastery: float,
+    bankable: bool,
+) -> ProblemResponse:
+    if USE_DB:
+        try:
+            async with async_pooled_connection() as conn:
+                await run_op_async(
+                    conn, record_problem_op(problem, payload, zpd_status, mastery, bankable)
+                )
+        except psycopg.Error as exc:
+            logger.warning("llm.problem.db_insert_failed", extra={"error": str(exc)})
+    return problem
+
+
+async def fetch_stored_problem(
+    student_id: str, skill_name: str, zpd_status: str, mastery: float
+) -> Optional[Dict[str, str]]:
+    try:
+        async with async_pooled_connection() as conn:
+            return await run_op_async(
+                conn, serve_stored_problem_op(student_id, skill_name, zpd_status, mastery)
+            )
+    except psycopg.Error as exc:
+        logger.warning("llm.problem.store_lookup_failed", extra={"error": str(exc)})
+        return None
+
+
+async def problem_context(payload: ProblemRequest) -> Tuple[float, str]:
     mastery = None
     intervention = None
     if payload.student_id:
         if USE_DB:
-            state = get_state_db(payload.student_id, payload.skill_name)
+            state = await get_state_db(payload.student_id, payload.skill_name)
         else:
             state = get_state_memory(payload.student_id, payload.skill_name)
         mastery = state.get("prior_skill_mastery")
-        intervention = get_intervention_state(payload.student_id, payload.skill_name)
+        intervention = state
+        if "intervention_active" not in state:
+            intervention = get_intervention_state(payload.student_id, payload.skill_name)
     if mastery is None:
         mastery = DEFAULT_PRIOR
 
     zpd_status = derive_zpd_status(mastery, payload.zpd_status)
     if intervention and intervention.get("intervention_active"):
         zpd_status = "support"
-    llm_problem_data = generate_problem_with_llm(
+    return mastery, zpd_status
+
+
+async def ready_problem(
+    payload: ProblemRequest, zpd_status: str, mastery: float
+) -> Optional[Tuple[ProblemResponse, bool]]:
+    # Problems that need no completion: (problem, bankable) or None.
+    extra = {"skill": payload.skill_name, "zpd": zpd_status}
+    pooled = pop_pooled_problem(payload.skill_name, zpd_status)
+    if pooled:
+        logger.info("llm.problem.pooled", extra=extra)
+        return ProblemResponse(**pooled), True
+    if USE_DB and payload.student_id:
+        # Reuse a banked problem this student has not seen before paying for a completion.
+        stored = await fetch_stored_problem(
+            payload.student_id, payload.skill_name, zpd_status, mastery
+        )
+        if stored:
+            logger.info("llm.problem.stored", extra=extra)
+            return ProblemResponse(**stored), False
+    return None
+
+
+@app.post("/llm/problem", response_model=ProblemResponse)
+async def llm_problem(payload: ProblemRequest) -> ProblemResponse:
+    mastery, zpd_status = await problem_context(payload)
+    ready = await ready_problem(payload, zpd_status, mastery)
+    if ready:
+        return await store_problem(ready[0], payload, zpd_status, mastery, ready[1])
+    extra = {"skill": payload.skill_name, "zpd": zpd_status}
+    llm_problem_data = await generate_problem_with_llm_async(
         skill_name=payload.skill_name,
         mastery=mastery,
         zpd_status=zpd_status,
     )
     if llm_problem_data:
-        logger.info("llm.problem.generated", extra={"skill": payload.skill_name, "zpd": zpd_status})
-        problem = ProblemResponse(**llm_problem_data)
+        logger.info("llm.problem.generated", extra=extra)
+        return await store_problem(
+            ProblemResponse(**llm_problem_data), payload, zpd_status, mastery, True
+        )
+    # Template fallbacks are logged but never banked.
+    logger.info("llm.problem.fallback", extra=extra)
+    problem = build_problem(payload.skill_name, zpd_status)
+    return await store_problem(problem, payload, zpd_status, mastery, False)
+
+
+def sse_event(event: str, data: Dict[str, Any]) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+async def problem_events(
+    payload: ProblemRequest, zpd_status: str, mastery: float
+) -> AsyncIterator[str]:
+    ready = await ready_problem(payload, zpd_status, mastery)
+    if ready:
+        problem, bankable = ready
+        yield sse_event("prompt", {"text": problem.prompt})
     else:
-        logger.info("llm.problem.fallback", extra={"skill": payload.skill_name, "zpd": zpd_status})
-        problem = build_problem(payload.skill_name, zpd_status)
-    if USE_DB:
-        conn = get_connection()
-        if conn:
-            try:
-                with conn:
-                    now = datetime.now(timezone.utc)
-                    problem_payload = {
-                        "prompt": problem.prompt,
-                        "answer": problem.answer,
-                        "latex": problem.latex,
-                        "skill_name": payload.skill_name,
-                        "student_id": payload.student_id,
-                        "zpd_status": zpd_status,
-                        "created_at": now,
-                    }
-                    insert_record(conn, "problems", problem_payload)
-            except psycopg.Error as exc:
-                logger.warning("llm.problem.db_insert_failed", extra={"error": str(exc)})
-    return problem
+        extra = {"skill": payload.skill_name, "zpd": zpd_status}
+        generated = None
+        streamed = False
+        async for kind, value in stream_problem_with_llm(
+            skill_name=payload.skill_name, mastery=mastery, zpd_status=zpd_status
+        ):
+            if kind == "prompt":
+                streamed = True
+                yield sse_event("prompt", {"text": value})
+            else:
+                generated = value
+        if generated:
+            logger.info("llm.problem.generated", extra=extra)
+            problem, bankable = ProblemResponse(**generated), True
+        else:
+            logger.info("llm.problem.fallback", extra=extra)
+            problem, bankable = build_problem(payload.skill_name, zpd_status), False
+            if streamed:
+                # The streamed text belonged to the rejected completion.
+                yield sse_event("reset", {})
+            yield sse_event("prompt", {"text": problem.prompt})
+    # The answer only leaves in this final, validated event.
+    yield sse_event("problem", problem.model_dump())
+    await store_problem(problem, payload, zpd_status, mastery, bankable)
+
+
+@app.post("/llm/problem/stream")
+async def llm_problem_stream(payload: ProblemRequest) -> StreamingResponse:
+    mastery, zpd_status = await problem_context(payload)
+    return StreamingResponse(
+        problem_events(payload, zpd_status, mastery),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@app.get("/llm/pool")
+async def llm_pool() -> Dict[str, Any]:
+    return problem_pool_metrics()
+
+
+@app.get("/attempts/log")
+async def attempt_log_status() -> Dict[str, Any]:
+    return attempt_log_metrics()
+
+
+@app.get("/llm/metrics")
+async def llm_client_metrics() -> Dict[str, Any]:
+    return llm_metrics()
+
+
+def trace_row(payload: OpikTracePayload, now: datetime) -> Dict[str, Any]:
+    return {
+        "student_id": payload.student_id,
+        "skill_name": payload.skill_name,
+        "time_on_task": payload.time_on_task,
+        "attempt_count": payload.attempt_count,
+        "hint_count": payload.hint_count,
+        "question": payload.question,
+        "source": payload.source,
+        "created_at": now,
+    }
+
+
+async def record_traces(payloads: List[OpikTracePayload]) -> None:
+    now = datetime.now(timezone.utc)
+    try:
+        await ingest_traces([trace_row(payload, now) for payload in payloads], USE_DB)
+    except psycopg.Error as exc:
+        raise HTTPException(status_code=500, detail=f"Database error: {exc}")
 
 
 @app.post("/opik/trace")
-def opik_trace(payload: OpikTracePayload) -> Dict[str, str]:
-    if USE_DB:
-        conn = get_connection()
-        if not conn:
-            raise HTTPException(status_code=500, detail="SUPABASE_DB_URL not set")
-        try:
-            with conn:
-                now = datetime.now(timezone.utc)
-                trace_payload = {
-                    "student_id": payload.student_id,
-                    "skill_name": payload.skill_name,
-                    "time_on_task": payload.time_on_task,
-                    "attempt_count": payload.attempt_count,
-                    "hint_count": payload.hint_count,
-                    "question": payload.question,
-                    "source": payload.source,
-                    "created_at": now,
-                }
-                insert_record(conn, "opik_traces", trace_payload)
-        except psycopg.Error as exc:
-            raise HTTPException(status_code=500, detail=f"Database error: {exc}")
+async def opik_trace(payload: OpikTracePayload) -> Dict[str, str]:
+    await record_traces([payload])
     return {"status": "ok"}
+
+
+@app.post("/opik/traces")
+async def opik_traces(payloads: List[OpikTracePayload]) -> Dict[str, Any]:
+    if len(payloads) > TRACES_BATCH_MAX:
+        raise HTTPException(
+            status_code=413, detail=f"At most {TRACES_BATCH_MAX} traces per batch"
+        )
+    await record_traces(payloads)
+    return {"status": "ok", "count": len(payloads)}
+
+
+@app.get("/opik/ingest")
+async def opik_ingest_status() -> Dict[str, Any]:
+    return trace_ingest_metrics()
@@ -0,0 +1,313 @@
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+import numpy as np
+
+MEMORY_STATE_MAX_ENTRIES = int(os.getenv("MEMORY_STATE_MAX_ENTRIES", "1000000"))
+MEMORY_STATE_TTL_SECONDS = float(os.getenv("MEMORY_STATE_TTL_SECONDS", "0"))
+MEMORY_STATE_SPILL_PATH = os.getenv("MEMORY_STATE_SPILL_PATH") or None
+
+_SKILL_BITS = 20
+_INITIAL_CAPACITY = 1024
+
+
+class LearnerRecord(NamedTuple):
+    mastery: float
+    velocity: float
+    attempt_count: int
+    intervention_active: bool
+    recovery_streak: int
+
+
+class LearnerStateStore:
+    # One row per (student, skill) in parallel numpy columns; a dict maps the
+    # packed interned ids to the row. Least recently used rows are evicted in
+    # batches once max_entries is exceeded, and rows idle for ttl_seconds are
+    # swept. With a spill path, evicted rows go to a local SQLite file and are
+    # reloaded transparently on the next read.
+    def __init__(
+        self,
+        max_entries: int = MEMORY_STATE_MAX_ENTRIES,
+        ttl_seconds: float = MEMORY_STATE_TTL_SECONDS,
+        spill_path: Optional[str] = MEMORY_STATE_SPILL_PATH,
+        evict_fraction: float = 0.05,
+    ) -> None:
+        self.max_entries = max(1, max_entries)
+        self.ttl_seconds = ttl_seconds
+        self.evict_batch = max(1, int(self.max_entries * evict_fraction))
+        self._lock = threading.Lock()
+        self._epoch = time.monotonic()
+        self._students: Dict[str, int] = {}
+        self._student_names: List[Optional[str]] = []
+        self._student_refs: List[int] = []
+        self._free_students: List[int] = []
+        self._skills: Dict[str, int] = {}
+        self._skill_names: List[Optional[str]] = []
+        self._skill_refs: List[int] = []
+        self._free_skills: List[int] = []
+        self._slots: Dict[int, int] = {}
+        self._free_slots: List[int] = []
+        self._size = 0
+        self._allocate(_INITIAL_CAPACITY)
+        self._next_sweep = self._now() + ttl_seconds if ttl_seconds > 0 else None
+        self.evictions = 0
+        self.reloads = 0
+        self._spill: Optional[sqlite3.Connection] = None
+        if spill_path:
+            self._spill = sqlite3.connect(spill_path, check_same_thread=False)
+            self._spill.execute(
+                """
+                create table if not exists learner_state (
+                    student_id text not null,
+                    skill_name text not null,
+                    mastery real not null,
+                    velocity real not null,
+                    attempt_count integer not null,
+                    intervention_active integer not null,
+                    recovery_streak integer not null,
+                    primary key (student_id, skill_name)
+                ) without rowid
+                """
+            )
+
+    def _allocate(self, capacity: int) -> None:
+        columns = {
+            "_student": np.int32,
+            "_skill": np.int32,
+            "_mastery": np.float64,
+            "_velocity": np.float64,
+            "_attempts": np.int32,
+            "_active": np.bool_,
+            "_streak": np.int16,
+            "_touched": np.uint32,
+        }
+        for name, dtype in columns.items():
+            column = np.zeros(capacity, dtype=dtype)
+            if hasattr(self, name):
+                old = getattr(self, name)
+                column[: len(old)] = old
+            setattr(self, name, column)
+
+    def _now(self) -> int:
+        return int(time.monotonic() - self._epoch)
+
+    def __len__(self) -> int:
+        return len(self._slots)
+
+    def _key(self, student_id: str, skill_name: str) -> Optional[int]:
+        student = self._students.get(student_id)
+        skill = self._skills.get(skill_name)
+        if student is None or skill is None:
+            return None
+        return (student << _SKILL_BITS) | skill
+
+    def _intern(self, student_id: str, skill_name: str) -> Tuple[int, int]:
+        skill = self._skills.get(skill_name)
+        if skill is None:
+            if self._free_skills:
+                skill = self._free_skills.pop()
+                self._skill_names[skill] = skill_name
+                self._skill_refs[skill] = 0
+            else:
+                skill = len(self._skill_names)
+                if skill >> _SKILL_BITS:
+                    # The id would spill into the student bits of the key.
+                    raise ValueError(f"more than {1 << _SKILL_BITS} distinct skills held")
+                self._skill_names.append(skill_name)
+                self._skill_refs.append(0)
+            self._skills[skill_name] = skill
+        student = self._students.get(student_id)
+        if student is None:
+            if self._free_students:
+                student = self._free_students.pop()
+                self._student_names[student] = student_id
+                self._student_refs[student] = 0
+            else:
+                student = len(self._student_names)
+                self._student_names.append(student_id)
+                self._student_refs.append(0)
+            self._students[student_id] = student
+        return student, skill
+
+    def _record(self, slot: int) -> LearnerRecord:
+        return LearnerRecord(
+            float(self._mastery[slot]),
+            float(self._velocity[slot]),
+            int(self._attempts[slot]),
+            bool(self._active[slot]),
+            int(self._streak[slot]),
+        )
+
+    def get(self, student_id: str, skill_name: str) -> Optional[LearnerRecord]:
+        with self._lock:
+            key = self._key(student_id, skill_name)
+            slot = self._slots.get(key) if key is not None else None
+            if slot is not None:
+                self._touched[slot] = self._now()
+                return self._record(slot)
+            record = self._load_spilled(student_id, skill_name)
+            if record is not None:
+                self.reloads += 1
+                self._put_locked(student_id, skill_name, record)
+            return record
+
+    def student_records(self, student_id: str) -> Dict[str, LearnerRecord]:
+        # Every pair held for the student, live or spilled, by skill. Read-only:
+        # neither touches nor reloads rows.
+        with self._lock:
+            records: Dict[str, LearnerRecord] = {}
+            if self._spill is not None:
+                for row in self._spill.execute(
+                    """
+                    select skill_name, mastery, velocity, attempt_count,
+                           intervention_active, recovery_streak
+                    from learner_state where student_id = ?
+                    """,
+                    (student_id,),
+                ):
+                    records[row[0]] = LearnerRecord(
+                        float(row[1]), float(row[2]), int(row[3]), bool(row[4]), int(row[5])
+                    )
+            student = self._students.get(student_id)
+            if student is not None and self._student_refs[student]:
+                live = self._live_slots()
+                for slot in live[self._student[live] == student]:
+                    records[self._skill_names[int(self._skill[slot])]] = self._record(int(slot))
+            return records
+
+    def put(self, student_id: str, skill_name: str, record: LearnerRecord) -> None:
+        with self._lock:
+            self._put_locked(student_id, skill_name, record)
+
+    def _put_locked(self, student_id: str, skill_name: str, record: LearnerRecord) -> None:
+        student, skill = self._intern(student_id, skill_name)
+        key = (student << _SKILL_BITS) | skill
+        slot = self._slots.get(key)
+        if slot is None:
+            if self._free_slots:
+                slot = self._free_slots.pop()
+            else:
+                if self._size == len(self._mastery):
+                    self._allocate(len(self._mastery) * 2)
+                slot = self._size
+                self._size += 1
+            self._slots[key] = slot
+            self._student[slot] = student
+            self._skill[slot] = skill
+            self._student_refs[student] += 1
+            self._skill_refs[skill] += 1
+        self._mastery[slot] = record.mastery
+        self._velocity[slot] = record.velocity
+        self._attempts[slot] = record.attempt_count
+        self._active[slot] = record.intervention_active
+        self._streak[slot] = record.recovery_streak
+        now = self._now()
+        self._touched[slot] = now
+        if self._next_sweep is not None and now >= self._next_sweep:
+            self._evict_idle(now)
+        if len(self._slots) > self.max_entries:
+            self._evict_lru(len(self._slots) - self.max_entries + self.evict_batch)
+
+    def _live_slots(self) -> np.ndarray:
+        return np.fromiter(self._slots.values(), dtype=np.int64, count=len(self._slots))
+
+    def _evict_lru(self, count: int) -> None:
+        live = self._live_slots()
+        count = min(count, len(live))
+        oldest = live[np.argpartition(self._touched[live], count - 1)[:count]]
+        self._evict(oldest)
+
+    def _evict_idle(self, now: int) -> None:
+        live = self._live_slots()
+        self._evict(live[now - self._touched[live].astype(np.int64) > self.ttl_seconds])
+        self._next_sweep = now + self.ttl_seconds
+
+    def _evict(self, slots: Iterable[int]) -> None:
+        spilled = []
+        for slot in (int(value) for value in slots):
+            student = int(self._student[slot])
+            skill = int(self._skill[slot])
+            student_id = self._student_names[student]
+            skill_name = self._skill_names[skill]
+            if self._spill is not None:
+                spilled.append((student_id, skill_name, *self._record(slot)))
+            del self._slots[(student << _SKILL_BITS) | skill]
+            self._free_slots.append(slot)
+            self._student_refs[student] -= 1
+            if self._student_refs[student] == 0:
+                # Release the interned id so departed students do not pile up.
+                del self._students[student_id]
+                self._student_names[student] = None
+                self._free_students.append(student)
+            self._skill_refs[skill] -= 1
+            if self._skill_refs[skill] == 0:
+                del self._skills[skill_name]
+                self._skill_names[skill] = None
+                self._free_skills.append(skill)
+            self.evictions += 1
+        self._write_spill(spilled)
+
+    def _write_spill(self, rows: List[Tuple[Any, ...]]) -> None:
+        if self._spill is None or not rows:
+            return
+        with self._spill:
+            self._spill.executemany(
+                "insert or replace into learner_state values (?, ?, ?, ?, ?, ?, ?)", rows
+            )
+
+    def _load_spilled(self, student_id: str, skill_name: str) -> Optional[LearnerRecord]:
+        if self._spill is None:
+            return None
+        row = self._spill.execute(
+            """
+            select mastery, velocity, attempt_count, intervention_active, recovery_streak
+            from learner_state where student_id = ? and skill_name = ?
+            """,
+            (student_id, skill_name),
+        ).fetchone()
+        if row is None:
+            return None
+        return LearnerRecord(float(row[0]), float(row[1]), int(row[2]), bool(row[3]), int(row[4]))
+
+    def snapshot(self) -> int:
+        # Writes every live row to the spill file, e.g. on shutdown.
+        with self._lock:
+            rows = []
+            for key, slot in self._slots.items():
+                rows.append(
+                    (
+                        self._student_names[key >> _SKILL_BITS],
+                        self._skill_names[key & ((1 << _SKILL_BITS) - 1)],
+                        *self._record(slot),
+                    )
+                )
+            self._write_spill(rows)
+            return len(rows) if self._spill is not None else 0
+
+    def metrics(self) -> Dict[str, Any]:
+        with self._lock:
+            column_bytes = sum(
+                getattr(self, name).nbytes
+                for name in (
+                    "_student", "_skill", "_mastery", "_velocity",
+                    "_attempts", "_active", "_streak", "_touched",
+                )
+            )
+            return {
+                "entries": len(self._slots),
+                "students": len(self._students),
+                "skills": len(self._skills),
+                "capacity": len(self._mastery),
+                "column_bytes": column_bytes,
+                "evictions": self.evictions,
+                "reloads": self.reloads,
+                "spill": self._spill is not None,
+            }
+
+    def close(self) -> None:
+        if self._spill is not None:
+            self._spill.close()
+            self._spill = None
@@ -0,0 +1,531 @@
+import sys
+from typing import List, Tuple
+
+import psycopg
+
+from db import get_connection, invalidate_schema
+
+MIGRATIONS_LOCK_KEY = 7_340_112
+
+# Append-only: each entry is (version, name, statements). Never edit an
+# applied migration; add a new version instead.
+MIGRATIONS: List[Tuple[int, str, Tuple[str, ...]]] = [
+    (
+        1,
+        "learning_path_tables",
+        (
+            """
+            create table if not exists public.courses (
+                id text primary key,
+                title text not null,
+                module text,
+                summary text,
+                parent_id text references public.courses(id),
+                target_skill text,
+                sequence int,
+                created_at timestamptz default now()
+            );
+            """,
+            """
+            create table if not exists public.enrollments (
+                student_id text not null references public.students(student_id),
+                course_id text not null references public.courses(id),
+                progress numeric default 0,
+                status text,
+                created_at timestamptz default now(),
+                primary key (student_id, course_id)
+            );
+            """,
+            """
+            create table if not exists public.assignments (
+                id text primary key,
+                student_id text not null references public.students(student_id),
+                course_id text references public.courses(id),
+                title text not null,
+                assignment_type text,
+                skill_name text,
+                problem_count integer default 0,
+                completion_rate numeric default 0,
+                status text,
+                created_at timestamptz default now()
+            );
+            """,
+            "create unique index if not exists assignments_student_course_idx on public.assignments(student_id, course_id);",
+            "alter table public.courses add column if not exists module text;",
+            "alter table public.courses add column if not exists summary text;",
+            "alter table public.courses add column if not exists parent_id text;",
+            "alter table public.courses add column if not exists target_skill text;",
+            "alter table public.courses add column if not exists sequence int;",
+            "alter table public.enrollments add column if not exists progress numeric default 0;",
+            "alter table public.enrollments add column if not exists status text;",
+            "alter table public.assignments add column if not exists assignment_type text;",
+            "alter table public.assignments add column if not exists skill_name text;",
+            "alter table public.assignments add column if not exists problem_count integer default 0;",
+            "alter table public.assignments add column if not exists completion_rate numeric default 0;",
+            "alter table public.assignments add column if not exists status text;",
+        ),
+    ),
+    (
+        2,
+        "skills_change_notify",
+        (
+            """
+            create or replace function public.notify_skills_changed() returns trigger
+            language plpgsql as $$
+            begin
+                perform pg_notify('skills_changed', '');
+                return null;
+            end;
+            $$;
+            """,
+            """
+            do $$
+            begin
+                if to_regclass('public.skills') is not null then
+                    drop trigger if exists skills_changed_notify on public.skills;
+                    create trigger skills_changed_notify
+                        after insert or update or delete or truncate on public.skills
+                        for each statement execute function public.notify_skills_changed();
+                end if;
+            end;
+            $$;
+            """,
+        ),
+    ),
+    (
+        3,
+        "problem_bank",
+        (
+            """
+            create or replace function public.problem_content_hash(latex text, answer text)
+            returns text language sql immutable as $$
+                select encode(sha256(convert_to(
+                    lower(regexp_replace(coalesce(latex, ''), '[[:space:]]+', '', 'g'))
+                    || chr(31)
+                    || lower(regexp_replace(coalesce(answer, ''), '[[:space:]]+', '', 'g')),
+                    'UTF8'
+                )), 'hex')
+            $$;
+            """,
+            """
+            create table if not exists public.problem_bank (
+                id bigint generated always as identity primary key,
+                content_hash text not null unique,
+                skill_name text not null,
+                zpd_status text not null,
+                mastery_band smallint not null,
+                skill_seq int not null,
+                prompt text not null,
+                latex text not null,
+                answer text not null,
+                created_at timestamptz default now(),
+                unique (skill_name, skill_seq)
+            );
+            """,
+            "create index if not exists problem_bank_bucket_idx on public.problem_bank(skill_name, zpd_status, mastery_band, skill_seq);",
+            """
+            create table if not exists public.problem_served (
+                student_id text not null references public.students(student_id),
+                skill_name text not null,
+                served varbit not null,
+                updated_at timestamptz default now(),
+                primary key (student_id, skill_name)
+            );
+            """,
+            # Backfill from previously served problems; their band is taken
+            # from the ZPD status since public.problems has no mastery.
+            """
+            do $$
+            begin
+                if to_regclass('public.problems') is not null then
+                    insert into public.problem_bank (
+                        content_hash, skill_name, zpd_status, mastery_band, skill_seq,
+                        prompt, latex, answer, created_at
+                    )
+                    select p.content_hash,
+                           p.skill_name,
+                           p.zpd_status,
+                           case p.zpd_status when 'support' then 2 when 'stretch' then 4 else 3 end,
+                           (row_number() over (partition by p.skill_name order by p.created_at, p.content_hash) - 1)::int,
+                           p.prompt, p.latex, p.answer, p.created_at
+                    from (
+                        select distinct on (public.problem_content_hash(latex, answer))
+                               public.problem_content_hash(latex, answer) as content_hash,
+                               skill_name,
+                               coalesce(zpd_status, 'challenge') as zpd_status,
+                               prompt, latex, answer, created_at
+                        from public.problems
+                        where skill_name is not null
+                          and coalesce(prompt, '') != ''
+                          and coalesce(latex, '') != ''
+                          and coalesce(answer, '') != ''
+                        order by public.problem_content_hash(latex, answer), created_at
+                    ) p
+                    on conflict (content_hash) do nothing;
+                end if;
+            end;
+            $$;
+            """,
+        ),
+    ),
+    (
+        4,
+        "bkt_state_intervention",
+        (
+            # Support-mode state lives next to mastery so any worker can serve
+            # the next answer for a pair.
+            "alter table public.bkt_state add column if not exists intervention_active boolean not null default false;",
+            "alter table public.bkt_state add column if not exists recovery_streak int not null default 0;",
+        ),
+    ),
+    (
+        5,
+        "bkt_record_answer",
+        (
+            # One row per pair from here on. Earlier racing inserts could leave
+            # duplicates; keep the most recently written version of each, by
+            # updated_at/created_at where the layout has them. ctid only
+            # breaks ties: its order says nothing about write time.
+            """
+            do $$
+            declare
+                v_order text;
+            begin
+                select string_agg(format('%I desc nulls last', c.column_name), ', '
+                                  order by c.column_name desc)
+                into v_order
+                from information_schema.columns c
+                where c.table_schema = 'public' and c.table_name = 'bkt_state'
+                  and c.column_name in ('updated_at', 'created_at');
+                execute format(
+                    $q$
+                    delete from public.bkt_state b
+                    using (
+                        select ctid,
+                               row_number() over (
+                                   partition by student_id, skill_name order by %s ctid desc
+                               ) as rn
+                        from public.bkt_state
+                    ) d
+                    where b.ctid = d.ctid and d.rn > 1
+                    $q$,
+                    coalesce(v_order || ', ', '')
+                );
+            end;
+            $$;
+            """,
+            "create unique index if not exists bkt_state_student_skill_key on public.bkt_state(student_id, skill_name);",
+            # Applies one answer in a single call: ensures the student and the
+            # row, locks it, runs the BKT update and the intervention state
+            # machine (mirroring main.advance_learner_state), logs the attempt
+            # and returns the new snapshot. Skill parameters and the prior come
+            # from the caller so CSV/table overrides keep working.
+            """
+            create or replace function public.bkt_record_answer(
+                p_student_id text,
+                p_skill_name text,
+                p_correct boolean,
+                p_attempt_count int,
+                p_hints_used int,
+                p_answer text,
+                p_time_on_task int,
+                p_prior double precision,
+                p_guess double precision,
+                p_slip double precision,
+                p_transit double precision,
+                p_snap_threshold double precision,
+                p_max_hints int,
+                p_log_attempt boolean
+            )
+            returns table (
+                prior_skill_mastery double precision,
+                learning_velocity double precision,
+                attempt_count int,
+                intervention_active boolean,
+                recovery_streak int,
+                student_created boolean
+            )
+            language plpgsql as $$
+            #variable_conflict use_column
+            declare
+                v_created boolean;
+                v_prior double precision;
+                v_active boolean;
+                v_streak int;
+                v_trigger boolean;
+                v_clamped double precision;
+                v_num double precision;
+                v_den double precision;
+                v_posterior double precision;
+                v_next double precision;
+            begin
+                insert into public.students (student_id) values (p_student_id)
+                on conflict (student_id) do nothing;
+                v_created := found;
+
+                insert into public.bkt_state (student_id, skill_name, prior_skill_mastery, attempt_count, learning_velocity)
+                values (p_student_id, p_skill_name, p_prior, 0, 0)
+                on conflict (student_id, skill_name) do nothing;
+
+                select b.prior_skill_mastery, b.intervention_active, b.recovery_streak
+                into v_prior, v_active, v_streak
+                from public.bkt_state b
+                where b.student_id = p_student_id and b.skill_name = p_skill_name
+                for update;
+
+                v_prior := coalesce(v_prior, p_prior);
+                v_active := coalesce(v_active, false);
+                v_streak := coalesce(v_streak, 0);
+                v_trigger := p_attempt_count > 3;
+
+                if v_active or v_trigger then
+                    v_next := v_prior;
+                else
+                    v_clamped := greatest(0.0, least(1.0, v_prior));
+                    if p_correct then
+                        v_num := v_clamped * (1.0 - p_slip);
+                        v_den := v_num + (1.0 - v_clamped) * p_guess;
+                    else
+                        v_num := v_clamped * p_slip;
+                        v_den := v_num + (1.0 - v_clamped) * (1.0 - p_guess);
+                    end if;
+                    v_posterior := case when v_den = 0 then v_clamped else v_num / v_den end;
+                    v_next := greatest(0.0, least(1.0, v_posterior + (1.0 - v_posterior) * p_transit));
+                    if v_next >= p_snap_threshold then
+                        v_next := 1.0;
+                    end if;
+                end if;
+
+                if v_trigger and not v_active then
+                    v_active := true;
+                    v_streak := 0;
+                elsif v_active then
+                    if p_correct and not coalesce(p_hints_used >= p_max_hints, false) then
+                        v_streak := v_streak + 1;
+                    else
+                        v_streak := 0;
+                    end if;
+                    if v_streak >= 3 then
+                        v_active := false;
+                        v_streak := 0;
+                    end if;
+                end if;
+
+                update public.bkt_state b
+                set prior_skill_mastery = v_next,
+                    attempt_count = p_attempt_count,
+                    learning_velocity = v_next - v_prior,
+                    intervention_active = v_active,
+                    recovery_streak = v_streak,
+                    updated_at = now()
+                where b.student_id = p_student_id and b.skill_name = p_skill_name;
+
+                if p_log_attempt then
+                    insert into public.attempts (
+                        student_id, skill_name, answer, attempt_count, time_on_task, hints_used, correct, created_at
+                    )
+                    values (
+                        p_student_id, p_skill_name, p_answer, p_attempt_count, p_time_on_task,
+                        p_hints_used, p_correct, clock_timestamp()
+                    );
+                end if;
+
+                return query select v_next, v_next - v_prior, p_attempt_count, v_active, v_streak, v_created;
+            end;
+            $$;
+            """,
+        ),
+    ),
+    (
+        6,
+        "cohort_skill_stats",
+        (
+            "alter table public.students add column if not exists class_id text;",
+            "create index if not exists students_class_id_idx on public.students(class_id);",
+            # The class and mastery each row is currently counted under in
+            # cohort_skill_stats (null mastery: not counted yet).
+            "alter table public.bkt_state add column if not exists cohort_class_id text;",
+            "alter table public.bkt_state add column if not exists cohort_mastery double precision;",
+            # Running totals per (class, skill); class '*' is every student.
+            # histogram[i] counts students with mastery in [i/20, (i+1)/20).
+            """
+            create table if not exists public.cohort_skill_stats (
+                class_id text not null,
+                skill_name text not null,
+                attempts bigint not null default 0,
+                correct bigint not null default 0,
+                students int not null default 0,
+                mastery_sum double precision not null default 0,
+                histogram int[] not null default array_fill(0, array[20]),
+                updated_at timestamptz default now(),
+                primary key (class_id, skill_name)
+            );
+            """,
+            # Classes are new, so the one-off backfill only builds the '*' cohort.
+            # The mastery and correctness columns follow whatever layout
+            # bkt_state and attempts have (as main.bkt_layout does); without a
+            # mastery column the backfill is left to rebuild_bkt_state.py.
+            """
+            do $$
+            declare
+                v_mastery text;
+                v_answered text;
+            begin
+                select c.column_name into v_mastery
+                from information_schema.columns c
+                where c.table_schema = 'public' and c.table_name = 'bkt_state'
+                  and c.column_name in ('prior_skill_mastery', 'prior_mastery', 'mastery')
+                order by array_position(
+                    array['prior_skill_mastery', 'prior_mastery', 'mastery']::text[], c.column_name::text
+                )
+                limit 1;
+                if v_mastery is null then
+                    return;
+                end if;
+
+                if not exists (
+                    select 1 from information_schema.columns
+                    where table_schema = 'public' and table_name = 'attempts' and column_name = 'skill_name'
+                ) then
+                    v_answered := 'select null::text as skill_name, 0::bigint as attempts, 0::bigint as correct where false';
+                elsif exists (
+                    select 1 from information_schema.columns
+                    where table_schema = 'public' and table_name = 'attempts' and column_name = 'correct'
+                ) then
+                    v_answered := 'select skill_name, count(*) as attempts, '
+                        || 'count(*) filter (where correct::text in (''true'', ''1'')) as correct '
+                        || 'from public.attempts group by skill_name';
+                else
+                    v_answered := 'select skill_name, count(*) as attempts, 0::bigint as correct '
+                        || 'from public.attempts group by skill_name';
+                end if;
+
+                execute format(
+                    $q$
+                    with m as (
+                        select skill_name,
+                               coalesce(%1$I, 0) as mastery,
+                               least(greatest(floor(coalesce(%1$I, 0) * 20)::int, 0), 19) as bucket
+                        from public.bkt_state
+                    ),
+                    counts as (
+                        select skill_name, bucket, count(*)::int as n from m group by skill_name, bucket
+                    ),
+                    totals as (
+                        select skill_name, count(*)::int as students, sum(mastery) as mastery_sum
+                        from m group by skill_name
+                    ),
+                    answered as (%2$s)
+                    insert into public.cohort_skill_stats (
+                        class_id, skill_name, attempts, correct, students, mastery_sum, histogram
+                    )
+                    select '*',
+                           coalesce(t.skill_name, a.skill_name),
+                           coalesce(a.attempts, 0),
+                           coalesce(a.correct, 0),
+                           coalesce(t.students, 0),
+                           coalesce(t.mastery_sum, 0),
+                           array(
+                               select coalesce(c.n, 0)
+                               from generate_series(0, 19) as g(i)
+                               left join counts c on c.skill_name = t.skill_name and c.bucket = g.i
+                               order by g.i
+                           )
+                    from totals t
+                    full join answered a on a.skill_name = t.skill_name
+                    on conflict (class_id, skill_name) do nothing
+                    $q$,
+                    v_mastery,
+                    v_answered
+                );
+                execute format(
+                    'update public.bkt_state set cohort_mastery = coalesce(%I, 0) where cohort_mastery is null',
+                    v_mastery
+                );
+            end;
+            $$;
+            """,
+        ),
+    ),
+    (
+        7,
+        "skills_bkt_params",
+        (
+            # Per-skill BKT parameters fitted by fit_bkt_params.py; null falls
+            # back to the defaults in bkt.py.
+            "alter table public.skills add column if not exists bkt_guess double precision;",
+            "alter table public.skills add column if not exists bkt_slip double precision;",
+            "alter table public.skills add column if not exists bkt_transit double precision;",
+        ),
+    ),
+]
+
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+
+def current_version(conn: psycopg.Connection) -> int:
+    with conn.cursor() as cur:
+        cur.execute("select to_regclass('public.schema_migrations') is not null as present")
+        row = cur.fetchone()
+        if not row or not row["present"]:
+            return 0
+        cur.execute("select coalesce(max(version), 0) as version from public.schema_migrations")
+        row = cur.fetchone()
+    return int(row["version"]) if row else 0
+
+
+def apply_migrations(conn: psycopg.Connection) -> List[int]:
+    applied: List[int] = []
+    if current_version(conn) >= SCHEMA_VERSION:
+        return applied
+    with conn.transaction():
+        with conn.cursor() as cur:
+            # Serialize concurrent workers/deploys; the lock is released on commit.
+            cur.execute("select pg_advisory_xact_lock(%s)", (MIGRATIONS_LOCK_KEY,))
+            cur.execute(
+                """
+                create table if not exists public.schema_migrations (
+                    version int primary key,
+                    name text not null,
+                    applied_at timestamptz default now()
+                );
+                """
+            )
+            cur.execute("select version from public.schema_migrations")
+            done = {row["version"] for row in cur.fetchall()}
+            for version, name, statements in MIGRATIONS:
+                if version in done:
+                    continue
+                for statement in statements:
+                    cur.execute(statement)
+                cur.execute(
+                    "insert into public.schema_migrations (version, name) values (%s, %s)",
+                    (version, name),
+                )
+                applied.append(version)
+    if applied:
+        invalidate_schema()
+    return applied
+
+
+def main() -> int:
+    conn = get_connection()
+    if not conn:
+        print("SUPABASE_DB_URL not set.", file=sys.stderr)
+        return 1
+    try:
+        with conn:
+            applied = apply_migrations(conn)
+            version = current_version(conn)
+    except psycopg.Error as exc:
+        print(f"Database error: {exc}", file=sys.stderr)
+        return 1
+    if applied:
+        print(f"Applied migrations {applied}; schema at version {version}.")
+    else:
+        print(f"Schema already at version {version}.")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
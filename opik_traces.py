@@ -0,0 +1,144 @@
+import logging
+import os
+import random
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional
+
+from db import async_pooled_connection
+from write_behind import WriteBehindBuffer, copy_rows, table_copy_columns
+
+logger = logging.getLogger("aits")
+
+OPIK_TRACE_WRITE_BEHIND = os.getenv("OPIK_TRACE_WRITE_BEHIND", "1").lower() not in ("0", "false", "no")
+OPIK_TRACE_BATCH_SIZE = int(os.getenv("OPIK_TRACE_BATCH_SIZE", "200"))
+OPIK_TRACE_FLUSH_SECONDS = float(os.getenv("OPIK_TRACE_FLUSH_SECONDS", "0.5"))
+OPIK_TRACE_MAX_BUFFER = int(os.getenv("OPIK_TRACE_MAX_BUFFER", "10000"))
+# Tracing never holds a request: a full buffer spills straight to disk.
+OPIK_TRACE_BLOCK_SECONDS = float(os.getenv("OPIK_TRACE_BLOCK_SECONDS", "0"))
+OPIK_TRACE_SPILL_PATH = os.getenv("OPIK_TRACE_SPILL_PATH", "opik_traces.spill.jsonl")
+# Fraction of traces also sent to Opik itself (0 disables forwarding).
+OPIK_TRACE_SAMPLE_RATE = float(os.getenv("OPIK_TRACE_SAMPLE_RATE", "0"))
+OPIK_PROJECT_NAME = os.getenv("OPIK_PROJECT_NAME", "aits")
+
+TRACE_COLUMNS = (
+    "student_id",
+    "skill_name",
+    "time_on_task",
+    "attempt_count",
+    "hint_count",
+    "question",
+    "source",
+    "created_at",
+)
+
+_BUFFER: Optional[WriteBehindBuffer] = None
+_FORWARDER: Optional["OpikForwarder"] = None
+
+
+class OpikForwarder:
+    # Sends a sample of traces to Opik from a single background thread; the
+    # SDK is imported lazily and a failed setup disables forwarding.
+    def __init__(self, sample_rate: float, project_name: str = OPIK_PROJECT_NAME) -> None:
+        self.sample_rate = sample_rate
+        self.project_name = project_name
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="opik-forward")
+        self._client: Any = None
+        self._disabled = False
+        self.forwarded = 0
+        self.skipped = 0
+        self.failed = 0
+
+    def submit(self, rows: List[Dict[str, Any]]) -> None:
+        if self._disabled:
+            return
+        sampled = [row for row in rows if random.random() < self.sample_rate]
+        self.skipped += len(rows) - len(sampled)
+        if sampled:
+            self._executor.submit(self._send, sampled)
+
+    def _send(self, rows: List[Dict[str, Any]]) -> None:
+        try:
+            if self._client is None:
+                import opik
+
+                self._client = opik.Opik(project_name=self.project_name)
+            for row in rows:
+                self._client.trace(
+                    name=row.get("source") or "interaction",
+                    start_time=row.get("created_at"),
+                    input={"question": row.get("question")},
+                    metadata={key: row.get(key) for key in TRACE_COLUMNS if key != "created_at"},
+                    tags=[row["skill_name"]] if row.get("skill_name") else None,
+                )
+            self.forwarded += len(rows)
+        except Exception as exc:
+            self.failed += len(rows)
+            if self._client is None:
+                self._disabled = True
+            logger.warning("opik.forward_failed", extra={"rows": len(rows), "error": str(exc)})
+
+    def close(self) -> None:
+        self._executor.shutdown(wait=True)
+        if self._client is not None:
+            try:
+                self._client.flush()
+            except Exception as exc:
+                logger.warning("opik.forward_flush_failed", extra={"error": str(exc)})
+
+    def metrics(self) -> Dict[str, Any]:
+        return {
+            "sample_rate": self.sample_rate,
+            "forwarded": self.forwarded,
+            "skipped": self.skipped,
+            "failed": self.failed,
+            "disabled": self._disabled,
+        }
+
+
+def start_trace_ingest(use_db: bool) -> None:
+    global _BUFFER, _FORWARDER
+    if use_db and OPIK_TRACE_WRITE_BEHIND and _BUFFER is None:
+        _BUFFER = WriteBehindBuffer(
+            "opik_traces",
+            TRACE_COLUMNS,
+            batch_size=OPIK_TRACE_BATCH_SIZE,
+            flush_seconds=OPIK_TRACE_FLUSH_SECONDS,
+            max_buffer=OPIK_TRACE_MAX_BUFFER,
+            block_seconds=OPIK_TRACE_BLOCK_SECONDS,
+            spill_path=OPIK_TRACE_SPILL_PATH,
+        )
+        _BUFFER.start()
+    if OPIK_TRACE_SAMPLE_RATE > 0 and _FORWARDER is None:
+        _FORWARDER = OpikForwarder(OPIK_TRACE_SAMPLE_RATE)
+
+
+async def stop_trace_ingest() -> None:
+    global _BUFFER, _FORWARDER
+    if _BUFFER is not None:
+        buffer, _BUFFER = _BUFFER, None
+        await buffer.stop()
+    if _FORWARDER is not None:
+        forwarder, _FORWARDER = _FORWARDER, None
+        forwarder.close()
+
+
+async def ingest_traces(rows: List[Dict[str, Any]], use_db: bool) -> None:
+    # Coalesced through the write-behind buffer when it runs; otherwise one
+    # COPY per call. Raises psycopg.Error only on the direct path.
+    if _FORWARDER is not None:
+        _FORWARDER.submit(rows)
+    if not use_db or not rows:
+        return
+    if _BUFFER is not None:
+        await _BUFFER.log_many(rows)
+        return
+    async with async_pooled_connection() as conn:
+        columns = await table_copy_columns(conn, "opik_traces", TRACE_COLUMNS)
+        await copy_rows(conn, "opik_traces", columns, rows)
+
+
+def trace_ingest_metrics() -> Dict[str, Any]:
+    return {
+        "write_behind": {"enabled": False} if _BUFFER is None else {"enabled": True, **_BUFFER.metrics()},
+        "forwarding": {"enabled": False} if _FORWARDER is None else {"enabled": True, **_FORWARDER.metrics()},
+    }
@@ -0,0 +1,187 @@
+import asyncio
+import logging
+import os
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, Iterable, List, Optional, Set, Tuple
+
+from llm import generate_problems_with_llm_async
+
+logger = logging.getLogger("aits")
+
+ZPD_BANDS = ("support", "challenge", "stretch")
+# Mastery sent to the LLM when generating ahead of time for a band.
+BAND_MASTERY = {"support": 0.45, "challenge": 0.72, "stretch": 0.92}
+
+PROBLEM_POOL_LOW_WATERMARK = int(os.getenv("PROBLEM_POOL_LOW_WATERMARK", "3"))
+PROBLEM_POOL_HIGH_WATERMARK = int(os.getenv("PROBLEM_POOL_HIGH_WATERMARK", "10"))
+PROBLEM_POOL_CONCURRENCY = int(os.getenv("PROBLEM_POOL_CONCURRENCY", "4"))
+PROBLEM_POOL_BATCH_SIZE = int(os.getenv("PROBLEM_POOL_BATCH_SIZE", "5"))
+PROBLEM_POOL_RETRY_SECONDS = float(os.getenv("PROBLEM_POOL_RETRY_SECONDS", "30"))
+# Consecutive failures double the wait for a bucket, up to this cap.
+PROBLEM_POOL_MAX_RETRY_SECONDS = float(os.getenv("PROBLEM_POOL_MAX_RETRY_SECONDS", "600"))
+
+BucketKey = Tuple[str, str]
+ProblemGenerator = Callable[..., Awaitable[List[Dict[str, str]]]]
+
+_POOL: Optional["ProblemPool"] = None
+
+
+class ProblemPool:
+    def __init__(
+        self,
+        skills: Iterable[str],
+        generate: ProblemGenerator = generate_problems_with_llm_async,
+        low_watermark: int = PROBLEM_POOL_LOW_WATERMARK,
+        high_watermark: int = PROBLEM_POOL_HIGH_WATERMARK,
+        concurrency: int = PROBLEM_POOL_CONCURRENCY,
+        batch_size: int = PROBLEM_POOL_BATCH_SIZE,
+        retry_seconds: float = PROBLEM_POOL_RETRY_SECONDS,
+        max_retry_seconds: float = PROBLEM_POOL_MAX_RETRY_SECONDS,
+    ) -> None:
+        self.low_watermark = max(1, low_watermark)
+        self.high_watermark = max(self.low_watermark, high_watermark)
+        self.batch_size = max(1, batch_size)
+        self.retry_seconds = retry_seconds
+        self.max_retry_seconds = max(retry_seconds, max_retry_seconds)
+        self._generate = generate
+        self._buckets: Dict[BucketKey, Deque[Dict[str, str]]] = {
+            (skill, band): deque() for skill in skills for band in ZPD_BANDS
+        }
+        self._seen: Dict[BucketKey, Set[Tuple[str, str]]] = {key: set() for key in self._buckets}
+        self._filling: Dict[BucketKey, asyncio.Task] = {}
+        self._failures: Dict[BucketKey, int] = {}
+        self._semaphore = asyncio.Semaphore(max(1, concurrency))
+        self._wakeup = asyncio.Event()
+        self._runner: Optional[asyncio.Task] = None
+        self.hits = 0
+        self.misses = 0
+        self.generated = 0
+        self.failed = 0
+
+    def pop(self, skill_name: str, zpd_status: str) -> Optional[Dict[str, str]]:
+        key = (skill_name, zpd_status)
+        bucket = self._buckets.get(key)
+        if not bucket:
+            self.misses += 1
+            if bucket is not None:
+                self._wakeup.set()
+            return None
+        problem = bucket.popleft()
+        self._seen[key].discard((problem["latex"], problem["answer"]))
+        self.hits += 1
+        if len(bucket) < self.low_watermark:
+            self._wakeup.set()
+        return problem
+
+    def start(self) -> None:
+        if self._runner is None:
+            self._wakeup.set()
+            self._runner = asyncio.create_task(self._run(), name="problem-pool")
+
+    async def stop(self) -> None:
+        tasks = list(self._filling.values())
+        if self._runner is not None:
+            tasks.append(self._runner)
+            self._runner = None
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._filling.clear()
+
+    async def _run(self) -> None:
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            for key, bucket in self._buckets.items():
+                if key not in self._filling and len(bucket) < self.low_watermark:
+                    self._filling[key] = asyncio.create_task(self._fill(key))
+
+    async def _fill(self, key: BucketKey) -> None:
+        skill_name, band = key
+        bucket = self._buckets[key]
+        try:
+            while len(bucket) < self.high_watermark:
+                wanted = min(self.batch_size, self.high_watermark - len(bucket))
+                async with self._semaphore:
+                    problems = await self._generate(
+                        skill_name=skill_name,
+                        mastery=BAND_MASTERY[band],
+                        zpd_status=band,
+                        count=wanted,
+                    )
+                added = 0
+                for problem in problems:
+                    fingerprint = (problem["latex"], problem["answer"])
+                    if fingerprint in self._seen[key]:
+                        continue
+                    self._seen[key].add(fingerprint)
+                    bucket.append(problem)
+                    added += 1
+                self.generated += added
+                if added:
+                    self._failures.pop(key, None)
+                else:
+                    # Failed or all-repeat completions back off instead of spinning.
+                    await self._backoff(key)
+        except asyncio.CancelledError:
+            raise
+        except Exception as exc:
+            logger.warning(
+                "llm.pool.refill_failed", extra={"skill": skill_name, "zpd": band, "error": str(exc)}
+            )
+            # The bucket stays marked as filling while it waits, so the
+            # runner cannot restart it straight away.
+            await self._backoff(key)
+        finally:
+            self._filling.pop(key, None)
+            # Re-check in case the bucket drained again while this refill ran.
+            self._wakeup.set()
+
+    async def _backoff(self, key: BucketKey) -> None:
+        self.failed += 1
+        failures = self._failures.get(key, 0) + 1
+        self._failures[key] = failures
+        await asyncio.sleep(min(self.retry_seconds * 2 ** min(failures - 1, 16), self.max_retry_seconds))
+
+    def metrics(self) -> Dict[str, Any]:
+        requests = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / requests if requests else 0.0,
+            "generated": self.generated,
+            "failed": self.failed,
+            "refilling": len(self._filling),
+            "low_watermark": self.low_watermark,
+            "high_watermark": self.high_watermark,
+            "depth": {f"{skill}|{band}": len(bucket) for (skill, band), bucket in self._buckets.items()},
+        }
+
+
+def start_problem_pool(
+    skills: Iterable[str], generate: ProblemGenerator = generate_problems_with_llm_async
+) -> None:
+    global _POOL
+    if _POOL is not None:
+        return
+    _POOL = ProblemPool(skills, generate)
+    _POOL.start()
+
+
+async def stop_problem_pool() -> None:
+    global _POOL
+    if _POOL is not None:
+        pool, _POOL = _POOL, None
+        await pool.stop()
+
+
+def pop_pooled_problem(skill_name: str, zpd_status: str) -> Optional[Dict[str, str]]:
+    if _POOL is None:
+        return None
+    return _POOL.pop(skill_name, zpd_status)
+
+
+def problem_pool_metrics() -> Dict[str, Any]:
+    if _POOL is None:
+        return {"enabled": False}
+    return {"enabled": True, **_POOL.metrics()}
@@ -0,0 +1,129 @@
+from typing import Dict, Optional
+
+from db import DbOp, Query
+
+# Mastery is bucketed into this many equal-width bands for lookups. Migration
+# 3 backfills with the same banding, so changing it needs a new migration.
+MASTERY_BANDS = 5
+
+
+def mastery_band(mastery: float) -> int:
+    return min(MASTERY_BANDS - 1, max(0, int(mastery * MASTERY_BANDS)))
+
+
+def serve_stored_problem_op(
+    student_id: str, skill_name: str, zpd_status: str, mastery: float
+) -> DbOp[Optional[Dict[str, str]]]:
+    # Picks the oldest banked problem in the student's band (or a neighbouring
+    # one) whose bit is not yet set in their served bitmap, and sets it.
+    row = yield Query(
+        """
+        with served as (
+            select s.served from public.problem_served s
+            where s.student_id = %(student_id)s and s.skill_name = %(skill_name)s
+        ),
+        pick as (
+            select b.skill_name, b.skill_seq, b.prompt, b.latex, b.answer
+            from public.problem_bank b
+            where b.skill_name = %(skill_name)s
+              and b.zpd_status = %(zpd_status)s
+              and b.mastery_band between %(band)s - 1 and %(band)s + 1
+              and substring(coalesce((select served from served), B'') from b.skill_seq + 1 for 1)
+                  is distinct from B'1'
+            order by abs(b.mastery_band - %(band)s), b.skill_seq
+            limit 1
+        ),
+        mark as (
+            insert into public.problem_served (student_id, skill_name, served)
+            select %(student_id)s, p.skill_name, set_bit(repeat('0', p.skill_seq + 1)::varbit, p.skill_seq, 1)
+            from pick p
+            on conflict (student_id, skill_name) do update set
+                served = set_bit(
+                    problem_served.served || repeat(
+                        '0', greatest(0, length(excluded.served) - length(problem_served.served))
+                    )::varbit,
+                    length(excluded.served) - 1,
+                    1
+                ),
+                updated_at = now()
+        )
+        select prompt, latex, answer from pick
+        """,
+        {
+            "student_id": student_id,
+            "skill_name": skill_name,
+            "zpd_status": zpd_status,
+            "band": mastery_band(mastery),
+        },
+        "one",
+    )
+    if not row:
+        return None
+    return {"prompt": row["prompt"], "latex": row["latex"], "answer": row["answer"]}
+
+
+def bank_problem_op(
+    student_id: Optional[str],
+    skill_name: str,
+    zpd_status: str,
+    mastery: float,
+    problem: Dict[str, str],
+) -> DbOp[None]:
+    # skill_seq is the problem's bit in per-student bitmaps, so it is dense per
+    # skill; the lock serializes numbering for concurrent inserts of one skill.
+    yield Query("select pg_advisory_xact_lock(hashtext(%s))", (f"problem_bank:{skill_name}",))
+    row = yield Query(
+        """
+        with ins as (
+            insert into public.problem_bank (
+                content_hash, skill_name, zpd_status, mastery_band, skill_seq, prompt, latex, answer
+            )
+            select public.problem_content_hash(%(latex)s, %(answer)s),
+                   %(skill_name)s, %(zpd_status)s, %(band)s,
+                   coalesce(
+                       (select max(skill_seq) + 1 from public.problem_bank
+                        where skill_name = %(skill_name)s),
+                       0
+                   ),
+                   %(prompt)s, %(latex)s, %(answer)s
+            on conflict (content_hash) do nothing
+            returning skill_name, skill_seq
+        )
+        select skill_name, skill_seq from ins
+        union all
+        select skill_name, skill_seq from public.problem_bank
+        where content_hash = public.problem_content_hash(%(latex)s, %(answer)s)
+        limit 1
+        """,
+        {
+            "skill_name": skill_name,
+            "zpd_status": zpd_status,
+            "band": mastery_band(mastery),
+            "prompt": problem["prompt"],
+            "latex": problem["latex"],
+            "answer": problem["answer"],
+        },
+        "one",
+    )
+    if not row or not student_id:
+        return
+    yield from mark_served_op(student_id, row["skill_name"], row["skill_seq"])
+
+
+def mark_served_op(student_id: str, skill_name: str, skill_seq: int) -> DbOp[None]:
+    yield Query(
+        """
+        insert into public.problem_served (student_id, skill_name, served)
+        values (%(student_id)s, %(skill_name)s, set_bit(repeat('0', %(seq)s + 1)::varbit, %(seq)s, 1))
+        on conflict (student_id, skill_name) do update set
+            served = set_bit(
+                problem_served.served || repeat(
+                    '0', greatest(0, length(excluded.served) - length(problem_served.served))
+                )::varbit,
+                %(seq)s,
+                1
+            ),
+            updated_at = now()
+        """,
+        {"student_id": student_id, "skill_name": skill_name, "seq": skill_seq},
+    )
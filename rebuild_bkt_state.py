@@ -0,0 +1,385 @@
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+import psycopg
+from psycopg import sql
+
+from bkt import DEFAULT_PRIOR, advance_learner_state, get_skill_params, set_skill_params
+from cohort_stats import rebuild_cohort_stats_op
+from db import (
+    fetch_skill_bkt_params,
+    fetch_skill_priors,
+    get_connection,
+    get_table_columns,
+    pick_column,
+    run_op,
+)
+
+STAGING_TABLE = "bkt_state_staging"
+
+
+def resolve_layout(conn: psycopg.Connection) -> Dict[str, Any]:
+    columns = get_table_columns(conn, "bkt_state")
+    mastery_col = pick_column(columns, ("prior_skill_mastery", "prior_mastery", "mastery"))
+    if not mastery_col:
+        raise RuntimeError("bkt_state table missing mastery column")
+    return {
+        "mastery": mastery_col,
+        "attempts": pick_column(columns, ("attempt_count", "attempts")),
+        "velocity": pick_column(columns, ("learning_velocity", "velocity")),
+        "active": pick_column(columns, ("intervention_active",)),
+        "streak": pick_column(columns, ("recovery_streak",)),
+        "created_at": "created_at" in columns,
+        "updated_at": "updated_at" in columns,
+    }
+
+
+def layout_columns(layout: Dict[str, Any]) -> List[str]:
+    cols = ["student_id", "skill_name", layout["mastery"]]
+    if layout["attempts"]:
+        cols.append(layout["attempts"])
+    if layout["velocity"]:
+        cols.append(layout["velocity"])
+    if layout["active"]:
+        cols.append(layout["active"])
+    if layout["streak"]:
+        cols.append(layout["streak"])
+    if layout["created_at"]:
+        cols.append("created_at")
+    if layout["updated_at"]:
+        cols.append("updated_at")
+    return cols
+
+
+def _state_row(
+    layout: Dict[str, Any],
+    student_id: str,
+    skill_name: str,
+    mastery: float,
+    velocity: float,
+    attempt_count: int,
+    intervention: Dict[str, Any],
+    first_seen: Any,
+    last_seen: Any,
+) -> Tuple[Any, ...]:
+    row: List[Any] = [student_id, skill_name, mastery]
+    if layout["attempts"]:
+        row.append(attempt_count)
+    if layout["velocity"]:
+        row.append(velocity)
+    if layout["active"]:
+        row.append(bool(intervention.get("intervention_active")))
+    if layout["streak"]:
+        row.append(int(intervention.get("recovery_streak") or 0))
+    if layout["created_at"]:
+        row.append(first_seen)
+    if layout["updated_at"]:
+        row.append(last_seen)
+    return tuple(row)
+
+
+def replay_rows(
+    layout: Dict[str, Any], priors: Dict[str, float], rows: Iterable[Dict[str, Any]]
+) -> Iterator[Tuple[Any, ...]]:
+    # Folds attempts ordered by (student_id, skill_name, created_at) into one
+    # state row per pair.
+    key: Optional[Tuple[str, str]] = None
+    mastery = velocity = 0.0
+    attempt_count = 0
+    intervention: Dict[str, Any] = {}
+    first_seen = last_seen = None
+    for row in rows:
+        row_key = (row["student_id"], row["skill_name"])
+        if row_key != key:
+            if key is not None:
+                yield _state_row(
+                    layout, key[0], key[1], mastery, velocity,
+                    attempt_count, intervention, first_seen, last_seen,
+                )
+            key = row_key
+            mastery = priors.get(row_key[1], DEFAULT_PRIOR)
+            velocity = 0.0
+            intervention = {}
+            first_seen = row["created_at"]
+        prior = mastery
+        attempt_count = int(row.get("attempt_count") or 0)
+        mastery, intervention = advance_learner_state(
+            prior,
+            bool(row["correct"]),
+            attempt_count,
+            row.get("hints_used"),
+            intervention,
+            get_skill_params(row_key[1]),
+        )
+        velocity = mastery - prior
+        last_seen = row["created_at"]
+    if key is not None:
+        yield _state_row(
+            layout, key[0], key[1], mastery, velocity,
+            attempt_count, intervention, first_seen, last_seen,
+        )
+
+
+def export_snapshot(conn: psycopg.Connection) -> Tuple[str, str]:
+    # Every partition reads attempts through this one snapshot. The caller
+    # keeps the transaction open until the partitions have imported it.
+    conn.isolation_level = psycopg.IsolationLevel.REPEATABLE_READ
+    row = conn.execute(
+        "select pg_export_snapshot() as snapshot_id, pg_current_snapshot()::text as snapshot"
+    ).fetchone()
+    return row["snapshot_id"], row["snapshot"]
+
+
+def replay_partition(
+    partition: int,
+    partitions: int,
+    layout: Dict[str, Any],
+    priors: Dict[str, float],
+    params: Dict[str, Dict[str, float]],
+    batch_size: int,
+    snapshot_id: str,
+) -> Tuple[int, int]:
+    set_skill_params(params)
+    read_conn = get_connection()
+    write_conn = get_connection()
+    if not read_conn or not write_conn:
+        raise RuntimeError("SUPABASE_DB_URL not set")
+
+    copy_sql = f"copy public.{STAGING_TABLE} ({', '.join(layout_columns(layout))}) from stdin"
+    pairs = 0
+    attempts = 0
+
+    def counted(rows: Iterable[Dict[str, Any]]) -> Iterator[Dict[str, Any]]:
+        nonlocal attempts
+        for row in rows:
+            attempts += 1
+            yield row
+
+    with read_conn, write_conn:
+        read_conn.isolation_level = psycopg.IsolationLevel.REPEATABLE_READ
+        read_conn.execute(sql.SQL("set transaction snapshot {}").format(sql.Literal(snapshot_id)))
+        with read_conn.cursor(name=f"bkt_rebuild_{partition}") as read_cur:
+            read_cur.itersize = batch_size
+            read_cur.execute(
+                """
+                select student_id, skill_name, correct, attempt_count, hints_used, created_at
+                from public.attempts
+                where skill_name is not null
+                  and correct is not null
+                  and (hashtext(student_id::text) & 2147483647) %% %s = %s
+                order by student_id, skill_name, created_at
+                """,
+                (partitions, partition),
+            )
+            with write_conn.cursor() as write_cur:
+                with write_cur.copy(copy_sql) as copy:
+                    for state in replay_rows(layout, priors, counted(read_cur)):
+                        copy.write_row(state)
+                        pairs += 1
+    return pairs, attempts
+
+
+def prepare_staging(conn: psycopg.Connection) -> None:
+    with conn.cursor() as cur:
+        cur.execute(f"drop table if exists public.{STAGING_TABLE}")
+        cur.execute(
+            f"create unlogged table public.{STAGING_TABLE} (like public.bkt_state including defaults)"
+        )
+
+
+# The full xid8 of a row's 32-bit xmin, taking the epoch from the snapshot's
+# xmax. Rows much older than the snapshot can map wrongly; that only replays
+# their pair again, it never hides a newer attempt.
+ROW_XID8_SQL = """
+greatest(
+    case when ((%(xmax)s - a.xmin::text::bigint) & 4294967295) < 2147483648
+         then %(xmax)s - ((%(xmax)s - a.xmin::text::bigint) & 4294967295)
+         else %(xmax)s + 4294967296 - ((%(xmax)s - a.xmin::text::bigint) & 4294967295)
+    end,
+    0
+)::text::xid8
+"""
+
+
+def catch_up_staging(
+    conn: psycopg.Connection, layout: Dict[str, Any], priors: Dict[str, float], snapshot: str
+) -> Tuple[int, int]:
+    # Pairs with any attempt the replay snapshot could not see (committed
+    # after it, whatever its created_at) are replayed again from scratch, so
+    # late rows land in created_at order. Runs under the swap's locks, so
+    # nothing can commit in between. Returns (pairs, attempts) replayed.
+    cols = layout_columns(layout)
+    with conn.cursor() as cur:
+        cur.execute("select pg_snapshot_xmax(%s::pg_snapshot)::text::bigint as xmax", (snapshot,))
+        xmax = cur.fetchone()["xmax"]
+        cur.execute(
+            f"""
+            select distinct a.student_id, a.skill_name
+            from public.attempts a
+            where a.skill_name is not null
+              and a.correct is not null
+              and not pg_visible_in_snapshot({ROW_XID8_SQL}, %(snapshot)s::pg_snapshot)
+            order by a.student_id, a.skill_name
+            """,
+            {"xmax": xmax, "snapshot": snapshot},
+        )
+        pairs = [(row["student_id"], row["skill_name"]) for row in cur.fetchall()]
+        if not pairs:
+            return 0, 0
+        keys = ([pair[0] for pair in pairs], [pair[1] for pair in pairs])
+        cur.execute(
+            """
+            select a.student_id, a.skill_name, a.correct, a.attempt_count, a.hints_used, a.created_at
+            from public.attempts a
+            join unnest(%s::text[], %s::text[]) as k(student_id, skill_name)
+              on a.student_id = k.student_id and a.skill_name = k.skill_name
+            where a.correct is not null
+            order by a.student_id, a.skill_name, a.created_at
+            """,
+            keys,
+        )
+        rows = cur.fetchall()
+        cur.execute(
+            f"""
+            delete from public.{STAGING_TABLE} s
+            using unnest(%s::text[], %s::text[]) as k(student_id, skill_name)
+            where s.student_id = k.student_id and s.skill_name = k.skill_name
+            """,
+            keys,
+        )
+        cur.executemany(
+            f"insert into public.{STAGING_TABLE} ({', '.join(cols)}) "
+            f"values ({', '.join(['%s'] * len(cols))})",
+            list(replay_rows(layout, priors, rows)),
+        )
+    return len(pairs), len(rows)
+
+
+def swap_in_staging(
+    conn: psycopg.Connection,
+    layout: Dict[str, Any],
+    replace_all: bool,
+    priors: Dict[str, float],
+    snapshot: str,
+) -> Tuple[int, int]:
+    # Rows are moved into the live table rather than renaming the staging
+    # table, so grants, RLS policies and foreign keys on bkt_state survive.
+    # Locking attempts too holds back write-behind inserts, which never
+    # touch bkt_state, until the swap commits. Returns the catch-up counts.
+    cols = ", ".join(layout_columns(layout))
+    with conn.cursor() as cur:
+        cur.execute("lock table public.bkt_state in exclusive mode")
+        cur.execute("lock table public.attempts in share mode")
+        caught_up = catch_up_staging(conn, layout, priors, snapshot)
+        if replace_all:
+            cur.execute("delete from public.bkt_state")
+        else:
+            cur.execute(
+                f"""
+                delete from public.bkt_state b
+                using public.{STAGING_TABLE} s
+                where b.student_id = s.student_id and b.skill_name = s.skill_name
+                """
+            )
+        cur.execute(
+            f"insert into public.bkt_state ({cols}) select {cols} from public.{STAGING_TABLE}"
+        )
+        cur.execute(f"drop table public.{STAGING_TABLE}")
+    return caught_up
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(
+        description=(
+            "Rebuild public.bkt_state by replaying public.attempts through BKT. "
+            "Workers replay in parallel from one database snapshot; the swap locks "
+            "bkt_state and attempts and first replays again every pair with attempts "
+            "committed after that snapshot, so answers made during the rebuild are "
+            "kept. Answers still buffered by "
+            "the write-behind attempt log (ATTEMPT_LOG_WRITE_BEHIND=1) at swap "
+            "time have no attempts row yet and are overwritten: run the rebuild "
+            "with it off or while no answers arrive."
+        )
+    )
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--batch-size", type=int, default=20_000, help="Rows per cursor fetch.")
+    parser.add_argument(
+        "--replace-all",
+        action="store_true",
+        help="Drop bkt_state rows that have no attempts instead of keeping them.",
+    )
+    parser.add_argument(
+        "--no-swap",
+        action="store_true",
+        help=f"Leave results in public.{STAGING_TABLE} without touching bkt_state.",
+    )
+    args = parser.parse_args()
+
+    conn = get_connection()
+    if not conn:
+        print("SUPABASE_DB_URL not set.", file=sys.stderr)
+        return 1
+
+    started = time.perf_counter()
+    try:
+        with conn.transaction():
+            layout = resolve_layout(conn)
+            priors = fetch_skill_priors(conn)
+            params = fetch_skill_bkt_params(conn)
+            prepare_staging(conn)
+        set_skill_params(params)
+
+        snapshot_conn = get_connection()
+        if not snapshot_conn:
+            raise RuntimeError("SUPABASE_DB_URL not set")
+        partitions = max(1, args.workers)
+        with snapshot_conn:
+            snapshot_id, snapshot = export_snapshot(snapshot_conn)
+            with ProcessPoolExecutor(max_workers=partitions) as pool:
+                futures = [
+                    pool.submit(
+                        replay_partition,
+                        partition,
+                        partitions,
+                        layout,
+                        priors,
+                        params,
+                        args.batch_size,
+                        snapshot_id,
+                    )
+                    for partition in range(partitions)
+                ]
+                totals = [future.result() for future in futures]
+            snapshot_conn.rollback()
+        pairs = sum(item[0] for item in totals)
+        attempts = sum(item[1] for item in totals)
+        replayed = time.perf_counter() - started
+        print(f"Replayed {attempts:,} attempts into {pairs:,} pairs in {replayed:.1f}s.")
+
+        if args.no_swap:
+            print(f"Results left in public.{STAGING_TABLE}.")
+            return 0
+        with conn.transaction():
+            caught_up, late = swap_in_staging(conn, layout, args.replace_all, priors, snapshot)
+            # The incremental cohort totals cannot see a bulk swap.
+            cohorts = run_op(conn, rebuild_cohort_stats_op())
+        print(
+            f"Swapped into public.bkt_state in {time.perf_counter() - started - replayed:.1f}s "
+            f"({caught_up:,} pairs with answers from during the replay redone, {late:,} attempts)."
+        )
+        if cohorts:
+            print(f"Rebuilt {cohorts:,} cohort aggregates.")
+        return 0
+    except psycopg.Error as exc:
+        print(f"Database error: {exc}", file=sys.stderr)
+        return 1
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
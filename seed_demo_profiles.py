@@ -11,6 +11,7 @@ import psycopg
 
 from db import get_connection, get_table_columns, pick_column, ensure_student
 from main import COURSE_CATALOG, DEFAULT_PRIOR, sync_learning_path
+from migrations import apply_migrations
 
 
 DEMO_PROFILES: List[Dict[str, object]] = [
@@ -186,6 +187,7 @@ def main() -> int:
 
     try:
         with conn:
+            apply_migrations(conn)
             for profile in DEMO_PROFILES:
                 student_id = str(profile["student_id"])
                 ensure_student(conn, student_id)
@@ -0,0 +1,150 @@
+import logging
+import os
+import threading
+import time
+from types import MappingProxyType
+from typing import Dict, Mapping, NamedTuple, Optional
+
+import psycopg
+from psycopg.rows import dict_row
+
+from bkt import set_skill_params
+from db import (
+    DbOp,
+    Query,
+    get_db_url,
+    invalidate_schema,
+    pick_column,
+    run_op,
+    table_columns_op,
+)
+
+logger = logging.getLogger("aits")
+
+SKILLS_CHANNEL = "skills_changed"
+SKILL_TABLE_REFRESH_SECONDS = float(os.getenv("SKILL_TABLE_REFRESH_SECONDS", "300"))
+
+
+class SkillRecord(NamedTuple):
+    skill_name: str
+    prior: Optional[float]
+    skill_id_numeric: Optional[int]
+    params: Mapping[str, float]
+
+
+_SKILLS: Optional[Mapping[str, SkillRecord]] = None
+_LISTENER: Optional["SkillTableListener"] = None
+
+
+def skill_table_op() -> DbOp[Mapping[str, SkillRecord]]:
+    global _SKILLS
+    columns = yield from table_columns_op("skills")
+    prior_col = pick_column(columns, ("prior_mastery", "prior_skill_mastery", "prior"))
+    optional_cols = {
+        "prior": prior_col,
+        "skill_id_numeric": "skill_id_numeric" if "skill_id_numeric" in columns else None,
+        "guess": "bkt_guess" if "bkt_guess" in columns else None,
+        "slip": "bkt_slip" if "bkt_slip" in columns else None,
+        "transit": "bkt_transit" if "bkt_transit" in columns else None,
+    }
+    select_cols = ["skill_name"] + [
+        f"{col} as {name}" for name, col in optional_cols.items() if col
+    ]
+    rows = []
+    if "skill_name" in columns:
+        rows = yield Query(f"select {', '.join(select_cols)} from public.skills", None, "all")
+
+    records: Dict[str, SkillRecord] = {}
+    params_table: Dict[str, Dict[str, float]] = {}
+    for row in rows:
+        params = {
+            name: float(row[name])
+            for name in ("guess", "slip", "transit")
+            if row.get(name) is not None
+        }
+        if params:
+            params_table[row["skill_name"]] = params
+        records[row["skill_name"]] = SkillRecord(
+            skill_name=row["skill_name"],
+            prior=float(row["prior"]) if row.get("prior") is not None else None,
+            skill_id_numeric=(
+                int(row["skill_id_numeric"]) if row.get("skill_id_numeric") is not None else None
+            ),
+            params=MappingProxyType(params),
+        )
+    # Readers only ever see a complete table: the reference is swapped last.
+    set_skill_params(params_table)
+    _SKILLS = MappingProxyType(records)
+    return _SKILLS
+
+
+def load_skill_table(conn: psycopg.Connection) -> Mapping[str, SkillRecord]:
+    return run_op(conn, skill_table_op())
+
+
+def skill_table_loaded() -> bool:
+    return _SKILLS is not None
+
+
+def get_skill_record(skill_name: str) -> Optional[SkillRecord]:
+    if _SKILLS is None:
+        return None
+    return _SKILLS.get(skill_name)
+
+
+def cached_skill_prior(skill_name: str, default: float) -> float:
+    record = get_skill_record(skill_name)
+    if record is None or record.prior is None:
+        return default
+    return record.prior
+
+
+class SkillTableListener(threading.Thread):
+    def __init__(self, db_url: str, refresh_seconds: float) -> None:
+        super().__init__(name="skill-table-listener", daemon=True)
+        self.db_url = db_url
+        self.refresh_seconds = refresh_seconds
+        self._stop_event = threading.Event()
+
+    def stop(self) -> None:
+        self._stop_event.set()
+
+    def run(self) -> None:
+        while not self._stop_event.is_set():
+            try:
+                with psycopg.connect(
+                    self.db_url, autocommit=True, row_factory=dict_row
+                ) as conn:
+                    conn.execute(f"listen {SKILLS_CHANNEL}")
+                    # Reload after (re)connecting in case a change was missed.
+                    load_skill_table(conn)
+                    next_refresh = time.monotonic() + self.refresh_seconds
+                    while not self._stop_event.is_set():
+                        notified = bool(list(conn.notifies(timeout=1.0)))
+                        if notified or time.monotonic() >= next_refresh:
+                            # Fitting scripts add columns with ALTER, which
+                            # does not notify, so re-read them as well.
+                            invalidate_schema("skills")
+                            load_skill_table(conn)
+                            next_refresh = time.monotonic() + self.refresh_seconds
+                            logger.info("skills.table.reloaded", extra={"notified": notified})
+            except psycopg.Error as exc:
+                logger.warning("skills.table.listener_failed", extra={"error": str(exc)})
+                self._stop_event.wait(5.0)
+
+
+def start_skill_table_listener() -> None:
+    global _LISTENER
+    db_url = get_db_url()
+    if not db_url or _LISTENER is not None:
+        return
+    _LISTENER = SkillTableListener(db_url, SKILL_TABLE_REFRESH_SECONDS)
+    _LISTENER.start()
+
+
+def stop_skill_table_listener() -> None:
+    global _LISTENER
+    if _LISTENER is not None:
+        _LISTENER.stop()
+        _LISTENER.join(timeout=5.0)
+        _LISTENER = None
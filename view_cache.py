@@ -0,0 +1,120 @@
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, NamedTuple, Optional, Tuple
+
+STUDENT_VIEW_CACHE_MAX_ENTRIES = int(os.getenv("STUDENT_VIEW_CACHE_MAX_ENTRIES", "10000"))
+# Bounds staleness from writes the bkt_state stamp does not reflect
+# (seeding scripts, skill prior reloads); 0 keeps entries until a bump.
+STUDENT_VIEW_CACHE_TTL_SECONDS = float(os.getenv("STUDENT_VIEW_CACHE_TTL_SECONDS", "30"))
+
+ViewKey = Tuple[str, str]
+
+
+class CachedView(NamedTuple):
+    version: int
+    stamp: Any
+    etag: str
+    body: bytes
+    stored_at: float
+
+
+def body_etag(body: bytes) -> str:
+    # Content-derived, so every worker hands out the same tag for the same view.
+    return f'"{hashlib.blake2b(body, digest_size=12).hexdigest()}"'
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    tags = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+    return "*" in tags or etag in tags
+
+
+class StudentViewCache:
+    # Serialized per-student read views (courses, assignments), keyed by a
+    # per-student version that answer submissions in this process bump and a
+    # stamp the caller reads from the database, which moves with answers on
+    # any worker. An entry is served only while both are current and it is
+    # younger than ttl_seconds.
+    def __init__(
+        self,
+        max_entries: int = STUDENT_VIEW_CACHE_MAX_ENTRIES,
+        ttl_seconds: float = STUDENT_VIEW_CACHE_TTL_SECONDS,
+    ) -> None:
+        self.max_entries = max(1, max_entries)
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        self._versions: Dict[str, int] = {}
+        self._entries: "OrderedDict[ViewKey, CachedView]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.not_modified = 0
+        self.bumps = 0
+
+    def version(self, student_id: str) -> int:
+        with self._lock:
+            return self._versions.get(student_id, 0)
+
+    def bump(self, student_id: str) -> None:
+        with self._lock:
+            self._versions[student_id] = self._versions.get(student_id, 0) + 1
+            self.bumps += 1
+            if len(self._versions) > 2 * self.max_entries:
+                # Older entries now fail the version check in get(). A version
+                # only needs to outlive the entries built from it, and at
+                # least half the students have none.
+                live = {key[0] for key in self._entries}
+                for stale in [sid for sid in self._versions if sid not in live]:
+                    del self._versions[stale]
+
+    def get(
+        self, student_id: str, view: str, version: int, stamp: Any = None
+    ) -> Optional[CachedView]:
+        key = (student_id, view)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and (
+                entry.version != version
+                or entry.stamp != stamp
+                or (self.ttl_seconds > 0 and time.monotonic() - entry.stored_at > self.ttl_seconds)
+            ):
+                del self._entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(
+        self, student_id: str, view: str, version: int, body: bytes, stamp: Any = None
+    ) -> CachedView:
+        entry = CachedView(version, stamp, body_etag(body), body, time.monotonic())
+        with self._lock:
+            # A bump while the view was being read makes it stale on arrival.
+            if self._versions.get(student_id, 0) == version:
+                self._entries[(student_id, view)] = entry
+                self._entries.move_to_end((student_id, view))
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+        return entry
+
+    def record_not_modified(self) -> None:
+        with self._lock:
+            self.not_modified += 1
+
+    def metrics(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "students": len(self._versions),
+                "hits": self.hits,
+                "misses": self.misses,
+                "not_modified": self.not_modified,
+                "bumps": self.bumps,
+                "ttl_seconds": self.ttl_seconds,
+            }
@@ -0,0 +1,288 @@
+import asyncio
+import glob
+import json
+import logging
+import os
+import time
+import uuid
+from collections import deque
+from datetime import datetime
+from typing import Any, Deque, Dict, Iterable, List, Optional, Sequence
+
+import psycopg
+
+from db import async_pooled_connection, run_op_async, table_columns_op
+
+logger = logging.getLogger("aits")
+
+
+def _encode(value: Any) -> Any:
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f"Cannot encode {type(value).__name__}")
+
+
+async def copy_rows(
+    conn: psycopg.AsyncConnection, table: str, columns: Sequence[str], rows: Iterable[Dict[str, Any]]
+) -> None:
+    async with conn.cursor() as cur:
+        async with cur.copy(f"copy public.{table} ({', '.join(columns)}) from stdin") as copy:
+            for row in rows:
+                await copy.write_row([row.get(col) for col in columns])
+
+
+async def table_copy_columns(
+    conn: psycopg.AsyncConnection, table: str, columns: Sequence[str]
+) -> List[str]:
+    # Only the columns this deployment's table actually has, in a stable order.
+    table_columns = await run_op_async(conn, table_columns_op(table))
+    return [col for col in columns if col in table_columns]
+
+
+def _pid_alive(pid: int) -> bool:
+    if os.name == "nt":
+        # os.kill would terminate it; leave the file to its own process.
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class WriteBehindBuffer:
+    # Rows are buffered in process and written with COPY once batch_size rows
+    # are waiting or flush_seconds have passed. Batches that cannot be written
+    # go to an append-only JSONL spill file, which is replayed after the next
+    # successful flush. Each process spills to "<spill_path>.<pid>", so
+    # workers never share a file; files left by exited processes are claimed
+    # with an atomic rename, so exactly one worker replays each of them.
+    def __init__(
+        self,
+        table: str,
+        columns: Sequence[str],
+        batch_size: int,
+        flush_seconds: float,
+        max_buffer: int,
+        block_seconds: float,
+        spill_path: str,
+    ) -> None:
+        self.table = table
+        self.wanted_columns = tuple(columns)
+        self.batch_size = max(1, batch_size)
+        self.flush_seconds = flush_seconds
+        self.max_buffer = max(self.batch_size, max_buffer)
+        self.block_seconds = block_seconds
+        self.spill_path = spill_path
+        self._pid = os.getpid()
+        self._spill_file = f"{spill_path}.{self._pid}"
+        self._buffer: Deque[Dict[str, Any]] = deque()
+        self._wakeup = asyncio.Event()
+        self._drained = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._runner: Optional[asyncio.Task] = None
+        self._columns: Optional[List[str]] = None
+        # Cleared by a failed write; spilled rows are only replayed once the DB answers again.
+        self._healthy = True
+        self.enqueued = 0
+        self.flushed = 0
+        self.batches = 0
+        self.blocked = 0
+        self.spilled = 0
+        self.replayed = 0
+        self.rejected = 0
+        self.failures = 0
+        self.max_depth = 0
+        self.last_flush_ms = 0.0
+        self.last_error: Optional[str] = None
+        self._name = f"write-behind-{table}"
+
+    async def log_many(self, rows: Iterable[Dict[str, Any]]) -> None:
+        for row in rows:
+            await self.log(row)
+
+    async def log(self, row: Dict[str, Any]) -> None:
+        if len(self._buffer) >= self.max_buffer:
+            # Backpressure: hold the request briefly for a flush, then fall
+            # back to the spill file rather than growing without bound.
+            self.blocked += 1
+            self._wakeup.set()
+            self._drained.clear()
+            try:
+                await asyncio.wait_for(self._drained.wait(), self.block_seconds)
+            except asyncio.TimeoutError:
+                pass
+            if len(self._buffer) >= self.max_buffer:
+                self._spill([row])
+                return
+        self._buffer.append(row)
+        self.enqueued += 1
+        self.max_depth = max(self.max_depth, len(self._buffer))
+        if len(self._buffer) >= self.batch_size:
+            self._wakeup.set()
+
+    def start(self) -> None:
+        if self._runner is None:
+            self._runner = asyncio.create_task(self._run(), name=self._name)
+
+    async def stop(self) -> None:
+        if self._runner is not None:
+            runner, self._runner = self._runner, None
+            runner.cancel()
+            await asyncio.gather(runner, return_exceptions=True)
+        # Flush on shutdown; whatever still fails lands in the spill file.
+        while self._buffer:
+            if not await self.flush():
+                break
+        if self._buffer:
+            self._spill(list(self._buffer))
+            self._buffer.clear()
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.flush_seconds)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            # The flusher must outlive any one bad pass: without it the buffer
+            # only fills and every write waits block_seconds.
+            try:
+                while self._buffer:
+                    if not await self.flush():
+                        break
+                    if len(self._buffer) < self.batch_size:
+                        break
+                if self._healthy and not self._buffer:
+                    await self._replay_spill()
+            except Exception as exc:
+                self.failures += 1
+                self.last_error = str(exc)
+                logger.exception("write_behind.flusher_failed", extra={"table": self.table})
+
+    async def flush(self) -> bool:
+        async with self._flush_lock:
+            batch = [self._buffer.popleft() for _ in range(min(self.batch_size, len(self._buffer)))]
+            if not batch:
+                return True
+            self._drained.set()
+            try:
+                await self._copy(batch)
+            except (psycopg.Error, OSError, RuntimeError) as exc:
+                self.failures += 1
+                self.last_error = str(exc)
+                self._healthy = False
+                logger.warning(
+                    "write_behind.flush_failed",
+                    extra={"table": self.table, "rows": len(batch), "error": str(exc)},
+                )
+                self._spill(batch)
+                return False
+            self._healthy = True
+            self.flushed += len(batch)
+            self.batches += 1
+            return True
+
+    async def _copy(self, rows: List[Dict[str, Any]]) -> None:
+        started = time.perf_counter()
+        async with async_pooled_connection() as conn:
+            if self._columns is None:
+                self._columns = await table_copy_columns(conn, self.table, self.wanted_columns)
+            await copy_rows(conn, self.table, self._columns, rows)
+        self.last_flush_ms = (time.perf_counter() - started) * 1000
+
+    def _spill(self, rows: List[Dict[str, Any]]) -> None:
+        try:
+            with open(self._spill_file, "a", encoding="utf-8") as handle:
+                for row in rows:
+                    handle.write(json.dumps(row, default=_encode) + "\n")
+                handle.flush()
+                os.fsync(handle.fileno())
+            self.spilled += len(rows)
+        except OSError as exc:
+            logger.error(
+                "write_behind.spill_failed",
+                extra={"table": self.table, "rows": len(rows), "error": str(exc)},
+            )
+
+    def _claimable_spills(self) -> List[str]:
+        # This process's file, files (and unfinished claims) of processes that
+        # have exited, and the unsuffixed file of earlier releases.
+        paths = [self.spill_path] if os.path.exists(self.spill_path) else []
+        for path in sorted(glob.glob(glob.escape(self.spill_path) + ".*")):
+            owner = path[len(self.spill_path) + 1 :].split(".", 1)[0]
+            if owner.isdigit() and (int(owner) == self._pid or not _pid_alive(int(owner))):
+                paths.append(path)
+        return paths
+
+    async def _replay_spill(self) -> None:
+        for path in self._claimable_spills():
+            # A unique name per claim: if another worker renamed it first the
+            # file is theirs, and rows spilled meanwhile start a new file.
+            claimed = f"{self._spill_file}.replay-{uuid.uuid4().hex[:8]}"
+            try:
+                os.rename(path, claimed)
+            except FileNotFoundError:
+                continue
+            if not await self._replay_file(claimed):
+                return
+
+    async def _replay_file(self, path: str) -> bool:
+        rows: List[Dict[str, Any]] = []
+        bad: List[str] = []
+        with open(path, encoding="utf-8", errors="replace") as handle:
+            for line in handle:
+                if not line.strip():
+                    continue
+                try:
+                    rows.append(json.loads(line))
+                except ValueError:
+                    # e.g. the last line of a spill cut short by a crash.
+                    bad.append(line if line.endswith("\n") else line + "\n")
+        if bad:
+            self._reject(bad)
+        for start in range(0, len(rows), self.batch_size):
+            batch = rows[start : start + self.batch_size]
+            try:
+                await self._copy(batch)
+            except (psycopg.Error, OSError, RuntimeError) as exc:
+                self.last_error = str(exc)
+                self._healthy = False
+                self._spill(rows[start:])
+                os.remove(path)
+                return False
+            self.replayed += len(batch)
+        os.remove(path)
+        logger.info("write_behind.spill_replayed", extra={"table": self.table, "rows": len(rows)})
+        return True
+
+    def _reject(self, lines: List[str]) -> None:
+        # Kept for inspection rather than dropped; never replayed.
+        self.rejected += len(lines)
+        logger.warning(
+            "write_behind.spill_rejected", extra={"table": self.table, "lines": len(lines)}
+        )
+        try:
+            with open(f"{self.spill_path}.rejected", "a", encoding="utf-8") as handle:
+                handle.writelines(lines)
+        except OSError as exc:
+            logger.error("write_behind.reject_failed", extra={"table": self.table, "error": str(exc)})
+
+    def metrics(self) -> Dict[str, Any]:
+        return {
+            "depth": len(self._buffer),
+            "max_depth": self.max_depth,
+            "max_buffer": self.max_buffer,
+            "enqueued": self.enqueued,
+            "flushed": self.flushed,
+            "batches": self.batches,
+            "blocked": self.blocked,
+            "spilled": self.spilled,
+            "replayed": self.replayed,
+            "rejected": self.rejected,
+            "failures": self.failures,
+            "last_flush_ms": round(self.last_flush_ms, 2),
+            "last_error": self.last_error,
+        }